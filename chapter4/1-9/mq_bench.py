@@ -0,0 +1,628 @@
+# Benchmarks for the message brokers in this directory. Each benchmark starts
+# a broker (mq_server.py by default) as a separate process on a free port, so
+# that the broker gets a core to itself and can be measured from outside,
+# exactly as real clients would see it.
+#
+#   python mq_bench.py fanout --subscribers 1 10 100 1000
+#   python mq_bench.py fanout --payload json --compress
+#   python mq_bench.py transport --transports tcp unix loopback
+#   python mq_bench.py churn --subscribers 0 10000 --clients 100000
+#   python mq_bench.py rpc --concurrency 1 10 100
+#   python mq_bench.py --server mq_server.py --server mq_server_plus.py \
+#       latency --rate 5000
+import argparse
+import asyncio
+import contextlib
+import importlib
+import json
+import os
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from functools import partial
+from typing import Dict, List, Tuple
+from msgproto import (
+    FrameProtocol, Codec, read_msg, send_msg, encode_compress, encode_msg,
+    encode_request, PLAIN, start_frame_server, start_frame_unix_server,
+    open_frame_connection, open_frame_unix_connection)
+from mq_client import BrokerClient
+from mq_loopback import LoopbackServer, open_loopback_connection
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def start_broker(script: str, port: int, *extra: str):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, script), '--port', str(port),
+         *extra],
+        cwd=HERE, stdout=subprocess.DEVNULL)
+    # The broker prints nothing useful to wait on, so poll until it accepts
+    # connections. The probe subscribes to /null, since the broker expects
+    # every connection to start with a subscription.
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            await asyncio.sleep(0.05)
+            continue
+        await send_msg(writer, b'/null')
+        writer.close()
+        await writer.wait_closed()
+        return proc
+    proc.terminate()
+    raise RuntimeError(f'{script} did not start listening on port {port}')
+
+
+def stop_broker(proc: subprocess.Popen):
+    proc.terminate()
+    proc.wait()
+
+
+# A subscriber that does nothing but count what it receives. It uses the
+# buffered framer with retain=False, so no per-message objects are created
+# on the receiving side and the numbers reflect the broker, not the
+# benchmark. Payloads starting with b'w' are warm-up messages and are not
+# counted. (A single b'w' is never worth compressing, so on a compressed
+# connection it arrives as PLAIN + b'w'.) Messages aren't decompressed
+# either; only their size on the wire is added up.
+class Counter(FrameProtocol):
+    def __init__(self, tally: 'Tally'):
+        super().__init__(retain=False)
+        self.tally = tally
+        self.warm = False
+
+    def frame_received(self, frame: memoryview):
+        if frame[:1] == b'w' or frame[:2] == PLAIN + b'w':
+            self.warm = True
+        else:
+            self.tally.bytes += len(frame)
+            self.tally.add()
+
+
+class Tally:
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.target = 0
+        self.done = asyncio.get_running_loop().create_future()
+
+    def add(self):
+        self.count += 1
+        if self.count == self.target and not self.done.done():
+            self.done.set_result(time.perf_counter())
+
+
+async def subscribe(port: int, channel: bytes, tally: Tally,
+                    protocol=Counter, codec: Codec = None):
+    loop = asyncio.get_running_loop()
+    transport, counter = await loop.create_connection(
+        lambda: protocol(tally), '127.0.0.1', port)
+    if codec:
+        transport.writelines(encode_compress(codec.dict_id))
+    transport.writelines([len(channel).to_bytes(4, byteorder='big'), channel])
+    return transport, counter
+
+
+# There is no acknowledgement for a subscription, so keep publishing warm-up
+# messages until every subscriber has seen one. After that, we know that all
+# of them are registered with the broker.
+async def warm_up(writer: asyncio.StreamWriter, channel: bytes, counters):
+    while not all(c.warm for c in counters):
+        await send_msg(writer, channel)
+        await send_msg(writer, b'w')
+        await asyncio.sleep(0.1)
+
+
+# Something like the JSON messages of a real application, for measuring
+# compression: the same keys every time, different values.
+def json_payload(size: int, i: int) -> bytes:
+    record = json.dumps(dict(
+        id=i, type='order.updated', status='shipped', currency='EUR',
+        amount=round(i * 1.37 % 1000, 2), customer=f'customer-{i % 977}',
+        timestamp=1700000000 + i)).encode()
+    return (record * (size // len(record) + 1))[:size]
+
+
+async def fanout_once(port: int, subscribers: int, messages: int,
+                      size: int, payload: str = 'x',
+                      codec: Codec = None) -> Tuple[float, float]:
+    channel = b'/topic/bench'
+    tally = Tally()
+    conns = [await subscribe(port, channel, tally, codec=codec)
+             for _ in range(subscribers)]
+    _, writer = await asyncio.open_connection('127.0.0.1', port)
+    await send_msg(writer, b'/null')
+    await warm_up(writer, channel, [c for _, c in conns])
+    tally.target = tally.count + messages * subscribers
+    first = tally.bytes
+    data = [b'x' * size] if payload == 'x' else [
+        json_payload(size, i) for i in range(100)]
+    t0 = time.perf_counter()
+    for i in range(messages):
+        await send_msg(writer, channel)
+        await send_msg(writer, data[i % len(data)])
+    t1 = await asyncio.wait_for(tally.done, timeout=300)
+    writer.close()
+    await writer.wait_closed()
+    for transport, _ in conns:
+        transport.close()
+    return (messages / (t1 - t0),
+            (tally.bytes - first) / (messages * subscribers))
+
+
+# How does publish throughput hold up as a topic gains subscribers? Each
+# message published is delivered to every subscriber, so deliveries/s is
+# the rate at which the broker writes frames to sockets. With --compress,
+# the subscribers ask for compressed messages, and bytes/delivery shows what
+# that saves on the wire.
+async def bench_fanout(args):
+    codec = None
+    if args.compress:
+        zdict = b''
+        if args.zdict:
+            with open(args.zdict, 'rb') as f:
+                zdict = f.read()
+        codec = Codec(zdict)
+    for server in args.server:
+        port = free_port()
+        proc = await start_broker(server, port, *args.server_args)
+        try:
+            print(f'{server}: {args.messages} messages of {args.size} bytes')
+            for n in args.subscribers:
+                rate, size = await fanout_once(port, n, args.messages,
+                                               args.size, args.payload, codec)
+                print(f'{n:>7} subscribers {rate:>12,.0f} msgs/s '
+                      f'{rate * n:>14,.0f} deliveries/s '
+                      f'{size:>8,.1f} bytes/delivery')
+        finally:
+            stop_broker(proc)
+
+
+# A client that comes and goes: it subscribes, and disconnects right away.
+# It only closes its sending side, though, and waits for the broker to close
+# the other, so that it doesn't leave before the broker has even accepted
+# it. (That would only fill up the broker's listen backlog.) It connects
+# through the broker's Unix socket: over TCP, every connection would leave
+# a port in TIME_WAIT, and there aren't enough ports for a hundred thousand
+# of them in a minute.
+async def churn_client(path: str, channel: bytes):
+    reader, writer = await asyncio.open_unix_connection(path)
+    await send_msg(writer, channel)
+    writer.write_eof()
+    await reader.read()
+    writer.close()
+    with contextlib.suppress(ConnectionError):
+        await writer.wait_closed()
+
+
+# A client that sends itself a message. By the time it comes back, the
+# broker has dealt with the clients that connected before this one.
+async def round_trip(path: str):
+    reader, writer = await asyncio.open_unix_connection(path)
+    await send_msg(writer, b'/topic/probe')
+    await send_msg(writer, b'/topic/probe')
+    await send_msg(writer, b'p')
+    await read_msg(reader)
+    writer.close()
+    await writer.wait_closed()
+
+
+async def churn_once(port: int, path: str, subscribers: int, clients: int,
+                     concurrency: int, rate: float,
+                     size: int) -> Tuple[float, float]:
+    channel = b'/topic/bench'
+    tally = Tally()
+    conns = [await subscribe(port, channel, tally)
+             for _ in range(subscribers)]
+    _, writer = await asyncio.open_connection('127.0.0.1', port)
+    await send_msg(writer, b'/null')
+    await warm_up(writer, channel, [c for _, c in conns])
+    first = tally.count
+    done = asyncio.Event()
+
+    # Messages go out at a steady rate, and the steady subscribers show
+    # whether the broker still keeps up with its publishers while all this
+    # goes on.
+    async def publisher():
+        data = b'x' * size
+        start = time.perf_counter()
+        i = 0
+        while not done.is_set():
+            i += 1
+            if (delay := start + i / rate - time.perf_counter()) > 0:
+                await asyncio.sleep(delay)
+            await send_msg(writer, channel)
+            await send_msg(writer, data)
+
+    async def churner(count: int):
+        for _ in range(count):
+            await churn_client(path, channel)
+
+    task = asyncio.create_task(publisher())
+    t0 = time.perf_counter()
+    await asyncio.gather(*[
+        churner(clients // concurrency + (i < clients % concurrency))
+        for i in range(concurrency)])
+    await round_trip(path)
+    elapsed = time.perf_counter() - t0
+    done.set()
+    await task
+    delivered = tally.count - first
+    writer.close()
+    await writer.wait_closed()
+    for transport, _ in conns:
+        transport.close()
+    return clients / elapsed, delivered / elapsed
+
+
+# How do connections coming and going hold up a broker that has a crowd of
+# subscribers on the same channel? Every churning client subscribes to the
+# channel that the steady subscribers are on, so the cost of adding and,
+# above all, removing a subscriber grows with their number if it's O(n).
+# Meanwhile, a publisher sends --rate messages per second to the channel;
+# deliveries/s is how many of them reached the steady subscribers.
+async def bench_churn(args):
+    directory = tempfile.mkdtemp(prefix='mq-bench-')
+    path = os.path.join(directory, 'broker.sock')
+    for server in args.server:
+        port = free_port()
+        proc = await start_broker(server, port, '--unix', path,
+                                  *args.server_args)
+        try:
+            print(f'{server}: {args.clients} clients, {args.concurrency} at '
+                  f'a time, {args.rate:,.0f} messages/s')
+            for n in args.subscribers:
+                churn, delivered = await churn_once(
+                    port, path, n, args.clients, args.concurrency, args.rate,
+                    args.size)
+                print(f'{n:>7} subscribers {churn:>10,.0f} clients/s '
+                      f'{delivered:>14,.0f} deliveries/s')
+        finally:
+            stop_broker(proc)
+    shutil.rmtree(directory)
+
+
+# The service for the request/reply benchmark: it sends every request back
+# as its own reply.
+async def echo_service(client: BrokerClient, channel: bytes):
+    await client.subscribe(channel)
+    async for request in client:
+        await client.reply(request, request[-1:])
+
+
+# A call the way it's done without request/reply support in the client: a
+# connection of its own, subscribed to a reply channel of its own.
+async def call_with_connection(port: int, channel: bytes):
+    reply_to = b'/reply/' + uuid.uuid4().hex.encode()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.writelines(encode_msg(reply_to) + encode_msg(channel) + encode_msg(
+        encode_request(b'0', reply_to, b'x')))
+    await read_msg(reader)
+    writer.close()
+    with contextlib.suppress(ConnectionError):
+        await writer.wait_closed()
+
+
+async def rpc_once(port: int, mode: str, calls: int,
+                   concurrency: int) -> Tuple[float, Dict[str, float]]:
+    channel = b'/queue/rpc'
+    client = BrokerClient('127.0.0.1', port)
+    client.start()
+    latencies = []
+
+    async def caller(count: int):
+        for _ in range(count):
+            t = time.perf_counter()
+            if mode == 'connection':
+                await call_with_connection(port, channel)
+            else:
+                await client.request(channel, b'x', timeout=None)
+            latencies.append(time.perf_counter() - t)
+
+    # The first call waits for the service to be subscribed, and for our
+    # own reply channel.
+    await client.request(channel, b'x', timeout=None)
+    t0 = time.perf_counter()
+    await asyncio.gather(*[
+        caller(calls // concurrency + (i < calls % concurrency))
+        for i in range(concurrency)])
+    elapsed = time.perf_counter() - t0
+    await client.close()
+    return calls / elapsed, percentiles(latencies)
+
+
+# Calls per second and their latency, with up to --concurrency calls at a
+# time, all of them multiplexed on one connection (see
+# mq_client.BrokerClient.request()), or each one on a connection of its
+# own.
+async def bench_rpc(args):
+    for server in args.server:
+        port = free_port()
+        proc = await start_broker(server, port, *args.server_args)
+        service = BrokerClient('127.0.0.1', port)
+        service.start()
+        task = asyncio.create_task(echo_service(service, b'/queue/rpc'))
+        try:
+            print(f'{server}: {args.calls} calls')
+            for mode in args.modes:
+                for n in args.concurrency:
+                    rate, latency = await rpc_once(port, mode, args.calls, n)
+                    print(f'{mode:>10} {n:>5} at a time {rate:>10,.0f} '
+                          f'calls/s  p50 {latency["p50"]:>8.3f} ms  '
+                          f'p99 {latency["p99"]:>8.3f} ms')
+        finally:
+            task.cancel()
+            await service.close(flush=False)
+            stop_broker(proc)
+
+
+# A subscriber for the transport benchmark. It reads with read_msg(), the
+# way the broker's own client() coroutines do, because that is the one
+# interface all three transports have in common.
+async def count_frames(reader, tally: Tally, warm: asyncio.Event):
+    with contextlib.suppress(asyncio.IncompleteReadError, ConnectionError):
+        while True:
+            frame = await read_msg(reader)
+            if frame[:1] == b'w':
+                warm.set()
+            else:
+                tally.add()
+
+
+async def transport_once(broker, transport: str, subscribers: int,
+                         messages: int, size: int) -> float:
+    directory = tempfile.mkdtemp(prefix='mq-bench-')
+    if transport == 'tcp':
+        port = free_port()
+        server = await start_frame_server(broker.client, '127.0.0.1', port)
+        connect = partial(open_frame_connection, '127.0.0.1', port)
+    elif transport == 'unix':
+        path = os.path.join(directory, 'broker.sock')
+        server = await start_frame_unix_server(broker.client, path)
+        connect = partial(open_frame_unix_connection, path)
+    else:
+        server = LoopbackServer(broker.client)
+        connect = partial(open_loopback_connection, server)
+    channel = b'/topic/bench'
+    tally = Tally()
+    writers, readers = [], []
+    for _ in range(subscribers):
+        reader, writer = await connect()
+        await send_msg(writer, channel)
+        warm = asyncio.Event()
+        writers.append(writer)
+        readers.append((asyncio.create_task(
+            count_frames(reader, tally, warm)), warm))
+    _, writer = await connect()
+    await send_msg(writer, b'/null')
+    while not all(warm.is_set() for _, warm in readers):
+        await send_msg(writer, channel)
+        await send_msg(writer, b'w')
+        await asyncio.sleep(0.05)
+    tally.target = tally.count + messages * subscribers
+    data = b'x' * size
+    t0 = time.perf_counter()
+    for _ in range(messages):
+        await send_msg(writer, channel)
+        await send_msg(writer, data)
+    t1 = await asyncio.wait_for(tally.done, timeout=300)
+    for w in [writer, *writers]:
+        w.close()
+    await asyncio.gather(*[task for task, _ in readers])
+    server.close()
+    # Let the broker's client() coroutines see the connections go away.
+    await asyncio.sleep(0.1)
+    shutil.rmtree(directory)
+    return messages / (t1 - t0)
+
+
+# What does the transport itself cost? Here the broker runs inside the
+# benchmark (the client() coroutine of --server), and the same publisher
+# and subscribers reach it over TCP, over a Unix socket, and over an
+# in-process loopback connection (see mq_loopback). Everything shares one
+# event loop, so unlike the other benchmarks, this doesn't show what a
+# broker on a core of its own can do; the differences between the rows are
+# what the transports cost.
+async def bench_transport(args):
+    for server in args.server:
+        broker = importlib.import_module(os.path.splitext(server)[0])
+        print(f'{server}: {args.messages} messages of {args.size} bytes')
+        for n in args.subscribers:
+            for transport in args.transports:
+                # The broker's progress messages would only slow it down.
+                with open(os.devnull, 'w') as devnull, \
+                        contextlib.redirect_stdout(devnull):
+                    rate = await transport_once(broker, transport, n,
+                                                args.messages, args.size)
+                print(f'{transport:>9} {n:>5} subscribers '
+                      f'{rate:>12,.0f} msgs/s '
+                      f'{rate * n:>14,.0f} deliveries/s')
+
+
+# Every latency benchmark message starts with b'x' and carries two
+# timestamps: when it was supposed to be sent, and when it actually was.
+STAMPS = struct.Struct('>dd')
+
+
+# A subscriber that records the latency of every message it receives. The
+# latency measured from the scheduled send time is what a client would have
+# seen: if the broker pushes back and the senders fall behind their
+# schedule, the delay counts too. Measured from the actual send time, those
+# stalls would be hidden; this is the coordinated omission problem, and the
+# reason why both are recorded.
+class Recorder(Counter):
+    def __init__(self, tally: 'Tally'):
+        super().__init__(tally)
+        self.latencies: List[float] = []
+        self.uncorrected: List[float] = []
+
+    def frame_received(self, frame: memoryview):
+        if frame[:1] == b'x':
+            now = time.perf_counter()
+            scheduled, sent = STAMPS.unpack_from(frame, 1)
+            self.latencies.append(now - scheduled)
+            self.uncorrected.append(now - sent)
+        super().frame_received(frame)
+
+
+# An open-loop sender: message i is due at start + i / rate, however long
+# the previous ones took. A sender that has fallen behind sends whatever is
+# overdue back to back, with the timestamps of when it should have been
+# sent.
+async def open_loop(port: int, channel: bytes, rate: float, count: int,
+                    size: int, start: float):
+    _, writer = await asyncio.open_connection('127.0.0.1', port)
+    await send_msg(writer, b'/null')
+    padding = b'.' * max(0, size - 1 - STAMPS.size)
+    for i in range(count):
+        scheduled = start + i / rate
+        if (delay := scheduled - time.perf_counter()) > 0:
+            await asyncio.sleep(delay)
+        await send_msg(writer, channel)
+        await send_msg(writer, b'x' + STAMPS.pack(
+            scheduled, time.perf_counter()) + padding)
+    return writer
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    if not values:
+        return {}
+    result = {}
+    for name, q in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999)):
+        result[name] = values[min(len(values) - 1, int(q * len(values)))]
+    result['max'] = values[-1]
+    # In milliseconds, which is easier on the eyes.
+    return {k: round(v * 1000, 3) for k, v in result.items()}
+
+
+async def latency_once(server: str, port: int, kind: str, args) -> Dict:
+    # On a /queue channel each message goes to one listener, on a /topic
+    # channel to all of them.
+    channel = b'/queue/bench' if kind == 'queue' else b'/topic/bench'
+    tally = Tally()
+    conns = [await subscribe(port, channel, tally, Recorder)
+             for _ in range(args.listeners)]
+    _, writer = await asyncio.open_connection('127.0.0.1', port)
+    await send_msg(writer, b'/null')
+    await warm_up(writer, channel, [c for _, c in conns])
+    per_sender = int(args.rate * args.duration / args.senders)
+    messages = per_sender * args.senders
+    deliveries = messages if kind == 'queue' else messages * args.listeners
+    tally.target = tally.count + deliveries
+    first = tally.count
+    start = time.perf_counter() + 0.1
+    senders = await asyncio.gather(*[
+        open_loop(port, channel, args.rate / args.senders, per_sender,
+                  args.size, start) for _ in range(args.senders)])
+    try:
+        end = await asyncio.wait_for(asyncio.shield(tally.done),
+                                     timeout=args.timeout)
+    except asyncio.TimeoutError:
+        end = time.perf_counter()
+    for w in [writer, *senders]:
+        w.close()
+    for transport, _ in conns:
+        transport.close()
+    received = tally.count - first
+    return dict(
+        server=server, kind=kind, senders=args.senders,
+        listeners=args.listeners, target_rate=args.rate, size=args.size,
+        sent=messages, expected=deliveries, received=received,
+        deliveries_per_second=round(received / (end - start)),
+        latency_ms=percentiles(
+            [x for _, c in conns for x in c.latencies]),
+        uncorrected_latency_ms=percentiles(
+            [x for _, c in conns for x in c.uncorrected]))
+
+
+# End-to-end latency at a fixed offered load, for each broker and each kind
+# of channel. The results are printed as JSON, so that runs can be saved and
+# compared with each other.
+async def bench_latency(args):
+    results = []
+    for server in args.server:
+        port = free_port()
+        proc = await start_broker(server, port, *args.server_args)
+        try:
+            for kind in args.kind:
+                results.append(await latency_once(server, port, kind, args))
+        finally:
+            stop_broker(proc)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # One or more brokers (mq_server.py if none); each benchmark is run
+    # against each of them.
+    parser.add_argument('--server', default=[], action='append')
+    # Extra command-line arguments for the broker, e.g.
+    # --server-args=--framer=buffered
+    parser.add_argument('--server-args', default=[], action='append')
+    commands = parser.add_subparsers(dest='command', required=True)
+    fanout = commands.add_parser('fanout')
+    fanout.add_argument('--subscribers', default=[1, 10, 100, 1000],
+                        type=int, nargs='+')
+    fanout.add_argument('--messages', default=10000, type=int)
+    fanout.add_argument('--size', default=64, type=int)
+    fanout.add_argument('--payload', default='x', choices=['x', 'json'])
+    # For a preset dictionary, pass the same --zdict to the broker, e.g.
+    # --server-args=--zdict=FILE.
+    fanout.add_argument('--compress', action='store_true')
+    fanout.add_argument('--zdict', metavar='FILE')
+    fanout.set_defaults(func=bench_fanout)
+    latency = commands.add_parser('latency')
+    latency.add_argument('--senders', default=4, type=int)
+    latency.add_argument('--listeners', default=4, type=int)
+    # The total offered load, in messages per second, over all senders.
+    latency.add_argument('--rate', default=2000, type=float)
+    latency.add_argument('--duration', default=5, type=float)
+    latency.add_argument('--size', default=64, type=int)
+    latency.add_argument('--kind', default=['topic', 'queue'], nargs='+',
+                         choices=['topic', 'queue'])
+    # How long to wait for the last messages before counting them as lost.
+    latency.add_argument('--timeout', default=30, type=float)
+    latency.set_defaults(func=bench_latency)
+    transport = commands.add_parser('transport')
+    transport.add_argument('--transports', default=['tcp', 'unix', 'loopback'],
+                           nargs='+', choices=['tcp', 'unix', 'loopback'])
+    transport.add_argument('--subscribers', default=[1, 10], type=int,
+                           nargs='+')
+    transport.add_argument('--messages', default=20000, type=int)
+    transport.add_argument('--size', default=64, type=int)
+    transport.set_defaults(func=bench_transport)
+    churn = commands.add_parser('churn')
+    churn.add_argument('--subscribers', default=[0, 1000, 10000], type=int,
+                       nargs='+')
+    churn.add_argument('--clients', default=100000, type=int)
+    churn.add_argument('--concurrency', default=100, type=int)
+    churn.add_argument('--rate', default=1, type=float)
+    churn.add_argument('--size', default=64, type=int)
+    churn.set_defaults(func=bench_churn)
+    # Every call on a connection of its own leaves a port in TIME_WAIT, so
+    # keep --calls well below the number of ephemeral ports.
+    rpc = commands.add_parser('rpc')
+    rpc.add_argument('--modes', default=['multiplexed', 'connection'],
+                     nargs='+', choices=['multiplexed', 'connection'])
+    rpc.add_argument('--concurrency', default=[1, 10, 100], type=int,
+                     nargs='+')
+    rpc.add_argument('--calls', default=5000, type=int)
+    rpc.set_defaults(func=bench_rpc)
+    args = parser.parse_args()
+    args.server = args.server or ['mq_server.py']
+    try:
+        asyncio.run(args.func(args))
+    except KeyboardInterrupt:
+        print('Bye!')
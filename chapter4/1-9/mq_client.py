@@ -0,0 +1,328 @@
+# A broker client for applications, as opposed to the one-shot listener and
+# sender scripts.
+#
+#   async with BrokerClient('localhost', 25000) as client:
+#       await client.subscribe(b'/topic/orders/#')
+#       await client.publish(b'/topic/prices', b'...')
+#       async for data in client:
+#           ...
+#
+# publish() doesn't write to the socket. It puts the message in a local
+# buffer and returns; a writer task takes everything that has accumulated
+# and sends it with one write (as a batch frame if there is more than one
+# message), then waits for drain() once for the whole lot. A busy
+# application therefore pays for one drain() per batch rather than one per
+# message. The buffer is bounded by max_pending bytes: once it's full,
+# publish() waits for the writer task to make room, which is how the
+# broker's back-pressure reaches the application.
+#
+# If the connection is lost, the client connects again, with exponential
+# backoff, and repeats its subscriptions. Messages still in the buffer are
+# sent on the new connection. Messages that had already been written to the
+# old connection are not sent again: as with the scripts, delivery is at
+# most once. Messages with an id are the exception (see msgproto.IDEMPOTENT):
+# whatever the kernel had accepted may still have been lost, so the last
+# resend_bytes of them are sent again, and the broker drops the ones it had
+# already received. With message_ids=True, every message gets an id.
+#
+# Request and reply (see msgproto.REQUEST) over the same connection:
+#
+#   async with BrokerClient() as service:
+#       await service.subscribe(b'/queue/prices')
+#       async for request in service:
+#           symbol = bytes(parse_request(request)[2])
+#           await service.reply(request, price_of(symbol))
+#
+#   async with BrokerClient() as client:
+#       price = await client.request(b'/queue/prices', b'ACME', timeout=1)
+#
+# The first request() subscribes the client to a channel of its own,
+# /reply/ and its name, and every request asks for its reply there, under a
+# correlation id. Replies are matched to their requests by that id, so any
+# number of requests can be waiting on the one connection, and a reply that
+# comes in after its request has timed out is dropped. Like any other
+# message, a request or a reply can be lost when a connection breaks; the
+# timeout covers that as well. A service on a /queue channel, as above, can
+# run as any number of instances, and each request goes to one of them.
+import asyncio
+import random
+import uuid
+from collections import deque
+from itertools import count
+from typing import Deque, Dict, List, Optional, Tuple
+from msgproto import (
+    read_msg, encode_msg, encode_batch, encode_compress, encode_envelope,
+    encode_idempotent, encode_request, parse_request, encode_reply,
+    parse_reply, open_frame_connection, open_frame_unix_connection, Codec,
+    Frame, SUBSCRIBE, UNSUBSCRIBE, REPLY)
+
+# (channel, data, frame, msg_id) for a message to send, where frame is the
+# encoded frame for a message with a lane, a TTL or an id.
+Pending = Tuple[bytes, Frame, Optional[List[Frame]], Optional[bytes]]
+
+
+class BrokerClient:
+    def __init__(self, host: str = 'localhost', port: int = 25000, *,
+                 unix: Optional[str] = None, framer: str = 'stream',
+                 max_pending: int = 1024 * 1024,
+                 batch_bytes: int = 64 * 1024,
+                 max_received: int = 1000,
+                 codec: Optional[Codec] = None,
+                 min_delay: float = 0.1, max_delay: float = 5.0,
+                 message_ids: bool = False,
+                 resend_bytes: int = 256 * 1024):
+        self.host, self.port, self.unix, self.framer = host, port, unix, framer
+        self.max_pending = max_pending
+        self.batch_bytes = batch_bytes
+        # With a codec, the broker is asked to compress what it sends us
+        # (see msgproto.COMPRESS).
+        self.codec = codec
+        self.min_delay, self.max_delay = min_delay, max_delay
+        self.message_ids = message_ids
+        self.resend_bytes = resend_bytes
+        # The name of this client, for message ids and correlation ids that
+        # no other client uses, and for its reply channel.
+        self.name = uuid.uuid4().hex[:8].encode()
+        self.reply_to = b'/reply/' + self.name
+        self._ids = (b'%s:%d' % (self.name, n) for n in count())
+        # The requests waiting for a reply, by correlation id.
+        self._calls: Dict[bytes, asyncio.Future] = {}
+        # Channels and patterns, in the order they were subscribed to. The
+        # broker expects every connection to start with a subscription, so
+        # a client without any subscribes to /null.
+        self.subscriptions: Dict[bytes, None] = {}
+        self._pending: Deque[Pending] = deque()
+        self._pending_bytes = 0
+        # The messages with ids most recently written to the connection, up
+        # to resend_bytes of them, for sending again if it breaks.
+        self._written: Deque[Pending] = deque()
+        self._written_bytes = 0
+        self._wakeup = asyncio.Event()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._received: asyncio.Queue = asyncio.Queue(max_received)
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connected = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.reconnects = 0
+
+    async def __aenter__(self) -> 'BrokerClient':
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def wait_connected(self):
+        await self._connected.wait()
+
+    async def publish(self, channel: bytes, data: Frame, lane: int = 0,
+                      ttl: float = 0, msg_id: Optional[bytes] = None):
+        if msg_id is None and self.message_ids:
+            msg_id = next(self._ids)
+        if msg_id is not None and (lane or ttl):
+            raise ValueError('a message with an id has no lane or TTL')
+        while self._pending_bytes >= self.max_pending:
+            self._room.clear()
+            await self._room.wait()
+        frame = None
+        if msg_id is not None:
+            frame = encode_idempotent(channel, data, msg_id)
+        elif lane or ttl:
+            frame = encode_envelope(channel, data, lane, ttl)
+        self._pending.append((channel, data, frame, msg_id))
+        self._pending_bytes += len(channel) + len(data)
+        self._wakeup.set()
+
+    async def request(self, channel: bytes, data: Frame,
+                      timeout: Optional[float] = 5.0) -> bytes:
+        if self._closing:
+            raise ConnectionError('the client is closed')
+        await self.subscribe(self.reply_to)
+        correlation_id = next(self._ids)
+        future = self._calls[correlation_id] = (
+            asyncio.get_running_loop().create_future())
+        try:
+            await self.publish(
+                channel, encode_request(correlation_id, self.reply_to, data))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            # close() may have cleared it already.
+            self._calls.pop(correlation_id, None)
+
+    async def reply(self, request: Frame, data: Frame):
+        correlation_id, reply_to, _ = parse_request(request)
+        await self.publish(bytes(reply_to),
+                           encode_reply(bytes(correlation_id), data))
+
+    async def flush(self):
+        # Wait until everything published so far has been written out.
+        while self._pending:
+            self._room.clear()
+            await self._room.wait()
+
+    async def subscribe(self, channel: bytes):
+        if channel not in self.subscriptions:
+            self.subscriptions[channel] = None
+            self._control(SUBSCRIBE + channel)
+
+    async def unsubscribe(self, channel: bytes):
+        if channel in self.subscriptions:
+            del self.subscriptions[channel]
+            self._control(UNSUBSCRIBE + channel)
+
+    def _control(self, frame: bytes):
+        # While disconnected, there is nothing to do: the subscriptions are
+        # sent when the connection is made.
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.writelines(encode_msg(frame))
+
+    async def receive(self) -> bytes:
+        return await self._received.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        return await self.receive()
+
+    async def close(self, flush: bool = True,
+                    flush_timeout: Optional[float] = 5.0):
+        # Without a connection, flush() would wait for one indefinitely, so
+        # what is still buffered after flush_timeout seconds is given up on.
+        if flush and self._task and not self._task.done():
+            try:
+                await asyncio.wait_for(self.flush(), flush_timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._closing = True
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        # No reply can arrive any more, so requests still waiting for one
+        # fail now rather than when they time out (or never, without a
+        # timeout).
+        for future in self._calls.values():
+            if not future.done():
+                future.set_exception(ConnectionError('the client was closed'))
+        self._calls.clear()
+
+    async def _open(self):
+        if self.unix and self.framer == 'buffered':
+            return await open_frame_unix_connection(self.unix)
+        if self.unix:
+            return await asyncio.open_unix_connection(self.unix)
+        if self.framer == 'buffered':
+            return await open_frame_connection(self.host, self.port)
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def _run(self):
+        delay = self.min_delay
+        while not self._closing:
+            try:
+                reader, writer = await self._open()
+            except OSError:
+                # Exponential backoff, with jitter, so that many clients
+                # don't all come back at the same moment after an outage.
+                await asyncio.sleep(delay * random.uniform(0.5, 1))
+                delay = min(delay * 2, self.max_delay)
+                continue
+            delay = self.min_delay
+            try:
+                await self._serve(reader, writer)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                self._connected.clear()
+                self._writer = None
+                writer.close()
+            if not self._closing:
+                self.reconnects += 1
+                self._resend()
+
+    def _resend(self):
+        # The messages with ids go back to the front of the line, in the
+        # order they were first sent.
+        self._pending.extendleft(reversed(self._written))
+        self._pending_bytes += self._written_bytes
+        self._written.clear()
+        self._written_bytes = 0
+        self._wakeup.set()
+
+    async def _serve(self, reader, writer: asyncio.StreamWriter):
+        if self.codec:
+            writer.writelines(encode_compress(self.codec.dict_id))
+        first, *more = list(self.subscriptions) or [b'/null']
+        writer.writelines(encode_msg(first))
+        for channel in more:
+            writer.writelines(encode_msg(SUBSCRIBE + channel))
+        self._writer = writer
+        self._connected.set()
+        sending = asyncio.create_task(self._send(writer))
+        try:
+            while True:
+                data = await read_msg(reader)
+                if self.codec:
+                    data = self.codec.decompress(data)
+                if data[:2] == REPLY and self._replied(data):
+                    continue
+                await self._received.put(bytes(data))
+        finally:
+            sending.cancel()
+
+    def _replied(self, data: Frame) -> bool:
+        # Whether data is the reply to one of our requests, whether or not
+        # that is still waiting for it.
+        correlation_id, reply = parse_reply(data)
+        if bytes(correlation_id[:len(self.name) + 1]) != self.name + b':':
+            return False
+        future = self._calls.get(bytes(correlation_id))
+        if future is not None and not future.done():
+            future.set_result(bytes(reply))
+        return True
+
+    async def _send(self, writer: asyncio.StreamWriter):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            buffers, pairs, size = [], [], 0
+            while self._pending and size < self.batch_bytes:
+                entry = self._pending.popleft()
+                channel, data, frame, msg_id = entry
+                size += len(channel) + len(data)
+                if frame is None:
+                    pairs.append((channel, data))
+                    continue
+                # Envelopes and messages with ids can't go in a batch frame,
+                # so the batch so far goes before it, to keep the messages in
+                # order.
+                buffers += self._encode(pairs) + frame
+                pairs = []
+                if msg_id is not None:
+                    self._written.append(entry)
+                    self._written_bytes += len(channel) + len(data)
+            writer.writelines(buffers + self._encode(pairs))
+            while self._written_bytes > self.resend_bytes:
+                channel, data, _, _ = self._written.popleft()
+                self._written_bytes -= len(channel) + len(data)
+            self._pending_bytes -= size
+            self._room.set()
+            try:
+                await writer.drain()
+            except ConnectionError:
+                # The reader sees the same thing and ends the connection.
+                return
+
+    @staticmethod
+    def _encode(pairs: List[Tuple[bytes, Frame]]) -> List[Frame]:
+        if len(pairs) == 1:
+            return [*encode_msg(pairs[0][0]), *encode_msg(pairs[0][1])]
+        return encode_batch(pairs) if pairs else []
@@ -3,7 +3,10 @@
 import asyncio
 import argparse
 import uuid
-from msgproto import read_msg, send_msg
+from msgproto import (
+    read_msg, send_msg, open_frame_connection, open_frame_unix_connection,
+    encode_replay, encode_prefetch, encode_ack, encode_compress, Codec,
+    SUBSCRIBE)
 
 
 async def main(args):
@@ -13,22 +16,65 @@ async def main(args):
     # happening in the logs.
     me = uuid.uuid4().hex[:8]
     print(f'Starting up {me}')
-    # Open a connection to the server.
-    reader, writer = await asyncio.open_connection(
-        args.host, args.port)
+    # Open a connection to the server. The buffered framer speaks the same
+    # wire format, so either kind of client works with either kind of server.
+    # On the broker's machine, --unix connects through its Unix socket.
+    if args.unix and args.framer == 'buffered':
+        reader, writer = await open_frame_unix_connection(args.unix)
+    elif args.unix:
+        reader, writer = await asyncio.open_unix_connection(args.unix)
+    elif args.framer == 'buffered':
+        reader, writer = await open_frame_connection(args.host, args.port)
+    else:
+        reader, writer = await asyncio.open_connection(
+            args.host, args.port)
     print(f'I am {writer.get_extra_info("sockname")}')
-    # The channel to subscribe to is an input parameter, captured in
-    # args.listen. Encode it into bytes before sending.
-    channel = args.listen.encode()
+    # The channels to subscribe to are an input parameter, captured in
+    # args.listen. Encode them into bytes before sending.
+    channel, *more = [c.encode() for c in args.listen]
+    # With --compress, the broker compresses what it sends us (see
+    # msgproto.COMPRESS). That has to be settled before subscribing, and with
+    # --zdict, both sides use the same preset dictionary.
+    codec = None
+    if args.compress:
+        zdict = b''
+        if args.zdict:
+            with open(args.zdict, 'rb') as f:
+                zdict = f.read()
+        codec = Codec(zdict)
+        writer.writelines(encode_compress(codec.dict_id))
     # By our protocol rules (as discussed in the broker code analysis
     # previously), the first thing to do after connecting is to send the
     # channel name to subscribe to.
     await send_msg(writer, channel)
+    # As a /queue worker with a window (see msgproto.PREFETCH), this
+    # listener acknowledges every message once it's done with it. (That's
+    # why --prefetch goes with a single channel and no --replay: messages
+    # don't say which channel they came from, and an acknowledgement for
+    # anything else would free the window of a message still being worked
+    # on.)
+    if args.prefetch:
+        writer.writelines(encode_prefetch(args.prefetch, channel))
+    # Any further channels, or patterns like /topic/orders/*, are added to
+    # the same connection with SUBSCRIBE frames.
+    for channel in more:
+        await send_msg(writer, SUBSCRIBE + channel)
+    # For durable /queue channels, ask for the messages still on disk from
+    # the given offset onward, e.g. to pick up where a crashed consumer left
+    # off.
+    if args.replay is not None:
+        writer.writelines(encode_replay(args.replay, args.listen[0].encode()))
     try:
         # This loop does nothing else but wait for data to appear on the
         # socket.
         while data := await read_msg(reader):
-            print(f'Received by {me}: {data[:20]}')
+            if codec:
+                data = codec.decompress(data)
+            print(f'Received by {me}: {bytes(data[:20])}')
+            if args.prefetch:
+                # Pretend to work on it for a while.
+                await asyncio.sleep(args.work)
+                writer.writelines(encode_ack())
         print('Connection ended.')
     except asyncio.IncompleteReadError:
         print('Server closed.')
@@ -38,12 +84,24 @@ async def main(args):
 
 if __name__ == '__main__':
     # The command-line arguments for this program make it easy to point to a
-    # host, a port, and a channel name to listen to.
+    # host, a port, and the channel names or patterns to listen to.
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', default='localhost')
     parser.add_argument('--port', default=25000)
-    parser.add_argument('--listen', default='/topic/foo')
+    parser.add_argument('--unix', metavar='PATH')
+    parser.add_argument('--listen', default=['/topic/foo'], nargs='+')
+    parser.add_argument('--replay', type=int, metavar='OFFSET')
+    parser.add_argument('--prefetch', type=int, metavar='WINDOW')
+    parser.add_argument('--work', default=0, type=float, metavar='SECONDS')
+    parser.add_argument('--framer', default='stream',
+                        choices=['stream', 'buffered'])
+    parser.add_argument('--compress', action='store_true')
+    parser.add_argument('--zdict', metavar='FILE')
+    args = parser.parse_args()
+    if args.prefetch and (len(args.listen) > 1 or args.replay is not None):
+        parser.error('--prefetch only works with a single --listen channel '
+                     'and without --replay')
     try:
-        asyncio.run(main(parser.parse_args()))
+        asyncio.run(main(args))
     except KeyboardInterrupt:
         print('Bye!')
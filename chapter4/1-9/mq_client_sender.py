@@ -1,18 +1,28 @@
 # Example 4-4. Sender: a toolkit for sending data to our message broker
 import asyncio
 import argparse
+import time
 import uuid
 from itertools import count
-from msgproto import send_msg
+from msgproto import (
+    send_msg, send_chunked, open_frame_connection, open_frame_unix_connection,
+    encode_register, encode_publish, encode_envelope, encode_delay,
+    encode_idempotent, BatchSender)
 
 
-async def main(args):
-    # As with the listener, claim an identity.
-    me = uuid.uuid4().hex[:8]
-    print(f'Starting up {me}')
-    # Reach out and make a connection.
-    reader, writer = await asyncio.open_connection(
-        host=args.host, port=args.port)
+async def connect(args):
+    # Reach out and make a connection: over TCP, or on the broker's machine,
+    # through its Unix socket.
+    if args.unix and args.framer == 'buffered':
+        reader, writer = await open_frame_unix_connection(args.unix)
+    elif args.unix:
+        reader, writer = await asyncio.open_unix_connection(args.unix)
+    elif args.framer == 'buffered':
+        reader, writer = await open_frame_connection(
+            host=args.host, port=args.port)
+    else:
+        reader, writer = await asyncio.open_connection(
+            host=args.host, port=args.port)
     print(f'I am {writer.get_extra_info("sockname")}')
     # According to our protocol rules, the first thing to do after connecting
     # to the server is to give the name of the channel to subscribe to;
@@ -22,10 +32,29 @@ async def main(args):
     channel = b'/null'
     # Send the channel to subscribe to.
     await send_msg(writer, channel)
+    return reader, writer
+
+
+async def main(args):
+    # As with the listener, claim an identity.
+    me = uuid.uuid4().hex[:8]
+    print(f'Starting up {me}')
+    reader, writer = await connect(args)
     # The command-line parameter args.channel provides the channel to which we
     # want to send messages. It must be converted to bytes first before
     # sending.
     chan = args.channel.encode()
+    # With a batch window, messages are collected and sent as one batch frame
+    # per window instead of two frames each (see msgproto.BatchSender).
+    batcher = None
+    if args.batch_delay:
+        batcher = BatchSender(writer, max_delay=args.batch_delay,
+                              max_bytes=args.batch_bytes)
+    # With --alias, the channel name is registered once under alias 0, and
+    # every message after that is a single PUBLISH frame (see
+    # msgproto.REGISTER).
+    if args.alias:
+        writer.writelines(encode_register(0, chan))
     try:
         # Using itertools.count() is like a while True loop, except that we
         # get an iteration variable to use. We use this in the debugging
@@ -38,7 +67,50 @@ async def main(args):
             # descriptive message. This flexibility is just for testing.
             await asyncio.sleep(args.interval)
             data = b'X' * args.size or f'Msg {i} from {me}'.encode()
+            # With --message-ids, every message carries an id, made of our
+            # identity and its number (see msgproto.IDEMPOTENT). If the
+            # connection breaks, we connect again and send the message once
+            # more under the same id: should it have reached the broker
+            # after all, the broker drops the second copy.
+            if args.message_ids:
+                frame = encode_idempotent(chan, data, f'{me}:{i}'.encode())
+                while True:
+                    try:
+                        writer.writelines(frame)
+                        await writer.drain()
+                        break
+                    except OSError:
+                        print('Connection lost, sending again.')
+                        writer.close()
+                        writer = await reconnect(args)
+                continue
             try:
+                # Messages larger than --chunk-size go out in pieces (see
+                # msgproto.CHUNK), however the rest are sent.
+                if args.chunk_size and len(data) > args.chunk_size:
+                    await send_chunked(writer, chan, data, args.chunk_size)
+                    continue
+                # With --lane or --ttl, every message goes in an envelope
+                # (see msgproto.ENVELOPE).
+                if args.lane or args.ttl:
+                    writer.writelines(
+                        encode_envelope(chan, data, args.lane, args.ttl))
+                    await writer.drain()
+                    continue
+                # With --delay, the broker holds on to every message for
+                # that many seconds before publishing it (see msgproto.DELAY).
+                if args.delay:
+                    writer.writelines(
+                        encode_delay(chan, data, time.time() + args.delay))
+                    await writer.drain()
+                    continue
+                if batcher:
+                    await batcher.send(chan, data)
+                    continue
+                if args.alias:
+                    writer.writelines(encode_publish(0, data))
+                    await writer.drain()
+                    continue
                 await send_msg(writer, chan)
                 # Note that two messages are sent here: the first is the
                 # destination channel name, and the second is the payload.
@@ -51,17 +123,39 @@ async def main(args):
         await writer.wait_closed()
 
 
+async def reconnect(args):
+    while True:
+        try:
+            _, writer = await connect(args)
+            return writer
+        except OSError:
+            await asyncio.sleep(args.interval or 0.1)
+
+
 if __name__ == '__main__':
     # As with the listener, there are a bunch of command-line options for
     # tweaking the sender: channel determines the target channel to send to,
     # while interval controls the delay between sends. The size parameter
-    # controls the size of each message payload.
+    # controls the size of each message payload. Setting batch-delay (in
+    # seconds) turns on batching: messages are then sent together once
+    # batch-bytes have accumulated or batch-delay has passed.
     parser = argparse.ArgumentParser()
     parser.add_argument('--host', default='localhost')
     parser.add_argument('--port', default=25000, type=int)
+    parser.add_argument('--unix', metavar='PATH')
     parser.add_argument('--channel', default='/topic/foo')
     parser.add_argument('--interval', default=1, type=float)
     parser.add_argument('--size', default=0, type=int)
+    parser.add_argument('--framer', default='stream',
+                        choices=['stream', 'buffered'])
+    parser.add_argument('--batch-delay', default=0, type=float)
+    parser.add_argument('--batch-bytes', default=64 * 1024, type=int)
+    parser.add_argument('--alias', action='store_true')
+    parser.add_argument('--chunk-size', default=0, type=int)
+    parser.add_argument('--lane', default=0, type=int)
+    parser.add_argument('--ttl', default=0, type=float, metavar='SECONDS')
+    parser.add_argument('--delay', default=0, type=float, metavar='SECONDS')
+    parser.add_argument('--message-ids', action='store_true')
     try:
         asyncio.run(main(parser.parse_args()))
     except KeyboardInterrupt:
@@ -0,0 +1,147 @@
+# Running a broker as several worker processes on one machine, so that it
+# isn't limited to the one core that its event loop runs on.
+#
+# Every worker listens on the same TCP port with SO_REUSEPORT, and the kernel
+# spreads incoming connections across them. Each channel is owned by exactly
+# one worker, picked by a hash of its name (owner() below). The owner is the
+# only worker that decides who gets a channel's messages, so that fan-out and
+# /queue round-robin behave just as with a single process:
+#   • A worker that receives a message for a channel it doesn't own forwards
+#     it to the owner (PEER_PUBLISH).
+#   • When a client subscribes to a channel on a worker that doesn't own it,
+#     that worker tells the owner (PEER_SUBSCRIBE). The owner keeps a
+#     Remote(worker, sub) entry among the channel's local subscribers.
+#     Patterns can match channels of any owner, so pattern subscriptions are
+#     announced to every worker.
+#   • To deliver a message, the owner writes it to its own subscribers and
+#     sends one PEER_DELIVER per other worker with subscribers, and that
+#     worker hands it to its own. For /queue channels, where the message goes
+#     to a single subscriber, it sends PEER_DELIVER_TO for just that one.
+# The workers are connected pairwise over Unix sockets. Every message between
+# them is a (head, data) pair, where the first byte of the head says what it
+# is, and the pairs are sent as batch frames (see msgproto.BatchSender), so
+# that a busy link costs one write per batch rather than one per message.
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import zlib
+from asyncio import StreamReader, StreamWriter
+from contextlib import suppress
+from typing import Callable, Dict, List, NamedTuple, Optional
+from msgproto import BatchSender, Frame, iter_batch, read_msg, send_msg
+
+PEER_PUBLISH = b'P'         # P + channel name, data
+PEER_DELIVER = b'D'         # D + channel name, data
+PEER_DELIVER_TO = b'T'      # T + 4-byte sub + channel name, data
+PEER_SUBSCRIBE = b'S'       # S + 4-byte sub + channel name or pattern
+PEER_UNSUBSCRIBE = b'U'     # U + 4-byte sub + channel name or pattern
+
+
+def owner(channel_name: bytes, workers: int) -> int:
+    # Not hash(): that is salted differently in every process.
+    return zlib.crc32(channel_name) % workers
+
+
+def encode_sub(kind: bytes, sub: int, channel_name: bytes = b'') -> bytes:
+    return kind + sub.to_bytes(4, byteorder='big') + channel_name
+
+
+# A subscriber connected to another worker: sub identifies the connection
+# within that worker.
+class Remote(NamedTuple):
+    worker: int
+    sub: int
+
+
+# The sending end of the link to one other worker.
+class Peer:
+    def __init__(self, writer: StreamWriter):
+        self.writer = writer
+        # No delay: whatever is forwarded in one pass of the event loop goes
+        # out as one batch at the end of it.
+        self.batch = BatchSender(writer, max_delay=0)
+
+    def send(self, head: bytes, data: Frame = b'') -> Optional[StreamWriter]:
+        # Like msgproto.broadcast(), this doesn't wait; it returns the writer
+        # if the caller should drain() it.
+        if self.batch.add(head, data):
+            return self.writer
+        return None
+
+
+def socket_path(directory: str, worker: int) -> str:
+    return os.path.join(directory, f'worker-{worker}.sock')
+
+
+# Connect this worker with all the others. Messages from other workers are
+# passed to handler(worker, head, data), which returns the writers that need
+# draining, like msgproto.broadcast() does; waiting for them here slows the
+# sending worker down in turn, so back-pressure crosses the link. A local
+# subscriber that has gone away only ends its own drain(), not the link.
+async def link_peers(directory: str, index: int, workers: int,
+                     handler: Callable[[int, memoryview, memoryview],
+                                       List[StreamWriter]]
+                     ) -> Dict[int, Peer]:
+    async def drain_one(writer: StreamWriter):
+        with suppress(ConnectionError):
+            await writer.drain()
+
+    async def peer_client(reader: StreamReader, writer: StreamWriter):
+        # The first frame on a link says which worker is at the other end.
+        worker = int(await read_msg(reader))
+        with_drain = set()
+        try:
+            while frame := await read_msg(reader):
+                for head, data in iter_batch(frame):
+                    with_drain.update(handler(worker, head, data))
+                if with_drain:
+                    await asyncio.gather(*[drain_one(w) for w in with_drain])
+                    with_drain.clear()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    await asyncio.start_unix_server(peer_client, socket_path(directory, index))
+    peers = {}
+    for worker in range(workers):
+        if worker == index:
+            continue
+        # The other workers are starting up at the same time as this one, so
+        # their sockets may not be there yet.
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(
+                    socket_path(directory, worker))
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.05)
+        await send_msg(writer, str(index).encode())
+        peers[worker] = Peer(writer)
+    return peers
+
+
+# Start the worker processes and wait for them. Each one runs
+# target(index, workers, directory, *args), where directory holds the Unix
+# sockets for the links between workers.
+def run_workers(workers: int, target: Callable, *args):
+    directory = tempfile.mkdtemp(prefix='mq-cluster-')
+    processes = [multiprocessing.Process(
+        target=target, args=(index, workers, directory, *args))
+        for index in range(workers)]
+    try:
+        for process in processes:
+            process.start()
+        # Being terminated should take the workers down too. (The workers
+        # keep the default handler, since they are started before this.)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit())
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        shutil.rmtree(directory)
@@ -0,0 +1,60 @@
+# Credit-based dispatch for /queue channels, shared by both brokers (see
+# msgproto.PREFETCH and msgproto.ACK).
+#
+# Plain round-robin hands a slow worker as many messages as a fast one, and
+# the slow worker's backlog, and with it the latency of everything queued
+# behind it, just keeps growing. Instead, a consumer that acknowledges its
+# messages has a window: it's never sent more than window messages that it
+# hasn't acknowledged yet. Each message goes to the consumer with the most
+# free room in its window, so work flows to whoever is keeping up. When no
+# consumer has room, the broker holds on to the message until one acks.
+#
+# Consumers that don't acknowledge anything (every client that predates
+# PREFETCH) have no window to go by. They are always able to take a message,
+# but only get one when no acknowledging consumer has room, so among
+# themselves they still take turns, exactly as before.
+from collections import deque
+from typing import Deque, Dict, Hashable, Iterable, Optional, Tuple
+from msgproto import Frame
+
+
+class Consumer:
+    __slots__ = ('window', 'unacked')
+
+    def __init__(self, window: int):
+        self.window = window
+        # (channel, data) for every message sent and not yet acknowledged,
+        # oldest first. Acknowledgements are counts, so they apply in the
+        # order the messages were sent.
+        self.unacked: Deque[Tuple[Hashable, Frame]] = deque()
+
+    @property
+    def free(self) -> int:
+        return self.window - len(self.unacked)
+
+    def sent(self, channel: Hashable, data: Frame):
+        self.unacked.append((channel, data))
+
+    def ack(self, count: int):
+        for _ in range(min(count, len(self.unacked))):
+            self.unacked.popleft()
+
+
+def can_take(conn: Hashable, consumers: Dict[Hashable, Consumer]) -> bool:
+    return (consumer := consumers.get(conn)) is None or consumer.free > 0
+
+
+# The subscriber with the most free room, or None if there is none. Ties go
+# to whichever comes first in conns, so the caller keeps rotating conns, as
+# before, to share the work out evenly.
+def choose(conns: Iterable[Hashable],
+           consumers: Dict[Hashable, Consumer]) -> Optional[Hashable]:
+    best, most = None, -1
+    for conn in conns:
+        if (consumer := consumers.get(conn)) is None:
+            free = 0
+        elif (free := consumer.free) <= 0:
+            continue
+        if free > most:
+            best, most = conn, free
+    return best
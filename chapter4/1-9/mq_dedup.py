@@ -0,0 +1,92 @@
+# Duplicate suppression for idempotent publishing, shared by both brokers
+# (see msgproto.IDEMPOTENT).
+#
+# A producer whose connection breaks can't tell which of its last messages
+# made it to the broker, so it sends them again, and without an id to go by,
+# every subscriber gets those twice. With an id, the broker only has to
+# remember which ids it has seen on each channel lately. Remembering them
+# all would take ever more memory, though, so each channel has a window:
+# two generations of ids, the current one and the one before. Ids go into
+# the current generation until it holds size ids, or until it's seconds
+# old; then the previous generation is thrown away and the current one
+# takes its place. An id is therefore recognised for at least the next size
+# ids on its channel (or seconds, if that is shorter), and no channel ever
+# holds more than twice size of them, however fast it's published to.
+#
+# The generations are sets of the ids' 64-bit hashes rather than of the ids
+# themselves, which keeps an entry to an int whatever the length of the id.
+# Two different ids with the same hash would make the second look like a
+# duplicate, but with 64 bits and a window of thousands, the odds are
+# negligible. How many channels have a window is limited as well: when
+# there are too many, the one published to least recently loses its window,
+# as with retained messages (see mq_retain).
+import time
+from collections import OrderedDict
+from typing import Hashable, Set
+
+
+class Window:
+    __slots__ = ('current', 'previous', 'started')
+
+    def __init__(self):
+        self.current: Set[int] = set()
+        self.previous: Set[int] = set()
+        self.started = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.current) + len(self.previous)
+
+
+class Dedup:
+    def __init__(self, size: int = 10000, seconds: float = 0,
+                 channels: int = 100):
+        self.configure(size, seconds, channels)
+
+    def configure(self, size: int, seconds: float, channels: int):
+        # A size of zero turns suppression off; with seconds of zero, only
+        # the number of ids counts.
+        self.size = size
+        self.seconds = seconds
+        self.channels = channels
+        # The windows by channel, least recently published first.
+        self.windows: 'OrderedDict[Hashable, Window]' = OrderedDict()
+
+    def __bool__(self) -> bool:
+        return self.size > 0
+
+    # Whether msg_id has been seen on channel lately. If not, it is now.
+    def seen(self, channel: Hashable, msg_id: bytes) -> bool:
+        if not self.size:
+            return False
+        if (window := self.windows.get(channel)) is None:
+            if len(self.windows) >= self.channels:
+                self.windows.popitem(last=False)
+            window = self.windows[channel] = Window()
+        else:
+            self.windows.move_to_end(channel)
+        key = hash(msg_id)
+        if key in window.current or key in window.previous:
+            return True
+        if len(window.current) >= self.size or (
+                self.seconds
+                and time.monotonic() - window.started >= self.seconds):
+            window.previous, window.current = window.current, set()
+            window.started = time.monotonic()
+        window.current.add(key)
+        return False
+
+
+# The command-line options of both brokers: each channel remembers the ids
+# of at least its last --dedup-ids messages (or of those of the last
+# --dedup-seconds, if that is fewer), for up to --dedup-channels channels.
+# A full window takes about 85 bytes per id, so with the defaults, all of
+# them together take at most some 170 MiB.
+def add_arguments(parser):
+    parser.add_argument('--dedup-ids', default=10000, type=int)
+    parser.add_argument('--dedup-seconds', default=0, type=float)
+    parser.add_argument('--dedup-channels', default=100, type=int)
+
+
+def options(args) -> dict:
+    return dict(size=args.dedup_ids, seconds=args.dedup_seconds,
+                channels=args.dedup_channels)
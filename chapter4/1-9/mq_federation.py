@@ -0,0 +1,173 @@
+# Federation: brokers on different machines that pass each other the
+# messages of selected channels (see mq_server_plus --federate).
+#
+# A broker started with --federate HOST:PORT=PATTERNS connects to the broker
+# at HOST:PORT, and the two of them exchange every message whose channel
+# matches one of the patterns, in both directions: a subscriber on either
+# node gets what is published on the other. Only the broker that connects
+# needs to be told; the other one learns the patterns from its FEDERATE
+# frame (see msgproto). A broker can have any number of links, and the
+# connecting side reconnects, with backoff, whenever its link is lost.
+#
+# On each side, the link is a Link object that is subscribed to the
+# patterns, like a connection would be, and is offered the same messages.
+# Rather than the data alone, it sends (head, data) pairs, where the head
+# holds the channel name, the message's lane and remaining TTL (see
+# mq_lanes), and its path: the nodes it has already been through. A node
+# never passes a message on to a node on its path, and drops a message that
+# has its own name on it, so messages can't go round in circles. The path
+# also limits how many links a message may cross (max_hops). With the
+# default of one, a message only reaches the nodes that are linked to the
+# one it was published on, which is right for a full mesh, where going
+# further would only deliver it twice. For a chain of nodes, max_hops has
+# to be as long as the chain.
+#
+# As in mq_cluster, the pairs go out as batch frames (see
+# msgproto.BatchSender), and a link that can't keep up pushes back: the
+# sender flushes the batch and waits on its drain() after every message it
+# forwards, so that drain() sees that message, and the receiver doesn't
+# read the next frame until the previous one has been published.
+#
+# Work queues stay on the node where they are published: /queue channels
+# are never forwarded.
+import asyncio
+import random
+import time
+from asyncio import StreamReader, StreamWriter
+from typing import Awaitable, Callable, List, Optional, Tuple, Union
+from msgproto import (
+    BatchSender, Frame, iter_batch, read_msg, encode_federate, parse_federate,
+    FEDERATE)
+from mq_lanes import Message
+
+LINK_MESSAGE = b'M'     # M + lane + 4-byte TTL + path + channel name, data
+
+
+def encode_head(channel_name: bytes, lane: int, ttl: float,
+                path: Tuple[bytes, ...]) -> bytes:
+    return (LINK_MESSAGE + lane.to_bytes(1, byteorder='big')
+            + round(ttl * 1000).to_bytes(4, byteorder='big')
+            + len(path).to_bytes(1, byteorder='big')
+            + b''.join(len(node).to_bytes(1, byteorder='big') + node
+                       for node in path)
+            + channel_name)
+
+
+def parse_head(head: memoryview) -> Tuple[bytes, int, float,
+                                          Tuple[bytes, ...]]:
+    # The channel name, the lane, the TTL in seconds and the path.
+    lane, ttl = head[1], int.from_bytes(head[2:6], byteorder='big') / 1000
+    pos, path = 7, []
+    for _ in range(head[6]):
+        path.append(bytes(head[pos + 1:pos + 1 + head[pos]]))
+        pos += 1 + head[pos]
+    return bytes(head[pos:]), lane, ttl, tuple(path)
+
+
+# The sending end of a link to another node.
+class Link:
+    def __init__(self, node: bytes, peer: bytes, writer: StreamWriter,
+                 patterns: List[bytes], max_hops: int = 1):
+        self.node = node
+        self.peer = peer
+        self.writer = writer
+        self.patterns = patterns
+        self.max_hops = max_hops
+        self.batch = BatchSender(writer, max_delay=0)
+        self.forwarded = 0
+
+    def __repr__(self) -> str:
+        return f'Link({self.peer.decode(errors="replace")})'
+
+    def forward(self, channel_name: bytes, msg: Union[Frame, Message]):
+        lane, ttl, path = 0, 0.0, ()
+        if isinstance(msg, Message):
+            path = msg.path
+            if self.peer in path or len(path) >= self.max_hops:
+                return
+            lane = msg.lane
+            if msg.deadline is not None:
+                # What is left of the TTL, since the clocks of two machines
+                # can't be compared. (At least a millisecond, since zero
+                # would mean no TTL at all.)
+                ttl = max(msg.deadline - time.monotonic(), 0.001)
+            msg = msg.data
+        head = encode_head(channel_name, lane, ttl, (*path, self.node))
+        self.batch.add(head, msg)
+        self.forwarded += 1
+
+
+# Run one link, from either end, until it's lost. attach() and detach()
+# subscribe the link to its patterns and take it away again (attach() may
+# also turn it down, e.g. if there already is a link to the same node), and
+# what the other node sends is handed to publish(channel_name, message).
+async def run_link(reader: StreamReader, link: Link,
+                   attach: Callable[[Link], bool],
+                   detach: Callable[[Link], None],
+                   publish: Callable[[bytes, Message], Awaitable]):
+    if not attach(link):
+        link.writer.close()
+        return
+    print(f'Federated with {link.peer} for {link.patterns}')
+    try:
+        while frame := await read_msg(reader):
+            for head, data in iter_batch(frame):
+                channel_name, lane, ttl, path = parse_head(head)
+                if link.node in path:
+                    continue
+                deadline = time.monotonic() + ttl if ttl else None
+                await publish(channel_name,
+                              Message(data, lane, deadline, path))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        detach(link)
+        link.writer.close()
+        print(f'Link to {link.peer} lost')
+
+
+# The end of a link that was asked for it: the other broker connected like a
+# client, and its first frame was FEDERATE.
+async def accept_link(reader: StreamReader, writer: StreamWriter,
+                      first: Frame, node: bytes, max_hops: int,
+                      attach: Callable[[Link], bool],
+                      detach: Callable[[Link], None],
+                      publish: Callable[[bytes, Message], Awaitable]):
+    peer, patterns = parse_federate(first)
+    writer.writelines(encode_federate(node))
+    link = Link(node, peer, writer, patterns, max_hops)
+    await run_link(reader, link, attach, detach, publish)
+
+
+# The end of a link that asks for it, for as long as the broker runs.
+async def federate(host: str, port: int, patterns: List[bytes],
+                   node: bytes, max_hops: int,
+                   attach: Callable[[Link], bool],
+                   detach: Callable[[Link], None],
+                   publish: Callable[[bytes, Message], Awaitable],
+                   min_delay: float = 0.1, max_delay: float = 5.0):
+    delay = min_delay
+    while True:
+        link: Optional[Link] = None
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.writelines(encode_federate(node, patterns))
+            # A broker that doesn't federate takes FEDERATE for a channel
+            # name, and never answers.
+            try:
+                answer = await asyncio.wait_for(read_msg(reader), 5)
+            except asyncio.TimeoutError:
+                answer = b''
+            if answer[:2] != FEDERATE:
+                print(f'{host}:{port} is not a broker that federates')
+                writer.close()
+            else:
+                link = Link(node, parse_federate(answer)[0], writer,
+                            patterns, max_hops)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        if link is not None:
+            delay = min_delay
+            await run_link(reader, link, attach, detach, publish)
+        await asyncio.sleep(delay * random.uniform(0.5, 1))
+        delay = min(delay * 2, max_delay)
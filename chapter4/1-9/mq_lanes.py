@@ -0,0 +1,126 @@
+# Priority lanes and time to live for the queues of mq_server_plus (see
+# msgproto.ENVELOPE).
+#
+# A LaneQueue is an asyncio.Queue with a deque per lane instead of a single
+# deque: get() takes from the most urgent lane that has anything, so an
+# urgent message only waits behind other urgent ones, never behind bulk
+# traffic. Within a lane, it's first in, first out, as before. There are
+# only a few lanes, so finding the next message is a look at each of them,
+# and putting and getting stay O(1).
+#
+# Messages with a lane or a TTL travel through the broker as Message
+# objects, and so do those that came from another broker, which also know
+# the nodes they have been through (see mq_federation). Everything else
+# stays the plain frame it always was, and goes in lane 0.
+#
+# Expiry is checked where a message is taken off a queue, and once more
+# right before it's sent, so it costs a comparison per message and nothing
+# at all for messages without a TTL. A queue doesn't go looking for expired
+# messages in the middle of a lane; expire() only drops those at the front
+# of each lane, which is where they pile up when every message of a lane has
+# the same TTL. An expired message further back still takes up a place until
+# it gets to the front, but it's never sent.
+import asyncio
+import time
+from collections import deque
+from typing import Deque, List, Optional, Tuple, Union
+from msgproto import Frame
+
+LANES = 4
+
+
+class Message:
+    __slots__ = ('data', 'lane', 'deadline', 'path')
+
+    def __init__(self, data: Frame, lane: int = 0,
+                 deadline: Optional[float] = None,
+                 path: Tuple[bytes, ...] = ()):
+        self.data = data
+        self.lane = min(lane, LANES - 1)
+        self.deadline = deadline
+        self.path = path
+
+    # The queues' None is how a sender is told to stop, so a message must
+    # never look false, even if its data is empty.
+    def __bool__(self) -> bool:
+        return True
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def expired(self, now: Optional[float] = None) -> bool:
+        return (self.deadline is not None
+                and (now or time.monotonic()) >= self.deadline)
+
+    def replace(self, data: Frame) -> 'Message':
+        return Message(data, self.lane, self.deadline, self.path)
+
+
+# A message as it comes in: a plain frame unless it needs to be more.
+def envelop(data: Frame, lane: int, ttl: float) -> Union[Frame, Message]:
+    if not lane and not ttl:
+        return data
+    return Message(data, lane, time.monotonic() + ttl if ttl else None)
+
+
+def unwrap(item: Union[Frame, Message]) -> Frame:
+    return item.data if isinstance(item, Message) else item
+
+
+def expired(item: Union[Frame, Message, None]) -> bool:
+    return isinstance(item, Message) and item.expired()
+
+
+class Lanes:
+    __slots__ = ('lanes', 'count')
+
+    def __init__(self):
+        self.lanes: List[Deque] = [deque() for _ in range(LANES)]
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        for lane in reversed(self.lanes):
+            yield from lane
+
+
+class LaneQueue(asyncio.Queue):
+    # asyncio.Queue keeps its items in self._queue and only ever asks it for
+    # its length, so the lanes can stand in for the deque.
+    def _init(self, maxsize: int):
+        self._queue = Lanes()
+
+    def _put(self, item):
+        lane = item.lane if isinstance(item, Message) else 0
+        self._queue.lanes[lane].append(item)
+        self._queue.count += 1
+
+    def _get(self):
+        for lane in reversed(self._queue.lanes):
+            if lane:
+                self._queue.count -= 1
+                return lane.popleft()
+
+    # The least urgent of the oldest messages, for when something has to go
+    # to make room (as with the drop-oldest policy).
+    def drop_nowait(self):
+        for lane in self._queue.lanes:
+            if lane:
+                self._queue.count -= 1
+                item = lane.popleft()
+                self._wakeup_next(self._putters)
+                return item
+        raise asyncio.QueueEmpty
+
+    def expire(self) -> List[Message]:
+        now = time.monotonic()
+        dropped = []
+        for lane in self._queue.lanes:
+            while lane and isinstance(lane[0], Message) and (
+                    lane[0].expired(now)):
+                dropped.append(lane.popleft())
+                self._queue.count -= 1
+                self._wakeup_next(self._putters)
+        return dropped
@@ -0,0 +1,349 @@
+# A durable, append-only message log for the broker's /queue channels.
+#
+# Each channel gets a directory of segments. A segment is a pair of files
+# named after the offset of its first message:
+#   • 00000000000000000000.log holds the records, one after the other: a
+#     4-byte payload size, a 4-byte CRC32 of size and payload, and the
+#     payload itself.
+#   • 00000000000000000000.idx holds a 4-byte position in the .log file for
+#     every record, so finding the record for any offset is a single lookup
+#     instead of a scan through the segment.
+# Both files of the active segment are preallocated and memory-mapped, so an
+# append is just two memory copies. When either file is full, the segment is
+# sealed (truncated to its used size) and a new one is started; old segments
+# are deleted according to the retention settings. Writes reach the disk in
+# batches: sync() is meant to be called periodically, off the event loop,
+# rather than once per message (group commit).
+import asyncio
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from typing import List, Optional
+
+HEADER = struct.Struct('>II')
+POSITION = struct.Struct('>I')
+
+
+class _Segment:
+    def __init__(self, directory: str, base: int, log_bytes: int = 0,
+                 index_entries: int = 0):
+        self.base = base
+        path = os.path.join(directory, f'{base:020d}')
+        self.log_path, self.idx_path = path + '.log', path + '.idx'
+        # The lock keeps close() from pulling the files out from under a
+        # sync() running in another thread.
+        self.lock = threading.Lock()
+        self.count = 0
+        self.size = 0
+        self.sealed = not log_bytes
+        if self.sealed:
+            self._log_fd = os.open(self.log_path, os.O_RDONLY)
+            self._idx_fd = os.open(self.idx_path, os.O_RDONLY)
+            self.size = os.fstat(self._log_fd).st_size
+            self.count = os.fstat(self._idx_fd).st_size // POSITION.size
+            access = mmap.ACCESS_READ
+        else:
+            self._log_fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT)
+            self._idx_fd = os.open(self.idx_path, os.O_RDWR | os.O_CREAT)
+            # Reopening an active segment after a restart must not cut off
+            # a segment that was made larger for one big message.
+            for fd, size in ((self._log_fd, log_bytes),
+                             (self._idx_fd, index_entries * POSITION.size)):
+                os.ftruncate(fd, max(size, os.fstat(fd).st_size))
+            access = mmap.ACCESS_WRITE
+        self.log = mmap.mmap(self._log_fd, 0, access=access)
+        self.idx = mmap.mmap(self._idx_fd, 0, access=access)
+
+    @property
+    def end(self) -> int:
+        return self.base + self.count
+
+    def fits(self, size: int) -> bool:
+        return (self.count < len(self.idx) // POSITION.size
+                and self.size + HEADER.size + size <= len(self.log))
+
+    def append(self, data) -> int:
+        size = len(data)
+        start = self.size
+        crc = zlib.crc32(data, zlib.crc32(size.to_bytes(4, byteorder='big')))
+        HEADER.pack_into(self.log, start, size, crc)
+        self.log[start + HEADER.size:start + HEADER.size + size] = data
+        POSITION.pack_into(self.idx, self.count * POSITION.size, start)
+        self.size = start + HEADER.size + size
+        self.count += 1
+        return self.base + self.count - 1
+
+    def read(self, offset: int) -> bytes:
+        (start,) = POSITION.unpack_from(
+            self.idx, (offset - self.base) * POSITION.size)
+        size, _ = HEADER.unpack_from(self.log, start)
+        # Slicing an mmap returns a bytes copy, so nothing keeps a view into
+        # the mapping alive and the segment can always be closed.
+        return self.log[start + HEADER.size:start + HEADER.size + size]
+
+    def recover(self):
+        # After a restart, the active segment's preallocated files don't say
+        # how much of them is in use. Walk the records from the start and
+        # stop at the first one whose checksum doesn't match: that is where
+        # the last run stopped writing (or where a crash tore a record).
+        pos, count = 0, 0
+        while pos + HEADER.size <= len(self.log):
+            size, crc = HEADER.unpack_from(self.log, pos)
+            end = pos + HEADER.size + size
+            if end > len(self.log):
+                break
+            data = self.log[pos + HEADER.size:end]
+            if crc != zlib.crc32(data, zlib.crc32(self.log[pos:pos + 4])):
+                break
+            POSITION.pack_into(self.idx, count * POSITION.size, pos)
+            pos, count = end, count + 1
+        self.size, self.count = pos, count
+
+    def sync(self):
+        with self.lock:
+            if not self.log.closed:
+                # fsync() on the file descriptors also writes out the
+                # mapping's dirty pages, and unlike mmap.flush() it releases
+                # the GIL while it waits for the disk.
+                os.fsync(self._log_fd)
+                os.fsync(self._idx_fd)
+
+    def seal(self):
+        # Cut both files down to what is actually used, and make sure they
+        # are on disk. The segment is reopened read-only afterwards.
+        with self.lock:
+            self.log.close()
+            self.idx.close()
+            os.ftruncate(self._log_fd, self.size)
+            os.ftruncate(self._idx_fd, self.count * POSITION.size)
+            os.fsync(self._log_fd)
+            os.fsync(self._idx_fd)
+            os.close(self._log_fd)
+            os.close(self._idx_fd)
+
+    def close(self):
+        with self.lock:
+            self.log.close()
+            self.idx.close()
+            os.close(self._log_fd)
+            os.close(self._idx_fd)
+
+    def delete(self):
+        self.close()
+        os.remove(self.log_path)
+        os.remove(self.idx_path)
+
+
+class SegmentedLog:
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024,
+                 index_entries: int = 1024 * 1024,
+                 retention_bytes: Optional[int] = None,
+                 retention_seconds: Optional[float] = None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_entries = index_entries
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(int(f[:-4]) for f in os.listdir(directory)
+                       if f.endswith('.log'))
+        self._segments: List[_Segment] = [
+            _Segment(directory, base) for base in bases[:-1]]
+        self._bases = bases
+        if bases:
+            active = _Segment(directory, bases[-1], segment_bytes,
+                              index_entries)
+            active.recover()
+        else:
+            active = _Segment(directory, 0, segment_bytes, index_entries)
+            self._bases = [0]
+        self._segments.append(active)
+        self._dirty = False
+        # The offset of the next message to be delivered. It is saved with
+        # every sync(), so after a restart delivery resumes close to where
+        # it stopped: at worst, messages delivered since the last sync() are
+        # delivered again.
+        self.cursor = self.start
+        self._cursor_path = os.path.join(directory, 'cursor')
+        if os.path.exists(self._cursor_path):
+            with open(self._cursor_path) as f:
+                self.cursor = max(self.start, int(f.read() or 0))
+        self._saved_cursor = self.cursor
+        self.closed = False
+
+    @property
+    def start(self) -> int:
+        # The oldest offset still on disk.
+        return self._segments[0].base
+
+    @property
+    def end(self) -> int:
+        # The offset that the next append will get.
+        return self._segments[-1].end
+
+    def append(self, data) -> int:
+        active = self._segments[-1]
+        if not active.fits(len(data)):
+            active = self._roll(len(data))
+        self._dirty = True
+        return active.append(data)
+
+    def read(self, offset: int) -> bytes:
+        if not self.start <= offset < self.end:
+            raise IndexError(f'offset {offset} is not in the log')
+        segment = self._segments[bisect_right(self._bases, offset) - 1]
+        return segment.read(offset)
+
+    def _roll(self, size: int) -> _Segment:
+        old = self._segments.pop()
+        self._bases.pop()
+        if old.count:
+            old.seal()
+            self._segments.append(_Segment(self.directory, old.base))
+            self._bases.append(old.base)
+        else:
+            # Nothing was written to it: the first message was too big for
+            # it, so it's simply replaced.
+            old.delete()
+        # A message larger than a whole segment gets a segment of its own.
+        log_bytes = max(self.segment_bytes, HEADER.size + size)
+        active = _Segment(self.directory, old.end, log_bytes,
+                          self.index_entries)
+        self._segments.append(active)
+        self._bases.append(active.base)
+        self.enforce_retention()
+        return active
+
+    def enforce_retention(self):
+        # Only sealed segments are ever deleted, oldest first.
+        now = time.time()
+        total = sum(s.size for s in self._segments)
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            too_big = (self.retention_bytes is not None
+                       and total > self.retention_bytes)
+            too_old = (self.retention_seconds is not None
+                       and now - os.stat(oldest.log_path).st_mtime
+                       > self.retention_seconds)
+            if not (too_big or too_old):
+                break
+            total -= oldest.size
+            oldest.delete()
+            del self._segments[0], self._bases[0]
+        self.cursor = max(self.cursor, self.start)
+
+    def discard(self, offset: int):
+        # Delete the sealed segments that only hold offsets before this one.
+        while len(self._segments) > 1 and self._segments[0].end <= offset:
+            self._segments[0].delete()
+            del self._segments[0], self._bases[0]
+
+    def sync(self):
+        # Safe to call from a thread other than the event loop's.
+        if self._dirty:
+            self._dirty = False
+            self._segments[-1].sync()
+        if (cursor := self.cursor) != self._saved_cursor:
+            tmp = self._cursor_path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.write(str(cursor))
+            os.replace(tmp, self._cursor_path)
+            self._saved_cursor = cursor
+
+    def close(self):
+        self.sync()
+        for segment in self._segments:
+            segment.close()
+        self.closed = True
+
+
+# LogQueue puts a SegmentedLog behind the same put()/get() interface as the
+# asyncio.Queue instances in the broker's CHAN_QUEUES, so a durable channel is
+# served by the same chan_sender() code as any other. The difference is that
+# put() never has to wait: there is no maxsize, because the backlog lives on
+# disk and not in memory. get() hands out messages from the log's cursor.
+class LogQueue:
+    def __init__(self, log: SegmentedLog):
+        self.log = log
+        self._event = asyncio.Event()
+        self._closed = False
+
+    def qsize(self) -> int:
+        return self.log.end - self.log.cursor
+
+    def full(self) -> bool:
+        return False
+
+    def empty(self) -> bool:
+        return not self.qsize()
+
+    async def put(self, data):
+        self.put_nowait(data)
+
+    def put_nowait(self, data):
+        # As with the in-memory queues, putting None asks the consumer to
+        # stop. It isn't written to the log.
+        if data is None:
+            self._closed = True
+        else:
+            self.log.append(data)
+        self._event.set()
+
+    async def get(self):
+        while self.empty():
+            if self._closed:
+                return None
+            self._event.clear()
+            await self._event.wait()
+        data = self.log.read(self.log.cursor)
+        self.log.cursor += 1
+        return data
+
+
+# A first-in, first-out queue on disk, for subscribers that can't keep up
+# (see the spill policy in mq_server_plus). It's a SegmentedLog in a
+# temporary directory that is read from its cursor, with consumed segments
+# deleted as soon as the cursor has passed them. Nothing here needs to
+# survive a restart, so it is never synced.
+class Spill:
+    def __init__(self, segment_bytes: int = 4 * 1024 * 1024):
+        self.log = SegmentedLog(tempfile.mkdtemp(prefix='mq-spill-'),
+                                segment_bytes=segment_bytes,
+                                index_entries=segment_bytes // 64)
+
+    def __len__(self) -> int:
+        return self.log.end - self.log.cursor
+
+    def push(self, data):
+        self.log.append(data)
+
+    def pop(self) -> bytes:
+        data = self.log.read(self.log.cursor)
+        self.log.cursor += 1
+        self.log.discard(self.log.cursor)
+        return data
+
+    def close(self):
+        for segment in self.log._segments:
+            segment.close()
+        shutil.rmtree(self.log.directory)
+
+
+# The group commit: one task syncs every log that has been written to since
+# the last round, then sleeps. Syncing runs in the default executor so that
+# the event loop keeps serving clients while the disk catches up.
+async def log_syncer(logs, interval: float):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        for log in list(logs):
+            await loop.run_in_executor(None, log.sync)
+            # The broker may have closed the log in the meantime.
+            if not log.closed:
+                log.enforce_retention()
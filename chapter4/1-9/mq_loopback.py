@@ -0,0 +1,172 @@
+# An in-process transport, for producers and consumers that run in the same
+# process, and on the same event loop, as the broker.
+#
+# Over TCP, or even a Unix socket, every message is copied into the kernel
+# and back out again, and split into frames again on the other side. A
+# loopback connection is a pair of transports that skips all of that: what
+# one side writes is handed straight to the other side's FrameReader (see
+# msgproto), which is where read_msg() gets its frames. The writer and the
+# reader are a regular StreamWriter and a FrameReader, so the broker's
+# client() coroutines and broadcast() work with loopback connections
+# unchanged.
+#
+# Nothing is serialized: a frame written as encode_msg(data), the way
+# broadcast() and send_msg() write them, reaches the reader as the very same
+# data object. (Only a frame that was written in several pieces, such as a
+# chunked message, has to be joined into one.) The flip side is the same as
+# for FrameProtocol's retain mode: a buffer must not be changed after it
+# has been written.
+import asyncio
+from asyncio import StreamWriter
+from asyncio.streams import FlowControlMixin
+from itertools import count
+from typing import Any, Dict, List, Optional, Tuple
+from msgproto import Frame, FrameReader
+
+NEXT_CONNECTION = count()
+
+
+class _Protocol(FlowControlMixin):
+    # The drain() bookkeeping for one side's StreamWriter, plus the future
+    # that its wait_closed() waits on.
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        super().__init__(loop=loop)
+        self.closed = loop.create_future()
+
+    def connection_lost(self, exc: Optional[BaseException]):
+        if not self.closed.done():
+            self.closed.set_result(None)
+        super().connection_lost(exc)
+
+    def _get_close_waiter(self, stream: StreamWriter) -> asyncio.Future:
+        return self.closed
+
+
+class LoopbackTransport(asyncio.Transport):
+    def __init__(self, loop: asyncio.AbstractEventLoop, extra: Dict[str, Any]):
+        super().__init__(extra)
+        self.reader = FrameReader()
+        self.reader.set_transport(self)
+        self.protocol = _Protocol(loop)
+        self.peer: Optional[LoopbackTransport] = None
+        self._closing = False
+        # A frame that has been written in several pieces: its size, and the
+        # pieces so far (the first one may be part of the size prefix).
+        self._size: Optional[int] = None
+        self._prefix = b''
+        self._parts: List[Frame] = []
+        self._got = 0
+
+    def write(self, data: Frame):
+        self.writelines([data])
+
+    def writelines(self, buffers):
+        if self._closing:
+            return
+        feed = self.peer.reader.feed_frame
+        for buf in buffers:
+            # The usual case, a whole frame body in one buffer, just after
+            # its size prefix: pass on the buffer itself.
+            if self._size == len(buf) and not self._parts:
+                feed(buf)
+                self._size = None
+                continue
+            view = memoryview(buf)
+            while view:
+                if self._size is None:
+                    take = 4 - len(self._prefix)
+                    self._prefix += view[:take]
+                    view = view[take:]
+                    if len(self._prefix) == 4:
+                        self._size = int.from_bytes(self._prefix,
+                                                    byteorder='big')
+                        self._prefix = b''
+                        if not self._size:
+                            feed(b'')
+                            self._size = None
+                    continue
+                need = self._size - self._got
+                piece, view = view[:need], view[need:]
+                self._parts.append(piece)
+                self._got += len(piece)
+                if self._got == self._size:
+                    parts = self._parts
+                    feed(parts[0] if len(parts) == 1 else b''.join(parts))
+                    self._size, self._parts, self._got = None, [], 0
+
+    # broadcast() checks these to decide whether a writer needs drain(). The
+    # "buffer" is the other side's queue of frames that haven't been read
+    # yet, and the limits are the ones at which that FrameReader pauses and
+    # resumes reading.
+    def get_write_buffer_size(self) -> int:
+        return len(self.peer.reader._frames)
+
+    def get_write_buffer_limits(self) -> Tuple[int, int]:
+        limit = self.peer.reader._limit
+        return limit // 2, limit
+
+    # Called by this side's FrameReader when its queue is too long or short
+    # again: stop or resume the other side's writes, which is what its
+    # drain() waits for.
+    def pause_reading(self):
+        self.peer.protocol.pause_writing()
+
+    def resume_reading(self):
+        if self.peer.protocol._paused:
+            self.peer.protocol.resume_writing()
+
+    def is_reading(self) -> bool:
+        return not self.peer.protocol._paused
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self):
+        # Closing either side closes the connection: both readers see the
+        # end of the stream after whatever frames they still have.
+        for side in (self, self.peer):
+            if not side._closing:
+                side._closing = True
+                side.peer.reader.feed_eof()
+                side.protocol.connection_lost(None)
+
+    def abort(self):
+        self.close()
+
+
+def loopback_pair() -> Tuple[Tuple[FrameReader, StreamWriter],
+                             Tuple[FrameReader, StreamWriter]]:
+    loop = asyncio.get_running_loop()
+    number = next(NEXT_CONNECTION)
+    a = LoopbackTransport(loop, dict(peername=('loopback', number),
+                                     sockname=('loopback', 'broker')))
+    b = LoopbackTransport(loop, dict(peername=('loopback', 'broker'),
+                                     sockname=('loopback', number)))
+    a.peer, b.peer = b, a
+    return ((a.reader, StreamWriter(a, a.protocol, None, loop)),
+            (b.reader, StreamWriter(b, b.protocol, None, loop)))
+
+
+# The counterpart of asyncio.start_server(): every connect() runs
+# client_connected_cb(reader, writer) as a task, just as a real server would
+# for a new connection, and returns the client's end.
+class LoopbackServer:
+    def __init__(self, client_connected_cb):
+        self._client_connected_cb = client_connected_cb
+        self._tasks = set()
+
+    def connect(self) -> Tuple[FrameReader, StreamWriter]:
+        server_end, client_end = loopback_pair()
+        task = asyncio.create_task(self._client_connected_cb(*server_end))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return client_end
+
+    def close(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+
+async def open_loopback_connection(server: LoopbackServer):
+    # A coroutine only for symmetry with asyncio.open_connection().
+    return server.connect()
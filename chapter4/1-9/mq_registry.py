@@ -0,0 +1,67 @@
+# The subscribers of a channel, for both brokers.
+#
+# These used to be kept in a deque, which is cheap to append to and to
+# rotate, but taking a subscriber out of one is a search from the front:
+# O(n) for every disconnect, so with tens of thousands of subscribers on a
+# channel, connections coming and going cost time quadratic in their number.
+#
+# Subscribers keeps them in an OrderedDict instead, used as an ordered set.
+# Adding and removing a subscriber is a dict operation, O(1), and since an
+# OrderedDict can move any key to either end in O(1) too, rotate() works as
+# it did on the deque: the last subscriber moves to the front, and first()
+# is the one whose turn it is. That keeps /queue round-robin stable: each
+# subscriber gets its turn once per round, a new one joins the round at the
+# end, and one that leaves just drops out of it.
+#
+# Iterating over an OrderedDict is slower than over a tuple, though, and it
+# must not change while that's going on. Fan-out, which goes through every
+# subscriber for every message, uses snapshot() instead: a tuple of the
+# subscribers, built the first time it's asked for after a subscription
+# change and reused until the next one, so that with a steady set of
+# subscribers it costs nothing at all. (Rotating doesn't count as a change;
+# the snapshot is in no particular order.)
+from collections import OrderedDict
+from typing import Hashable, Iterable, Iterator, Optional, Tuple
+
+
+class Subscribers:
+    __slots__ = ('_members', '_snapshot')
+
+    def __init__(self, members: Iterable[Hashable] = ()):
+        self._members: 'OrderedDict[Hashable, None]' = OrderedDict.fromkeys(
+            members)
+        self._snapshot: Optional[Tuple[Hashable, ...]] = None
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self._members)
+
+    def __contains__(self, member: Hashable) -> bool:
+        return member in self._members
+
+    def __repr__(self) -> str:
+        return f'Subscribers({list(self._members)})'
+
+    def add(self, member: Hashable):
+        if member not in self._members:
+            self._members[member] = None
+            self._snapshot = None
+
+    def discard(self, member: Hashable):
+        if self._members.pop(member, False) is None:
+            self._snapshot = None
+
+    def rotate(self):
+        if len(self._members) > 1:
+            self._members.move_to_end(next(reversed(self._members)),
+                                      last=False)
+
+    def first(self) -> Hashable:
+        return next(iter(self._members))
+
+    def snapshot(self) -> Tuple[Hashable, ...]:
+        if self._snapshot is None:
+            self._snapshot = tuple(self._members)
+        return self._snapshot
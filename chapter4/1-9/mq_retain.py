@@ -0,0 +1,107 @@
+# Retained messages for /topic channels (see mq_server --retain).
+#
+# A subscriber normally sees nothing until the next publish, which is a long
+# wait for a dashboard that wants the current state right away. With
+# retention, the broker keeps the last few messages of every topic and sends
+# them to each new subscriber, oldest first, before anything else.
+#
+# Each topic's messages are kept in a Ring: a fixed list of slots, written
+# round and round, so a full ring replaces its oldest message without
+# moving anything else. Memory is bounded three ways: the number of slots,
+# the bytes held per topic, and the bytes held for all topics together.
+# When the last limit is hit, the topics that haven't been published to for
+# the longest lose their oldest messages first.
+from collections import OrderedDict
+from typing import Iterator, List, Optional
+from msgproto import Frame
+from mq_topics import is_pattern, matches
+
+
+class Ring:
+    __slots__ = ('slots', 'start', 'count', 'size')
+
+    def __init__(self, capacity: int):
+        self.slots: List[Optional[Frame]] = [None] * capacity
+        self.start = 0
+        self.count = 0
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[Frame]:
+        for i in range(self.count):
+            yield self.slots[(self.start + i) % len(self.slots)]
+
+    def append(self, data: Frame):
+        if self.count == len(self.slots):
+            self.popleft()
+        self.slots[(self.start + self.count) % len(self.slots)] = data
+        self.count += 1
+        self.size += len(data)
+
+    def popleft(self) -> Frame:
+        data, self.slots[self.start] = self.slots[self.start], None
+        self.start = (self.start + 1) % len(self.slots)
+        self.count -= 1
+        self.size -= len(data)
+        return data
+
+
+class Retained:
+    def __init__(self, count: int = 0, channel_bytes: Optional[int] = None,
+                 total_bytes: Optional[int] = None):
+        self.configure(count, channel_bytes, total_bytes)
+
+    def configure(self, count: int, channel_bytes: Optional[int],
+                  total_bytes: Optional[int]):
+        # A count of zero turns retention off. No limit on bytes is None.
+        self.count = count
+        self.channel_bytes = channel_bytes
+        self.total_bytes = total_bytes
+        # The rings by channel name, least recently published first.
+        self.rings: 'OrderedDict[bytes, Ring]' = OrderedDict()
+        self.size = 0
+
+    def __bool__(self) -> bool:
+        return self.count > 0
+
+    def add(self, channel_name: bytes, data: Frame):
+        ring = self.rings.get(channel_name)
+        if ring is None:
+            ring = self.rings[channel_name] = Ring(self.count)
+        else:
+            self.rings.move_to_end(channel_name)
+        # A message that could never fit still makes the older ones stale:
+        # they are no longer the latest, so replaying them would be wrong.
+        if ((self.channel_bytes and len(data) > self.channel_bytes)
+                or (self.total_bytes and len(data) > self.total_bytes)):
+            self.size -= ring.size
+            del self.rings[channel_name]
+            return
+        # Frames from the buffered framer are views into its receive buffer.
+        # The broker's framer never reuses that buffer (retain=True), but a
+        # view keeps the whole of it alive, 64 KiB or more, for as long as
+        # the message is retained; a copy holds on to the message alone.
+        data = bytes(data)
+        self.size -= ring.size
+        ring.append(data)
+        while self.channel_bytes and ring.size > self.channel_bytes:
+            ring.popleft()
+        self.size += ring.size
+        while self.total_bytes and self.size > self.total_bytes:
+            oldest_name, oldest = next(iter(self.rings.items()))
+            self.size -= len(oldest.popleft())
+            if not oldest:
+                del self.rings[oldest_name]
+
+    # The messages a new subscription gets. For a pattern, that means
+    # checking every retained topic, but that happens once per subscription,
+    # not once per message.
+    def replay(self, channel_name: bytes) -> Iterator[Frame]:
+        if not is_pattern(channel_name):
+            yield from self.rings.get(channel_name, ())
+            return
+        for name, ring in list(self.rings.items()):
+            if matches(channel_name, name):
+                yield from ring
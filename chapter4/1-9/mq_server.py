@@ -2,14 +2,80 @@
 import asyncio
 from asyncio import StreamReader, StreamWriter, gather
 from collections import deque, defaultdict
-from typing import Deque, DefaultDict
+from contextlib import suppress
+from itertools import count
+from typing import (
+    Any, Deque, DefaultDict, Dict, Iterable, List, Optional, Tuple)
+import argparse
+import os
+import time
 # Imports from our msgproto.py module.
-from msgproto import read_msg, send_msg
+from msgproto import (
+    read_msg, broadcast, encode_msg, iter_batch, parse_alias, parse_chunk,
+    start_frame_server, start_frame_unix_server, Codec, Frame, FrameTooLarge,
+    CONTROL, BATCH, REGISTER, PUBLISH, SUBSCRIBE, UNSUBSCRIBE, PREFETCH, ACK,
+    CHUNK, COMPRESS, PLAIN, ENVELOPE, DELAY, IDEMPOTENT, parse_envelope,
+    parse_delay, parse_idempotent)
+from mq_topics import TopicTrie, is_pattern
+from mq_credit import Consumer, choose
+from mq_registry import Subscribers
+from mq_retain import Retained
+from mq_timers import TimerWheel
+import mq_dedup
+from mq_dedup import Dedup
+import mq_trace
+from mq_trace import Tracer, install_dump, DEBUG
+from mq_cluster import (
+    Peer, Remote, link_peers, run_workers, owner, encode_sub, PEER_PUBLISH,
+    PEER_DELIVER, PEER_DELIVER_TO, PEER_SUBSCRIBE, PEER_UNSUBSCRIBE)
 
 # A global collection of currently active subscribers. Every time a client
 # connects, they must first send a channel name they’re subscribing to. A
-# deque will hold all the subscribers for a particular channel.
-SUBSCRIBERS: DefaultDict[bytes, Deque] = defaultdict(deque)
+# Subscribers registry (see mq_registry) will hold all the subscribers for a
+# particular channel.
+SUBSCRIBERS: DefaultDict[bytes, Subscribers] = defaultdict(Subscribers)
+# Channel ids, see intern() below.
+CHANNEL_IDS: Dict[bytes, int] = {}
+CHANNELS: List[Tuple[bytes, Subscribers]] = []
+# Pattern subscriptions, and the combined subscribers of each channel id
+# while there are any; see subscribe() and route() below.
+PATTERNS = TopicTrie()
+ROUTES: Dict[int, Subscribers] = {}
+# /queue consumers that acknowledge their messages (see mq_credit), and the
+# messages of each channel id that are waiting for one of them to have room.
+CONSUMERS: Dict[StreamWriter, Consumer] = {}
+BACKLOG: Dict[int, Deque[Frame]] = {}
+# With --workers, this process is one of several (see mq_cluster). CLUSTER
+# holds its index and the number of workers, PEERS the links to the other
+# workers, and every local connection gets a number, so that other workers
+# can refer to it as a Remote(worker, sub). All of these stay empty in a
+# single process.
+CLUSTER: Dict[str, Any] = {}
+PEERS: Dict[int, Peer] = {}
+SUB_IDS: Dict[StreamWriter, int] = {}
+LOCAL_SUBS: Dict[int, StreamWriter] = {}
+NEXT_SUB = count()
+# The largest frame a client may send (see msgproto.FrameTooLarge), and the
+# chunked messages (see msgproto.CHUNK) being relayed right now, by each of
+# the subscribers they are being written to.
+LIMITS: Dict[str, Optional[int]] = dict(max_frame_size=None)
+STREAMS: Dict[StreamWriter, 'Stream'] = {}
+# The codec of each connection that asked for compression (see
+# msgproto.COMPRESS), out of COMPRESSORS: plain zlib, and zlib with the
+# preset dictionary given with --zdict, by dictionary id.
+CODECS: Dict[StreamWriter, Codec] = {}
+COMPRESSORS: Dict[bytes, Codec] = {b'': Codec()}
+# The last messages of each /topic channel, for new subscribers (see
+# mq_retain). Off unless main() is given a retain count.
+RETAINED = Retained()
+# Messages published with a delay (see msgproto.DELAY), held on a timer
+# wheel until they are due (see mq_timers).
+TIMERS = TimerWheel()
+# The message ids recently published to each channel (see mq_dedup).
+DEDUP = Dedup()
+# Events for debugging, such as every message sent, are traced rather than
+# printed (see mq_trace).
+TRACE = Tracer()
 
 
 async def client(reader: StreamReader, writer: StreamWriter):
@@ -26,71 +92,692 @@ async def client(reader: StreamReader, writer: StreamWriter):
     #     channel name, followed by a message containing the data. Our broker
     #     will send such data messages to every client subscribed to that
     #     channel name.
-    subscribe_chan = await read_msg(reader)
+    # With the buffered framer, frames arrive as memoryview slices; channel
+    # names are turned into bytes so that they can be used as dict keys. (For
+    # frames that are already bytes, bytes() returns the very same object.)
+    max_size = LIMITS['max_frame_size']
+    subscribe_chan = bytes(await read_msg(reader, max_size))
+    # Compression (see msgproto.COMPRESS) is asked for before subscribing,
+    # so that there is no message the client could receive uncompressed.
+    codec = None
+    if subscribe_chan[:2] == COMPRESS:
+        codec = COMPRESSORS.get(subscribe_chan[2:], COMPRESSORS[b''])
+        subscribe_chan = bytes(await read_msg(reader, max_size))
+        print(f'Remote {peername} compressing with zlib'
+              + (' and a preset dictionary' if codec.zdict else ''))
+    if PEERS:
+        sub = SUB_IDS[writer] = next(NEXT_SUB)
+        LOCAL_SUBS[sub] = writer
+    if codec:
+        CODECS[writer] = codec
     # Add the StreamWriter instance to the global collection of subscribers.
-    SUBSCRIBERS[subscribe_chan].append(writer)
+    # A connection can subscribe to more channels, and to patterns, later on
+    # (see msgproto.SUBSCRIBE); subscriptions keeps track of all of them.
+    subscriptions = {subscribe_chan}
+    subscribe(subscribe_chan, writer)
     print(f'Remote {peername} subscribed to {subscribe_chan}')
+    if RETAINED and replay_retained(subscribe_chan, writer):
+        await writer.drain()
+    # The channel aliases this client has registered, mapped to channel ids.
+    aliases: Dict[int, int] = {}
+    # The chunked message this client is in the middle of sending, if any.
+    stream: Optional[Stream] = None
     try:
         # An infinite loop, waiting for data from this client. The first
-        # message from a client must be the destination channel name.
-        while channel_name := await read_msg(reader):
-            # Next comes the actual data to distribute to the channel.
-            data = await read_msg(reader)
-            print(f'Sending to {channel_name}: {data[:19]}...')
-            # Get the deque of subscribers on the target channel.
-            conns = SUBSCRIBERS[channel_name]
-            # Some special handling if the channel name begins with the magic
-            # word /queue: in this case, we send the data to only one of the
-            # subscribers, not all of them. This can be used for sharing work
-            # between a bunch of workers, rather than the usual pub-sub
-            # notification scheme, where all subscribers on a channel get all
-            # the messages.
-            if conns and channel_name.startswith(b'/queue'):
-                # Here is why we use a deque and not a list: rotation of the
-                # deque is how we keep track of which client is next in line
-                # for /queue distribution. This seems expensive until you
-                # realize that a single deque rotation is an O(1) operation.
-                conns.rotate()
-                # Target only whichever client is first; this changes after
-                # every rotation.
-                conns = [conns[0]]
-            # Create a list of coroutines for sending the message to each
-            # writer, and then unpack these into gather() so we can wait for
-            # all of the sending to complete. This line is a bad flaw in our
-            # program, but it may not be obvious why: though it may be true
-            # that all of the sending to each subscriber will happen
-            # concurrently, what happens if we have one very slow client? In
-            # this case, the gather() will finish only when the slowest
-            # subscriber has received its data. We can’t receive any more data
-            # from the sending client until all these send_msg() coroutines
-            # finish. This slows all message distribution to the speed of the
-            # slowest subscriber.
-            await gather(*[send_msg(c, data) for c in conns])
+        # message from a client must be the destination channel name, or a
+        # control frame (see msgproto.CONTROL).
+        while head := await read_msg(reader, max_size):
+            if head[:1] != CONTROL:
+                # Next comes the actual data to distribute to the channel.
+                messages = [(intern(bytes(head)),
+                             await read_msg(reader, max_size))]
+            elif (kind := bytes(head[:2])) == PUBLISH:
+                # Publishing by alias: no channel name on the wire, and no
+                # new bytes object or dict lookup to find the channel.
+                alias, data = parse_alias(head)
+                if (channel_id := aliases.get(alias)) is None:
+                    print(f'Remote {peername} used unknown alias {alias}')
+                    continue
+                messages = [(channel_id, data)]
+            elif kind == BATCH:
+                # A batch frame carries many (channel, data) pairs at once.
+                # They are all dispatched in this one pass, and we wait for
+                # slow subscribers only once, at the end of the batch.
+                messages = [(intern(c), d) for c, d in iter_batch(head)]
+            elif kind == ENVELOPE:
+                # Messages aren't queued here, they are written out right
+                # away, so there is nothing for a lane or a TTL to change:
+                # the message is published like any other.
+                _, _, channel_name, data = parse_envelope(head)
+                messages = [(intern(bytes(channel_name)), data)]
+            elif kind == DELAY:
+                when, channel_name, data = parse_delay(head)
+                channel_name = bytes(channel_name)
+                if (delay := when - time.time()) <= 0:
+                    messages = [(intern(channel_name), data)]
+                else:
+                    # As in mq_server_plus, the data is copied, so that it
+                    # doesn't keep a whole receive buffer alive while it
+                    # waits.
+                    TIMERS.schedule(time.monotonic() + delay, channel_name,
+                                    bytes(data))
+                    continue
+            elif kind == IDEMPOTENT:
+                msg_id, channel_name, data = parse_idempotent(head)
+                channel_id = intern(bytes(channel_name))
+                if DEDUP.seen(channel_id, bytes(msg_id)):
+                    TRACE.event(DEBUG, 'Dropped a duplicate of %s on %s',
+                                bytes(msg_id), bytes(channel_name))
+                    continue
+                messages = [(channel_id, data)]
+            elif kind == REGISTER:
+                alias, channel_name = parse_alias(head)
+                aliases[alias] = intern(bytes(channel_name))
+                continue
+            elif kind == SUBSCRIBE:
+                if (channel_name := bytes(head[2:])) not in subscriptions:
+                    subscriptions.add(channel_name)
+                    subscribe(channel_name, writer)
+                    print(f'Remote {peername} subscribed to {channel_name}')
+                    drain_backlogs()
+                    if RETAINED and replay_retained(channel_name, writer):
+                        await writer.drain()
+                continue
+            elif kind == PREFETCH:
+                # A subscription, with acknowledgements. The window is per
+                # connection: the latest PREFETCH sets it.
+                window, channel_name = parse_alias(head)
+                CONSUMERS.setdefault(writer, Consumer(window)).window = window
+                if (channel_name := bytes(channel_name)) not in subscriptions:
+                    subscriptions.add(channel_name)
+                    subscribe(channel_name, writer)
+                    print(f'Remote {peername} consuming {channel_name} '
+                          f'with window {window}')
+                drain_backlogs()
+                continue
+            elif kind == ACK:
+                if consumer := CONSUMERS.get(writer):
+                    consumer.ack(int.from_bytes(head[2:6], byteorder='big'))
+                    if slow := drain_backlogs():
+                        await drain(slow)
+                continue
+            elif kind == UNSUBSCRIBE:
+                if (channel_name := bytes(head[2:])) in subscriptions:
+                    subscriptions.remove(channel_name)
+                    unsubscribe(channel_name, writer)
+                continue
+            elif kind == CHUNK:
+                # The pieces of a large message are passed on one at a time,
+                # and the next one isn't read before slow subscribers have
+                # drained, so no more than a piece per connection is held
+                # here, however large the message.
+                if PEERS:
+                    print(f'Remote {peername} sent a chunked message, which '
+                          f'is not supported with --workers')
+                    continue
+                total, channel_name, piece = parse_chunk(head)
+                if stream is None:
+                    channel_name = bytes(channel_name)
+                    stream = await start_stream(intern(channel_name), total)
+                    print(f'Streaming {total} bytes to {channel_name}')
+                if len(piece) > stream.remaining:
+                    print(f'Remote {peername} sent more than {total} bytes '
+                          f'of a chunked message')
+                    writer.close()
+                    break
+                slow = stream.write(piece)
+                if not stream.remaining:
+                    slow += stream.finish()
+                    stream = None
+                if slow:
+                    await drain(slow)
+                continue
+            else:
+                print(f'Remote {peername} sent unknown control frame {kind}')
+                continue
+            slow = set()
+            for channel_id, data in messages:
+                slow.update(publish(channel_id, data))
+            if slow:
+                await drain(slow)
     except asyncio.CancelledError:
         print(f'Remote {peername} closing connection.')
         writer.close()
         await writer.wait_closed()
-    except asyncio.IncompleteReadError:
+    except (asyncio.IncompleteReadError, ConnectionError):
         print(f'Remote {peername} disconnected')
+    except FrameTooLarge as e:
+        # The rest of the frame is still coming, and there's no way to skip
+        # it without reading it, so the connection is closed instead.
+        print(f'Remote {peername} sent a {e}')
+        writer.close()
     finally:
         print(f'Remote {peername} closed')
         # When leaving the client() coroutine, we make sure to remove
-        # ourselves from the global SUBSCRIBERS collection. Unfortunately,
-        # this is an O(n) operation, which can be a little expensive for very
-        # large n. A different data structure would fix this, but for now we
-        # console ourselves with the knowledge that connections are intended
-        # to be long-lived—thus, there should be few disconnection events—and
-        # n is unlikely to be very large (say ~10,000 as a rough
-        # order-of-magnitude estimate), and this code is at least easy to
-        # understand.
-        SUBSCRIBERS[subscribe_chan].remove(writer)
-
-
-async def main(*args, **kwargs):
-    server = await asyncio.start_server(*args, **kwargs)
-    async with server:
-        await server.serve_forever()
-try:
-    asyncio.run(main(client, host='127.0.0.1', port=25000))
-except KeyboardInterrupt:
-    print('Bye!')
+        # ourselves from the global SUBSCRIBERS collection. With a deque,
+        # this was an O(n) operation, which got expensive for large n when
+        # many clients came and went; the Subscribers registry makes it
+        # O(1).
+        for channel_name in subscriptions:
+            unsubscribe(channel_name, writer)
+        if PEERS:
+            del LOCAL_SUBS[SUB_IDS.pop(writer)]
+        CODECS.pop(writer, None)
+        # A chunked message that this client didn't finish sending can't be
+        # finished by anyone else, and one that was being written to this
+        # client just carries on without it.
+        if stream is not None:
+            stream.abort()
+        if (receiving := STREAMS.get(writer)) is not None:
+            receiving.remove(writer)
+        # Whatever this consumer didn't acknowledge goes to the front of the
+        # line, for the other consumers. (Except for chunked messages: they
+        # were never held here, so they are lost.)
+        if consumer := CONSUMERS.pop(writer, None):
+            for channel_id, data in reversed(consumer.unacked):
+                if data is not None:
+                    BACKLOG.setdefault(channel_id, deque()).appendleft(data)
+            drain_backlogs()
+        # Nothing more is sent to this client, so close our end too, rather
+        # than leave it to the garbage collector. With many clients coming
+        # and going, open sockets would pile up until it came round.
+        writer.close()
+
+
+# Wait for the slow subscribers of what this client sent. One of them may
+# have gone away in the meantime, which is no reason to stop reading from
+# this client: the subscriber's own client() coroutine cleans up after it.
+async def drain(writers: Iterable[StreamWriter]):
+    async def drain_one(writer: StreamWriter):
+        with suppress(ConnectionError):
+            await writer.drain()
+    await gather(*[drain_one(w) for w in set(writers)])
+
+
+# Exact channel names go into SUBSCRIBERS as before. Patterns go into the
+# PATTERNS trie instead, and a change to those throws away all the cached
+# ROUTES, which are rebuilt on demand by route(). An exact subscription only
+# concerns the route of its own channel: a new subscriber is simply added
+# to it, but one that leaves may still match through a pattern, so that
+# route is rebuilt. Subscribers on other workers are added here too, as
+# Remote entries.
+def subscribe(channel_name: bytes, writer: StreamWriter):
+    if is_pattern(channel_name):
+        PATTERNS.add(channel_name, writer)
+        ROUTES.clear()
+    else:
+        SUBSCRIBERS[channel_name].add(writer)
+        if (channel_id := CHANNEL_IDS.get(channel_name)) in ROUTES:
+            ROUTES[channel_id].add(writer)
+    if writer in SUB_IDS:
+        announce(PEER_SUBSCRIBE, channel_name, SUB_IDS[writer])
+
+
+def unsubscribe(channel_name: bytes, writer: StreamWriter):
+    if is_pattern(channel_name):
+        PATTERNS.remove(channel_name, writer)
+        ROUTES.clear()
+    else:
+        SUBSCRIBERS[channel_name].discard(writer)
+        ROUTES.pop(CHANNEL_IDS.get(channel_name), None)
+    if writer in SUB_IDS:
+        announce(PEER_UNSUBSCRIBE, channel_name, SUB_IDS[writer])
+
+
+# Tell the workers that need to know about a subscription of a local
+# connection: the channel's owner, or for a pattern, all of them.
+def announce(kind: bytes, channel_name: bytes, sub: int):
+    head = encode_sub(kind, sub, channel_name)
+    if is_pattern(channel_name):
+        for peer in PEERS.values():
+            peer.send(head)
+    elif (worker := owner(channel_name, CLUSTER['workers'])) in PEERS:
+        PEERS[worker].send(head)
+
+
+# All the subscribers of a channel: the exact ones plus those with a matching
+# pattern, each connection only once, even if several of its subscriptions
+# match. Matching is done once per channel and cached until the next
+# subscription change.
+def route(channel_id: int) -> Subscribers:
+    if (conns := ROUTES.get(channel_id)) is None:
+        channel_name, exact = CHANNELS[channel_id]
+        conns = ROUTES[channel_id] = Subscribers(
+            [*exact, *PATTERNS.match(channel_name)])
+    return conns
+
+
+# Every channel that is published to gets a small integer id. CHANNELS is
+# indexed by that id and holds the channel name and its subscribers (the
+# very same registry as SUBSCRIBERS[name]), so once a message's channel id is
+# known, finding its subscribers is a list index instead of a dict lookup.
+# This is what makes publishing by alias cheap (see msgproto.REGISTER).
+def intern(channel_name: bytes) -> int:
+    if (channel_id := CHANNEL_IDS.get(channel_name)) is None:
+        channel_id = CHANNEL_IDS[channel_name] = len(CHANNELS)
+        CHANNELS.append((channel_name, SUBSCRIBERS[channel_name]))
+    return channel_id
+
+
+# Send one message to the subscribers of a channel. The returned writers are
+# the ones that need to be drained before more data is accepted.
+def publish(channel_id: int, data: Frame) -> List[StreamWriter]:
+    # Get the name and the subscribers of the target channel.
+    channel_name, conns = CHANNELS[channel_id]
+    # With several workers, only the channel's owner publishes; any other
+    # worker passes the message on to it.
+    if PEERS and (worker := owner(channel_name, CLUSTER['workers'])) in PEERS:
+        slow = PEERS[worker].send(PEER_PUBLISH + channel_name, data)
+        return [slow] if slow else []
+    # While nobody has subscribed to a pattern, the exact subscribers are
+    # all there is, and the trie isn't consulted at all.
+    if PATTERNS:
+        conns = route(channel_id)
+    if TRACE.sampled(DEBUG):
+        TRACE.event(DEBUG, 'Sending to %s: %s...', channel_name,
+                    bytes(data[:19]))
+    # Chunked messages aren't retained: the point of chunking them is that
+    # the broker never holds a whole one.
+    if RETAINED and channel_name.startswith(b'/topic'):
+        RETAINED.add(channel_name, data)
+    # Some special handling if the channel name begins with the magic word
+    # /queue: in this case, we send the data to only one of the subscribers,
+    # not all of them. This can be used for sharing work between a bunch of
+    # workers, rather than the usual pub-sub notification scheme, where all
+    # subscribers on a channel get all the messages.
+    if conns and channel_name.startswith(b'/queue'):
+        # Rotation is how we keep track of which client is next in line for
+        # /queue distribution. This seems expensive until you realize that a
+        # single rotation is an O(1) operation, for the registry as much as
+        # for the deque it replaced.
+        conns.rotate()
+        # Target only whichever client is first; this changes after every
+        # rotation. Once there are consumers with acknowledgements, it's the
+        # one with the most room instead, and if nobody has room, the
+        # message waits in BACKLOG.
+        if not CONSUMERS:
+            conns = [conns.first()]
+        elif (channel_id in BACKLOG
+              or (conn := choose(conns, CONSUMERS)) is None):
+            BACKLOG.setdefault(channel_id, deque()).append(data)
+            return []
+        else:
+            if consumer := CONSUMERS.get(conn):
+                consumer.sent(channel_id, data)
+            conns = [conn]
+    else:
+        # Everyone gets the message, so rather than the registry itself, go
+        # through its snapshot: a plain tuple, only rebuilt after a
+        # subscription change.
+        conns = conns.snapshot()
+    # In the first version of this broker, we created a send_msg() coroutine
+    # for every subscriber and waited on all of them with gather(). With
+    # thousands of subscribers, that meant thousands of coroutines, thousands
+    # of identical 4-byte headers, and a drain() on every writer, for every
+    # single message. Now the frame is encoded once, broadcast() writes it
+    # straight onto each subscriber's transport, and the caller only waits
+    # for the few subscribers whose write buffers are over their high-water
+    # mark. That wait is still the weak spot: a very slow subscriber will
+    # still hold up the sending client, just as before.
+    if not PEERS:
+        return fanout(conns, data)
+    # Subscribers on other workers get the message through their worker:
+    # once per worker, however many of its connections are subscribed, or,
+    # for /queue, only if the one chosen subscriber is there.
+    local, remote = [], {}
+    for conn in conns:
+        if isinstance(conn, Remote):
+            remote.setdefault(conn.worker, conn.sub)
+        else:
+            local.append(conn)
+    slow = fanout(local, data)
+    for worker, sub in remote.items():
+        if channel_name.startswith(b'/queue'):
+            head = encode_sub(PEER_DELIVER_TO, sub, channel_name)
+        else:
+            head = PEER_DELIVER + channel_name
+        if writer := PEERS[worker].send(head, data):
+            slow.append(writer)
+    return slow
+
+
+# Send a new subscription the retained messages of its channel, or of all
+# the topics that its pattern matches. They go through fanout() like any
+# other message, so they are compressed, or set aside while a chunked
+# message is being written, just the same.
+def replay_retained(channel_name: bytes,
+                    writer: StreamWriter) -> List[StreamWriter]:
+    slow = []
+    for data in list(RETAINED.replay(channel_name)):
+        slow.extend(fanout([writer], data))
+    return slow
+
+
+# Write a message to local subscribers. Those that asked for compression get
+# it compressed once per codec, however many of them there are, and those
+# in the middle of receiving a chunked message get it later (see Stream
+# below). Other workers are sent the data as it is, and compress it for
+# their own subscribers.
+def fanout(conns: Iterable[StreamWriter], data: Frame) -> List[StreamWriter]:
+    if not CODECS:
+        frame = encode_msg(data)
+        if STREAMS:
+            conns = defer(conns, frame)
+        return broadcast(conns, frame)
+    groups: Dict[Optional[Codec], List[StreamWriter]] = {}
+    for conn in conns:
+        groups.setdefault(CODECS.get(conn), []).append(conn)
+    slow = []
+    for codec, group in groups.items():
+        frame = encode_msg(data if codec is None else codec.compress(data))
+        if STREAMS:
+            group = defer(group, frame)
+        slow.extend(broadcast(group, frame))
+    return slow
+
+
+# A chunked message on its way to its subscribers. Each of them receives it
+# as one ordinary frame: the size prefix goes out with the first piece, and
+# every piece after that is simply written after it. Until the last piece,
+# nothing else may be written to those subscribers, or it would end up in
+# the middle of the frame. Messages for them are set aside in deferred and
+# written out by finish(), and other chunked messages for them wait in
+# start_stream() until this one is done. However slowly the chunks come in,
+# no more than the largest frame a client may send is set aside for any one
+# subscriber: one that would need more is disconnected (see defer() below).
+class Stream:
+    def __init__(self, conns: List[StreamWriter], total: int):
+        self.conns = conns
+        self.remaining = total
+        self.header: Optional[bytes] = total.to_bytes(4, byteorder='big')
+        self.deferred: Dict[StreamWriter, List[Frame]] = {}
+        self.deferred_bytes: Dict[StreamWriter, int] = {}
+        self.done = asyncio.get_running_loop().create_future()
+        for conn in conns:
+            STREAMS[conn] = self
+
+    def write(self, piece: Frame) -> List[StreamWriter]:
+        self.remaining -= len(piece)
+        if self.header is None:
+            return broadcast(self.conns, [piece])
+        header, self.header = self.header, None
+        if not CODECS:
+            return broadcast(self.conns, [header, piece])
+        # Connections that asked for compression expect a marker byte at the
+        # start of every frame. Chunked messages are never compressed, so
+        # for them it's PLAIN.
+        size = int.from_bytes(header, byteorder='big') + len(PLAIN)
+        marked = size.to_bytes(4, byteorder='big') + PLAIN
+        return (broadcast([c for c in self.conns if c not in CODECS],
+                          [header, piece])
+                + broadcast([c for c in self.conns if c in CODECS],
+                            [marked, piece]))
+
+    def finish(self) -> List[StreamWriter]:
+        slow = []
+        for conn in self.conns:
+            del STREAMS[conn]
+            if frames := self.deferred.get(conn):
+                slow.extend(broadcast([conn], frames))
+        self.done.set_result(None)
+        return slow
+
+    # Carry on without a subscriber, which has gone away or is being
+    # disconnected.
+    def remove(self, conn: StreamWriter):
+        self.conns.remove(conn)
+        del STREAMS[conn]
+        self.deferred.pop(conn, None)
+        self.deferred_bytes.pop(conn, None)
+
+    def abort(self):
+        # The subscribers already have part of the frame, and nothing can be
+        # sent to them that they could tell apart from the rest of it.
+        for conn in self.conns:
+            del STREAMS[conn]
+            conn.close()
+        self.done.set_result(None)
+
+
+# Wait until none of the subscribers of a chunked message is receiving
+# another one, and then start it. The subscribers are chosen as publish()
+# would, except that nothing waits in BACKLOG: the message isn't held here,
+# so if no /queue consumer has room, the next one in line gets it anyway.
+async def start_stream(channel_id: int, total: int) -> Stream:
+    while True:
+        channel_name, conns = CHANNELS[channel_id]
+        if PATTERNS:
+            conns = route(channel_id)
+        if conns and channel_name.startswith(b'/queue'):
+            conns.rotate()
+            conn = choose(conns, CONSUMERS) if CONSUMERS else None
+            conns = [conns.first() if conn is None else conn]
+        else:
+            conns = list(conns)
+        if not (busy := [STREAMS[c] for c in conns if c in STREAMS]):
+            break
+        # Not awaiting the future itself, which would cancel it if this
+        # client went away.
+        await asyncio.wait([busy[0].done])
+    # It still counts against the consumer's window, since the consumer
+    # will acknowledge it like any other message.
+    if conns and (consumer := CONSUMERS.get(conns[0])):
+        consumer.sent(channel_id, None)
+    return Stream(conns, total)
+
+
+# Set aside an encoded message for the subscribers that are in the middle of
+# receiving a chunked one, and return the others. A publisher that stalls
+# halfway through a chunked message would otherwise have the broker hold
+# everything else for its subscribers until it carries on, so a subscriber
+# that has more than --max-frame-size set aside is treated like a slow
+# subscriber that has gone away: it's disconnected (nothing else can be
+# sent to it), and the chunked message carries on without it.
+def defer(conns: Iterable[StreamWriter],
+          frame: List[Frame]) -> List[StreamWriter]:
+    ready = []
+    limit = LIMITS['max_frame_size']
+    for conn in conns:
+        if (stream := STREAMS.get(conn)) is None:
+            ready.append(conn)
+            continue
+        stream.deferred.setdefault(conn, []).extend(frame)
+        size = stream.deferred_bytes.get(conn, 0) + sum(map(len, frame))
+        stream.deferred_bytes[conn] = size
+        if limit and size > limit:
+            print(f'Remote {conn.get_extra_info("peername")} had more than '
+                  f'{limit} bytes waiting behind a chunked message')
+            stream.remove(conn)
+            conn.close()
+    return ready
+
+
+# Delayed messages that have come due are published like any other, in the
+# order they were due, and the timer wheel waits for slow subscribers once
+# per batch. With --workers, a message is held by the worker it was sent to,
+# and published from there to its channel's owner.
+async def release(due: List[Tuple[bytes, Frame]]):
+    slow = []
+    for channel_name, data in due:
+        slow.extend(publish(intern(channel_name), data))
+    if slow:
+        await drain(slow)
+
+
+# Hand out the /queue messages that have been waiting, now that a consumer
+# may have room for them. publish() puts back what still doesn't fit.
+def drain_backlogs() -> List[StreamWriter]:
+    slow = []
+    for channel_id in list(BACKLOG):
+        backlog = BACKLOG.pop(channel_id)
+        while backlog:
+            slow.extend(publish(channel_id, backlog.popleft()))
+            if channel_id in BACKLOG:
+                BACKLOG[channel_id].extend(backlog)
+                break
+    return slow
+
+
+# Messages from the other workers, see mq_cluster.
+def peer_received(worker: int, head: memoryview,
+                  data: memoryview) -> List[StreamWriter]:
+    kind = bytes(head[:1])
+    if kind == PEER_PUBLISH:
+        return publish(intern(bytes(head[1:])), data)
+    if kind == PEER_DELIVER:
+        # The owner has decided that this worker's subscribers get this
+        # message. Subscribers of other workers may match too (through
+        # patterns), but the owner takes care of those.
+        conns = route(intern(bytes(head[1:])))
+        return fanout([c for c in conns if not isinstance(c, Remote)], data)
+    sub = int.from_bytes(head[1:5], byteorder='big')
+    if kind == PEER_DELIVER_TO:
+        # The connection may have gone away since the owner chose it, and
+        # then the message goes back to the owner. The owner doesn't know
+        # about windows on other workers, but acknowledgements are tracked
+        # here, so that unacknowledged messages are handed out again.
+        channel_id = intern(bytes(head[5:]))
+        if (writer := LOCAL_SUBS.get(sub)) is None:
+            return publish(channel_id, data)
+        if consumer := CONSUMERS.get(writer):
+            consumer.sent(channel_id, data)
+        return fanout([writer], data)
+    elif kind == PEER_SUBSCRIBE:
+        subscribe(bytes(head[5:]), Remote(worker, sub))
+        return drain_backlogs()
+    elif kind == PEER_UNSUBSCRIBE:
+        unsubscribe(bytes(head[5:]), Remote(worker, sub))
+    return []
+
+
+async def main(*args, framer: str = 'stream', cluster: Tuple = None,
+               max_frame_size: Optional[int] = None, zdict: bytes = b'',
+               unix: Optional[str] = None, retain: int = 0,
+               retain_bytes: Optional[int] = None,
+               retain_total: Optional[int] = None, trace: Dict = None,
+               delay: Dict = None, dedup: Dict = None, **kwargs):
+    LIMITS['max_frame_size'] = max_frame_size
+    if trace:
+        flush = trace.pop('flush')
+        TRACE.configure(**trace)
+        install_dump(TRACE)
+        if flush:
+            flusher = asyncio.create_task(TRACE.flusher(flush))
+    RETAINED.configure(retain, retain_bytes, retain_total)
+    if dedup:
+        DEDUP.configure(**dedup)
+    if delay:
+        TIMERS.configure(**delay)
+    timers = asyncio.create_task(TIMERS.run(release))
+    if zdict:
+        codec = Codec(zdict)
+        COMPRESSORS[codec.dict_id] = codec
+    if cluster:
+        index, workers, directory = cluster
+        CLUSTER.update(index=index, workers=workers)
+        PEERS.update(await link_peers(directory, index, workers,
+                                      peer_received))
+        # All the workers listen on the same port.
+        kwargs['reuse_port'] = True
+    # The buffered framer (see msgproto.FrameProtocol) is opt-in. Since
+    # start_frame_server() has the same signature as asyncio.start_server(),
+    # and its reader works with read_msg(), client() is the same either way.
+    if framer == 'buffered':
+        server = await start_frame_server(
+            *args, max_size=LIMITS['max_frame_size'], **kwargs)
+    else:
+        server = await asyncio.start_server(*args, **kwargs)
+    # Clients on the same machine can connect through a Unix socket as well,
+    # which skips the TCP/IP stack: no checksums, no acknowledgements, no
+    # congestion control, just a copy from one socket buffer to the other.
+    if unix:
+        if framer == 'buffered':
+            unix_server = await start_frame_unix_server(
+                args[0], unix, max_size=LIMITS['max_frame_size'])
+        else:
+            unix_server = await asyncio.start_unix_server(args[0], unix)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if unix:
+            unix_server.close()
+            os.remove(unix)
+        timers.cancel()
+        if trace and flush:
+            flusher.cancel()
+
+
+def worker(index: int, workers: int, directory: str, args):
+    try:
+        asyncio.run(main(client, host=args.host, port=args.port,
+                         framer=args.framer,
+                         cluster=(index, workers, directory),
+                         max_frame_size=args.max_frame_size,
+                         zdict=args.zdict, trace=mq_trace.options(args),
+                         delay=dict(tick=args.delay_tick,
+                                    slots=args.delay_slots),
+                         dedup=mq_dedup.options(args)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=25000, type=int)
+    parser.add_argument('--framer', default='stream',
+                        choices=['stream', 'buffered'])
+    parser.add_argument('--workers', default=1, type=int)
+    # Larger messages can still be sent, as chunks (see msgproto.CHUNK).
+    # Zero means no limit.
+    parser.add_argument('--max-frame-size', default=16 * 1024 * 1024,
+                        type=int)
+    # A preset dictionary for compression (see msgproto.Codec). Clients
+    # that want to use it need a copy of the same file.
+    parser.add_argument('--zdict', metavar='FILE')
+    # Listen on a Unix socket too, for clients on the same machine.
+    parser.add_argument('--unix', metavar='PATH')
+    # Keep the last N messages of every /topic channel, and send them to
+    # new subscribers. Memory is limited per channel and for all of them
+    # together; zero means no limit.
+    parser.add_argument('--retain', default=0, type=int, metavar='N')
+    parser.add_argument('--retain-bytes', default=1024 * 1024, type=int)
+    parser.add_argument('--retain-total', default=64 * 1024 * 1024,
+                        type=int)
+    # Delayed messages are released every --delay-tick seconds, from a
+    # timer wheel of --delay-slots slots (see mq_timers).
+    parser.add_argument('--delay-tick', default=0.01, type=float)
+    parser.add_argument('--delay-slots', default=4096, type=int)
+    # Idempotent publishing (see mq_dedup). With --workers, every worker
+    # remembers only the ids that reached it, so a message sent again on a
+    # new connection may still get through twice.
+    mq_dedup.add_arguments(parser)
+    # Tracing (see mq_trace). With --workers, every worker has its own
+    # ring, and it's the workers that take SIGUSR1.
+    mq_trace.add_arguments(parser)
+    args = parser.parse_args()
+    if args.unix and args.workers > 1:
+        parser.error('--unix is not supported with --workers')
+    if args.retain and args.workers > 1:
+        parser.error('--retain is not supported with --workers')
+    if args.zdict:
+        with open(args.zdict, 'rb') as f:
+            args.zdict = f.read()
+    try:
+        if args.workers > 1:
+            run_workers(args.workers, worker, args)
+        else:
+            asyncio.run(main(client, host=args.host, port=args.port,
+                             framer=args.framer,
+                             max_frame_size=args.max_frame_size,
+                             zdict=args.zdict, unix=args.unix,
+                             retain=args.retain,
+                             retain_bytes=args.retain_bytes,
+                             retain_total=args.retain_total,
+                             trace=mq_trace.options(args),
+                             delay=dict(tick=args.delay_tick,
+                                        slots=args.delay_slots),
+                             dedup=mq_dedup.options(args)))
+    except KeyboardInterrupt:
+        print('Bye!')
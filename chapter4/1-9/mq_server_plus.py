@@ -1,14 +1,47 @@
 # Example 4-9. Message broker: improved design
 import asyncio
 from asyncio import StreamReader, StreamWriter, Queue
-from collections import deque, defaultdict
+from collections import Counter, deque, defaultdict
 from contextlib import suppress
-from typing import Deque, DefaultDict, Dict
-from msgproto import read_msg, send_msg
+from typing import (
+    Any, Deque, DefaultDict, Dict, List, Optional, Set, Tuple, Union)
+from urllib.parse import quote, unquote_to_bytes
+import argparse
+import json
+import os
+import socket
+import time
+from msgproto import (
+    read_msg, send_msg, encode_msg, iter_batch, parse_alias,
+    start_frame_server, start_frame_unix_server, Codec, Frame, FrameTooLarge,
+    CONTROL, BATCH, REGISTER, PUBLISH, SUBSCRIBE, UNSUBSCRIBE, REPLAY,
+    PREFETCH, ACK, COMPRESS, ENVELOPE, FEDERATE, DELAY, IDEMPOTENT, CHUNK,
+    parse_envelope, parse_delay, parse_idempotent)
+from mq_topics import TopicTrie, is_pattern, matches
+from mq_credit import Consumer, can_take, choose
+from mq_registry import Subscribers
+from mq_log import SegmentedLog, LogQueue, Spill, log_syncer
+from mq_lanes import LaneQueue, Message, envelop, unwrap, expired
+from mq_federation import Link, accept_link, federate
+from mq_timers import TimerWheel
+import mq_dedup
+from mq_dedup import Dedup
+import mq_trace
+from mq_trace import Tracer, install_dump, DEBUG
 
 
-SUBSCRIBERS: DefaultDict[bytes, Deque] = defaultdict(deque)
-SEND_QUEUES: DefaultDict[StreamWriter, Queue] = defaultdict(Queue)
+SUBSCRIBERS: DefaultDict[bytes, Subscribers] = defaultdict(Subscribers)
+# How a channel treats subscribers whose send queue is full, see offer()
+# below. SLOW_POLICIES holds (pattern, policy) pairs from --slow-policy; the
+# first one that matches a channel wins, and SLOW_OPTIONS['default'] applies
+# to all other channels.
+POLICIES = ('drop-newest', 'drop-oldest', 'coalesce', 'disconnect', 'spill')
+SLOW_POLICIES: List[Tuple[bytes, str]] = []
+SLOW_OPTIONS: Dict[str, Any] = dict(default='drop-newest',
+                                    send_queue_size=1000,
+                                    send_batch_bytes=64 * 1024)
+SEND_QUEUES: DefaultDict[StreamWriter, LaneQueue] = defaultdict(
+    lambda: LaneQueue(maxsize=SLOW_OPTIONS['send_queue_size']))
 # In the previous implementation, there were only SUBSCRIBERS ; now there are
 # SEND_QUEUES and CHAN_QUEUES as global collections. This is a consequence of
 # completely decoupling the receiving and sending of data. SEND_QUEUES has one
@@ -16,16 +49,94 @@ SEND_QUEUES: DefaultDict[StreamWriter, Queue] = defaultdict(Queue)
 # client must be placed onto that queue. (If you peek ahead, the send_client()
 # coroutine will pull data off SEND_QUEUES and send it.)
 CHAN_QUEUES: Dict[bytes, Queue] = {}
+# Channels come and go, see get_channel() and reap_channels() below. WAKE
+# holds an event per channel that is set when it may have gained a
+# subscriber, RECENT the channels published to since the last round of
+# reaping, and CHANNEL_TASKS the chan_sender() tasks still running; its size
+# is the gauge of live channel tasks.
+WAKE: Dict[bytes, asyncio.Event] = {}
+RECENT: Set[bytes] = set()
+CHANNEL_TASKS: Set[asyncio.Task] = set()
+# Pattern subscriptions, and the combined subscribers of each channel while
+# there are any; see subscribe() and route() below.
+PATTERNS = TopicTrie()
+ROUTES: Dict[bytes, Subscribers] = {}
+# Durable /queue channels, see open_log() below. LOG_OPTIONS holds the
+# --durable settings; unless it is given, every channel stays in memory.
+LOG_OPTIONS: Dict[str, Any] = {}
+LOGS: Dict[bytes, SegmentedLog] = {}
+# How many replays (see replay() below) are reading each channel's log. The
+# log can't be closed under them, so these channels aren't reaped.
+REPLAYING: Counter = Counter()
+# Per subscriber: how many messages found its send queue full ('overflowed')
+# and how many of those it will never receive ('dropped'). Also the pending
+# values of coalescing channels, and the overflow on disk of spilling ones.
+SLOW_COUNTS: DefaultDict[StreamWriter, Counter] = defaultdict(Counter)
+LATEST: Dict[Tuple[StreamWriter, bytes], 'Latest'] = {}
+SPILLS: Dict[StreamWriter, Spill] = {}
+# /queue consumers that acknowledge their messages (see mq_credit), and the
+# messages of each channel that have to be handed out again because a
+# consumer left without acknowledging them.
+CONSUMERS: Dict[StreamWriter, Consumer] = {}
+REDELIVER: Dict[bytes, Deque[Frame]] = {}
+# Traffic per channel since the last /sys/stats snapshot: messages, bytes,
+# drops, expired messages and duplicates (see publish_stats() below).
+TRAFFIC: DefaultDict[bytes, List[int]] = defaultdict(
+    lambda: [0, 0, 0, 0, 0])
+# How many messages send_client() wrote per batch since the last snapshot,
+# by powers of two: BATCH_SIZES[n] counts the batches of 2**(n - 1) up to
+# 2**n - 1 messages.
+BATCH_SIZES: Counter = Counter()
+STATS_CHANNEL = b'/sys/stats'
+# The largest frame a client may send (see msgproto.FrameTooLarge). Every
+# message is held in memory here until it has been sent, so unlike
+# mq_server, this broker doesn't relay chunked messages (msgproto.CHUNK).
+LIMITS: Dict[str, Optional[int]] = dict(max_frame_size=None)
+# Compression (see msgproto.COMPRESS), as in mq_server: the codec of each
+# connection that asked for it, out of COMPRESSORS.
+CODECS: Dict[StreamWriter, Codec] = {}
+COMPRESSORS: Dict[bytes, Codec] = {b'': Codec()}
+# Federation with brokers on other nodes (see mq_federation): this node's
+# name and how many links a message may cross, and the links to other
+# nodes, by node name. Links are subscribed to their patterns, so they turn
+# up among the subscribers of a channel, next to StreamWriters.
+FEDERATION: Dict[str, Any] = dict(node=b'', max_hops=1)
+LINKS: Dict[bytes, Link] = {}
+# Messages published with a delay (see msgproto.DELAY), held on a timer
+# wheel until they are due (see mq_timers).
+TIMERS = TimerWheel()
+# The message ids recently published to each channel (see mq_dedup).
+DEDUP = Dedup()
+# Every message sent is traced rather than printed (see mq_trace).
+TRACE = Tracer()
 
 
 async def client(reader: StreamReader, writer: StreamWriter):
     peername = writer.get_extra_info('peername')
-    subscribe_chan = await read_msg(reader)
+    max_size = LIMITS['max_frame_size']
+    subscribe_chan = bytes(await read_msg(reader, max_size))
+    # Another broker, linking up with this one.
+    if subscribe_chan[:2] == FEDERATE:
+        await accept_link(reader, writer, subscribe_chan, FEDERATION['node'],
+                          FEDERATION['max_hops'], attach_link, detach_link,
+                          publish)
+        return
+    # Compression (see msgproto.COMPRESS) is asked for before subscribing,
+    # so that there is no message the client could receive uncompressed.
+    codec = None
+    if subscribe_chan[:2] == COMPRESS:
+        codec = COMPRESSORS.get(subscribe_chan[2:], COMPRESSORS[b''])
+        subscribe_chan = bytes(await read_msg(reader, max_size))
+        print(f'Remote {peername} compressing with zlib'
+              + (' and a preset dictionary' if codec.zdict else ''))
     # Up until this point in the client() coroutine function, the code is the
     # same as in the simple server: the subscribed channel name is received,
     # and we add the StreamWriter instance for the new client to the global
     # SUBSCRIBERS collection.
-    SUBSCRIBERS[subscribe_chan].append(writer)
+    if codec:
+        CODECS[writer] = codec
+    subscriptions = {subscribe_chan}
+    subscribe(subscribe_chan, writer)
     # This is new: we create a long-lived task that will do all the sending of
     # data to this client. The task will run independently as a separate
     # coroutine and will pull messages off the supplied queue,
@@ -33,42 +144,134 @@ async def client(reader: StreamReader, writer: StreamWriter):
     send_task = asyncio.create_task(
         send_client(writer, SEND_QUEUES[writer]))
     print(f'Remote {peername} subscribed to {subscribe_chan}')
+    aliases: Dict[int, bytes] = {}
+    replays: Set[asyncio.Task] = set()
     try:
-        while channel_name := await read_msg(reader):
-            data = await read_msg(reader)
-            # Now we’re inside the loop where we receive data. Remember that
-            # we always receive two messages: one for the destination channel
-            # name, and one for the data. We’re going to create a new,
-            # dedicated Queue for every destination channel, and that’s what
-            # CHAN_QUEUES is for: when any client wants to push data to a
-            # channel, we’re going to put that data onto the appropriate queue
-            # and then go immediately back to listening for more data. This
-            # approach decouples the distribution of messages from the
-            # receiving of messages from this client.
-            if channel_name not in CHAN_QUEUES:
-                # If there isn’t already a queue for the target channel, make
-                # one.
-                CHAN_QUEUES[channel_name] = Queue(maxsize=10)
-                # Create a dedicated and long-lived task for that channel. The
-                # coroutine chan_sender() will be responsible for taking data
-                # off the channel queue and distributing that data to
-                # subscribers.
-                asyncio.create_task(chan_sender(channel_name))
-            # Place the newly received data onto the specific channel’s queue.
-            # If the queue fills up, we’ll wait here until there is space for
-            # the new data. Waiting here means we won’t be reading any new
-            # data off the socket, which means that the client will have to
-            # wait on sending new data into the socket on its side. This isn’t
-            # necessarily a bad thing, since it communicates so-called
-            # back-pressure to this client. (Alternatively, you could choose
-            # to drop messages here if the use case is OK with that.)
-            await CHAN_QUEUES[channel_name].put(data)
+        while head := await read_msg(reader, max_size):
+            # Control frames (see msgproto.CONTROL) are handled here: batch
+            # frames are unpacked and all of their messages are queued in a
+            # single pass, and aliases registered by this client are mapped
+            # to channel names. (Unlike in the simple broker, aliases can't
+            # be mapped to channel ids here: idle channels are dropped, and
+            # may come back later as a new channel.)
+            if head[:1] != CONTROL:
+                messages = [(bytes(head), await read_msg(reader, max_size))]
+            elif (kind := bytes(head[:2])) == PUBLISH:
+                alias, data = parse_alias(head)
+                if (channel_name := aliases.get(alias)) is None:
+                    print(f'Remote {peername} used unknown alias {alias}')
+                    continue
+                messages = [(channel_name, data)]
+            elif kind == BATCH:
+                messages = list(iter_batch(head))
+            elif kind == ENVELOPE:
+                # A message with a priority lane and a TTL (see mq_lanes).
+                lane, ttl, channel_name, data = parse_envelope(head)
+                messages = [(bytes(channel_name), envelop(data, lane, ttl))]
+            elif kind == DELAY:
+                when, channel_name, data = parse_delay(head)
+                channel_name = bytes(channel_name)
+                if (delay := when - time.time()) <= 0:
+                    messages = [(channel_name, data)]
+                else:
+                    # The data is copied, so that a message that waits for
+                    # hours doesn't keep a whole receive buffer alive (see
+                    # msgproto.FrameProtocol).
+                    TIMERS.schedule(time.monotonic() + delay, channel_name,
+                                    bytes(data))
+                    continue
+            elif kind == IDEMPOTENT:
+                msg_id, channel_name, data = parse_idempotent(head)
+                channel_name = bytes(channel_name)
+                if DEDUP.seen(channel_name, bytes(msg_id)):
+                    TRAFFIC[channel_name][4] += 1
+                    continue
+                messages = [(channel_name, data)]
+            elif kind == REGISTER:
+                alias, channel_name = parse_alias(head)
+                aliases[alias] = bytes(channel_name)
+                continue
+            elif kind == SUBSCRIBE:
+                # Further subscriptions, to channels or to patterns, on this
+                # same connection.
+                if (channel_name := bytes(head[2:])) not in subscriptions:
+                    subscriptions.add(channel_name)
+                    subscribe(channel_name, writer)
+                    print(f'Remote {peername} subscribed to {channel_name}')
+                    redeliver()
+                continue
+            elif kind == PREFETCH:
+                # A subscription, with acknowledgements. The window is per
+                # connection: the latest PREFETCH sets it.
+                window, channel_name = parse_alias(head)
+                CONSUMERS.setdefault(writer, Consumer(window)).window = window
+                if (channel_name := bytes(channel_name)) not in subscriptions:
+                    subscriptions.add(channel_name)
+                    subscribe(channel_name, writer)
+                    print(f'Remote {peername} consuming {channel_name} '
+                          f'with window {window}')
+                redeliver()
+                continue
+            elif kind == ACK:
+                if consumer := CONSUMERS.get(writer):
+                    was_full = consumer.free <= 0
+                    consumer.ack(int.from_bytes(head[2:6], byteorder='big'))
+                    redeliver()
+                    # Channel senders may be waiting for this consumer to
+                    # have room again.
+                    if was_full:
+                        for channel_name in subscriptions:
+                            wake(channel_name)
+                continue
+            elif kind == UNSUBSCRIBE:
+                if (channel_name := bytes(head[2:])) in subscriptions:
+                    subscriptions.remove(channel_name)
+                    unsubscribe(channel_name, writer)
+                continue
+            elif kind == REPLAY:
+                offset = int.from_bytes(head[2:10], byteorder='big')
+                if log := durable_log(channel_name := bytes(head[10:])):
+                    task = asyncio.create_task(
+                        replay(writer, channel_name, log, offset))
+                    replays.add(task)
+                    task.add_done_callback(replays.discard)
+                continue
+            elif kind == CHUNK:
+                # None of the message could be delivered, however many more
+                # chunks it has, so the client is told so once, by closing
+                # the connection, rather than being read to the end.
+                print(f'Remote {peername} sent a chunked message, which '
+                      f'is only supported by mq_server')
+                writer.close()
+                break
+            else:
+                print(f'Remote {peername} sent unknown control frame {kind}')
+                continue
+            for channel_name, data in messages:
+                await publish(channel_name, data)
     except asyncio.CancelledError:
         print(f'Remote {peername} connection cancelled.')
-    except asyncio.IncompleteReadError:
+    except (asyncio.IncompleteReadError, ConnectionError):
         print(f'Remote {peername} disconnected')
+    except FrameTooLarge as e:
+        print(f'Remote {peername} sent a {e}')
+        writer.close()
     finally:
         print(f'Remote {peername} closed')
+        for task in list(replays):
+            task.cancel()
+        # Unsubscribe first, so that nothing new is queued for this client
+        # behind the None below.
+        for channel_name in subscriptions:
+            unsubscribe(channel_name, writer)
+        # Whatever this consumer didn't acknowledge goes to the front of the
+        # line, for the other consumers.
+        if consumer := CONSUMERS.pop(writer, None):
+            for channel_name, data in reversed(consumer.unacked):
+                REDELIVER.setdefault(channel_name, deque()).appendleft(data)
+            redeliver()
+            for channel_name in REDELIVER:
+                wake(channel_name)
         # When the connection is closed, it’s time to clean up. The long-lived
         # task we created for sending data to this client, send_task, can be
         # shut down by placing None onto its queue, SEND_QUEUES[writer] (check
@@ -79,11 +282,251 @@ async def client(reader: StreamReader, writer: StreamWriter):
         await SEND_QUEUES[writer].put(None)
         # Wait for that sender task to finish...
         await send_task
-        # ...then remove the entry in the SEND_QUEUES collection (and in the
-        # next line, we also remove the sock from the SUBSCRIBERS collection
-        # as before).
+        # ...then remove the entry in the SEND_QUEUES collection, along with
+        # whatever overflowed to disk and was never sent.
         del SEND_QUEUES[writer]
-        SUBSCRIBERS[subscribe_chan].remove(writer)
+        if spill := SPILLS.pop(writer, None):
+            spill.close()
+        CODECS.pop(writer, None)
+        if counts := SLOW_COUNTS.pop(writer, None):
+            print(f'Remote {peername} overflowed {counts["overflowed"]} '
+                  f'times, dropped {counts["dropped"]} messages')
+
+
+# As in the simple broker, exact channel names go into SUBSCRIBERS and
+# patterns into the PATTERNS trie. A pattern change throws away all the
+# cached ROUTES, which are rebuilt on demand; an exact one only concerns
+# its own channel's route. (Links never subscribe to a /queue channel by
+# its exact name, see attach_link(), so there is nothing to filter here.)
+def subscribe(channel_name: bytes, writer: StreamWriter):
+    if is_pattern(channel_name):
+        PATTERNS.add(channel_name, writer)
+        ROUTES.clear()
+    else:
+        SUBSCRIBERS[channel_name].add(writer)
+        if (writers := ROUTES.get(channel_name)) is not None:
+            writers.add(writer)
+    wake(channel_name)
+
+
+def unsubscribe(channel_name: bytes, writer: StreamWriter):
+    if is_pattern(channel_name):
+        PATTERNS.remove(channel_name, writer)
+        ROUTES.clear()
+    elif subscribers := SUBSCRIBERS.get(channel_name):
+        # A channel nobody subscribes to any more has no entry, so that
+        # short-lived channel names don't leave one each behind.
+        subscribers.discard(writer)
+        if not subscribers:
+            del SUBSCRIBERS[channel_name]
+        ROUTES.pop(channel_name, None)
+
+
+# Wake up the chan_sender() of every channel that a subscription is for, in
+# case it is waiting for a subscriber (or for a consumer with room).
+def wake(channel_name: bytes):
+    if not is_pattern(channel_name):
+        if event := WAKE.get(channel_name):
+            event.set()
+    else:
+        for name, event in WAKE.items():
+            if matches(channel_name, name):
+                event.set()
+
+
+def route(name: bytes) -> Union[Subscribers, Tuple]:
+    # While nobody has subscribed to a pattern, the exact subscribers are all
+    # there is. Otherwise, the trie is consulted once per channel, and the
+    # result is cached until the next subscription change. Looking a channel
+    # up doesn't add it to SUBSCRIBERS.
+    if not PATTERNS:
+        return SUBSCRIBERS.get(name, ())
+    if (writers := ROUTES.get(name)) is None:
+        matched = [*SUBSCRIBERS.get(name, ()), *PATTERNS.match(name)]
+        # Links to other nodes match /queue channels through patterns, but
+        # work queues aren't federated.
+        if LINKS and name.startswith(b'/queue'):
+            matched = [w for w in matched if not isinstance(w, Link)]
+        writers = ROUTES[name] = Subscribers(matched)
+    return writers
+
+
+# A link to another node subscribes to its patterns like a client would,
+# except for /queue channels. There can only be one link between two nodes,
+# or every message would be sent twice.
+def attach_link(link: Link) -> bool:
+    if link.peer in LINKS or link.peer == link.node:
+        print(f'Turning down a second link to {link.peer}')
+        return False
+    LINKS[link.peer] = link
+    for pattern in link.patterns:
+        if is_pattern(pattern) or not pattern.startswith(b'/queue'):
+            subscribe(pattern, link)
+    return True
+
+
+def detach_link(link: Link):
+    del LINKS[link.peer]
+    for pattern in link.patterns:
+        if is_pattern(pattern) or not pattern.startswith(b'/queue'):
+            unsubscribe(pattern, link)
+
+
+# The queue of a channel, which is set up the first time that something is
+# published to it (or again, after it was reaped).
+def get_channel(channel_name: bytes) -> Queue:
+    if (queue := CHAN_QUEUES.get(channel_name)) is None:
+        # We’re going to create a new, dedicated Queue for every destination
+        # channel, and that’s what CHAN_QUEUES is for: when any client wants
+        # to push data to a channel, we’re going to put that data onto the
+        # appropriate queue and then go immediately back to listening for
+        # more data. This approach decouples the distribution of messages
+        # from the receiving of messages from this client. The queue has a
+        # lane per priority, so that urgent messages go out first (see
+        # mq_lanes). In durable mode, /queue channels get a queue that is
+        # backed by a log on disk instead, so that neither a restart nor a
+        # slow consumer loses messages.
+        if LOG_OPTIONS and channel_name.startswith(b'/queue'):
+            queue = LogQueue(open_log(channel_name))
+        else:
+            queue = LaneQueue(maxsize=10)
+        CHAN_QUEUES[channel_name] = queue
+        WAKE[channel_name] = asyncio.Event()
+        # Create a dedicated and long-lived task for that channel. The
+        # coroutine chan_sender() will be responsible for taking data off the
+        # channel queue and distributing that data to subscribers.
+        task = asyncio.create_task(chan_sender(channel_name, queue))
+        CHANNEL_TASKS.add(task)
+        task.add_done_callback(CHANNEL_TASKS.discard)
+    return queue
+
+
+def log_directory(channel_name: bytes) -> str:
+    return os.path.join(LOG_OPTIONS['directory'], quote(channel_name, safe=''))
+
+
+def open_log(channel_name: bytes) -> SegmentedLog:
+    options = dict(LOG_OPTIONS)
+    del options['directory']
+    LOGS[channel_name] = SegmentedLog(log_directory(channel_name), **options)
+    return LOGS[channel_name]
+
+
+# The log of a durable channel, opened again if the channel was reaped.
+def durable_log(channel_name: bytes) -> Optional[SegmentedLog]:
+    if (channel_name not in LOGS and LOG_OPTIONS
+            and channel_name.startswith(b'/queue')
+            and os.path.isdir(log_directory(channel_name))):
+        get_channel(channel_name)
+    return LOGS.get(channel_name)
+
+
+# Channel names are often short-lived, e.g. one per session or per request,
+# and every channel costs a queue and a chan_sender() task. Every
+# idle_timeout seconds, the channels that nobody has published to since the
+# last round are dropped, if they have nothing queued, or if they have
+# nobody to send it to: a channel that was published to once and never
+# subscribed to would otherwise keep its queue and its task forever. What
+# such a channel still had queued is dropped. (Durable channels
+# keep their backlog, which is on disk and is delivered as soon as a
+# consumer turns up, and channels whose log is being replayed stay open.)
+# A chan_sender() is shut down as the book suggests,
+# with a None on its queue (or by setting its event, if it is waiting for a
+# subscriber). Its traffic counts and its cached route go too, while its
+# subscribers, if it has any, stay subscribed. Should the channel be
+# published to again, get_channel() simply sets it up afresh.
+async def reap_channels(idle_timeout: float):
+    while True:
+        await asyncio.sleep(idle_timeout)
+        idle = [name for name, queue in CHAN_QUEUES.items()
+                if name not in RECENT and name not in REPLAYING and (
+                    (queue.empty() and name not in REDELIVER)
+                    or (not route(name) and not isinstance(queue, LogQueue)))]
+        RECENT.clear()
+        dropped = 0
+        for name in idle:
+            queue = CHAN_QUEUES.pop(name)
+            dropped += len(REDELIVER.pop(name, ()))
+            # Emptying the queue lets a publish() that was waiting for room
+            # go ahead, but only after the None is in, so it notices and
+            # publishes again (to a new queue).
+            if not isinstance(queue, LogQueue):
+                while not queue.empty():
+                    queue.get_nowait()
+                    dropped += 1
+            queue.put_nowait(None)
+            WAKE.pop(name).set()
+            ROUTES.pop(name, None)
+            TRAFFIC.pop(name, None)
+            # A durable channel's backlog is safe on disk, and its log is
+            # opened again when it's needed.
+            if log := LOGS.pop(name, None):
+                log.close()
+        if idle:
+            print(f'Reaped {len(idle)} idle channels, '
+                  f'{len(CHAN_QUEUES)} left, dropping {dropped} messages '
+                  f'nobody subscribed to')
+
+
+# Send a client the messages of a durable channel from the given offset up
+# to the end of the log as it is right now. These go straight to the socket
+# rather than through SEND_QUEUES, so that a long replay is paced by drain()
+# instead of piling up in memory. Since replayed messages arrive in offset
+# order, a client that replays from offset N knows that the k-th message it
+# receives had offset N + k (if the connection isn't also subscribed to the
+# channel), and can resume from there later.
+async def replay(writer: StreamWriter, channel_name: bytes,
+                 log: SegmentedLog, offset: int):
+    REPLAYING[channel_name] += 1
+    try:
+        with suppress(OSError):
+            for offset in range(offset, log.end):
+                # The broker may be shutting down, and closing its logs.
+                if log.closed:
+                    break
+                # Retention may delete old segments while we're replaying.
+                if offset >= log.start:
+                    await send_msg(writer,
+                                   encode_for(writer, log.read(offset)))
+    finally:
+        REPLAYING[channel_name] -= 1
+        if not REPLAYING[channel_name]:
+            del REPLAYING[channel_name]
+
+
+async def publish(channel_name: bytes, data: Union[Frame, Message]):
+    # Place the newly received data onto the specific channel’s queue. If the
+    # queue fills up, we’ll wait here until there is space for the new data.
+    # Waiting here means we won’t be reading any new data off the socket,
+    # which means that the client will have to wait on sending new data into
+    # the socket on its side. This isn’t necessarily a bad thing, since it
+    # communicates so-called back-pressure to this client. (Alternatively, you
+    # could choose to drop messages here if the use case is OK with that.)
+    RECENT.add(channel_name)
+    traffic = TRAFFIC[channel_name]
+    traffic[0] += 1
+    traffic[1] += len(data)
+    while True:
+        queue = get_channel(channel_name)
+        # The log on disk keeps the data only: durable messages have neither
+        # a lane nor a TTL.
+        if isinstance(queue, LogQueue):
+            data = unwrap(data)
+        await queue.put(data)
+        # If we had to wait, reap_channels() may have emptied the queue and
+        # shut it down in the meantime, in which case our message went in
+        # behind the None, where nobody will ever get it. It goes to the
+        # channel's new queue instead.
+        if CHAN_QUEUES.get(channel_name) is queue:
+            break
+
+
+# Delayed messages that have come due go to their channels' queues like any
+# other message, in the order they were due. The timer wheel waits for the
+# whole batch to be queued before it moves on.
+async def release(due: List[Tuple[bytes, Frame]]):
+    for channel_name, data in due:
+        await publish(channel_name, data)
 
 
 # The send_client() coroutine function is very nearly a textbook example of
@@ -91,71 +534,558 @@ async def client(reader: StreamReader, writer: StreamWriter):
 # placed onto the queue. Note also how we suppress CancelledError inside the
 # loop: this is because we want this task to be closed only by receiving a
 # None on the queue. This way, all pending data on the queue can be sent out
-# before shutdown.
+# before shutdown. Rather than a write and a drain() per message, though,
+# whatever is already waiting goes out together, up to --send-batch-bytes:
+# one writelines() and one drain() for the lot. A subscriber that keeps up
+# gets its messages one at a time, as before, but one with a backlog is
+# caught up with far fewer system calls and trips through the event loop.
 async def send_client(writer: StreamWriter, queue: Queue):
-    while True:
+    budget = SLOW_OPTIONS['send_batch_bytes']
+    done = False
+    while not done:
         try:
-            data = await queue.get()
+            item = await queue.get()
         except asyncio.CancelledError:
             continue
-        if not data:
-            break
-        try:
-            await send_msg(writer, data)
-        except asyncio.CancelledError:
-            await send_msg(writer, data)
+        parts: List[Frame] = []
+        size = count = 0
+        while True:
+            if isinstance(item, Latest):
+                # A coalesced value: from now on, new values for its channel
+                # have to be queued again.
+                del LATEST[item.key]
+                item = item.data
+            if not item:
+                done = True
+                break
+            # A message may have run out of time while it was waiting here.
+            if isinstance(item, Message):
+                if item.expired():
+                    SLOW_COUNTS[writer]['expired'] += 1
+                    item = None
+                else:
+                    item = item.data
+            if item is not None:
+                parts += encode_msg(item)
+                size += 4 + len(item)
+                count += 1
+            if size >= budget or queue.empty():
+                break
+            item = queue.get_nowait()
+        # If the client is gone, or was cut off by the disconnect policy,
+        # keep emptying the queue anyway, until the None arrives.
+        if writer.transport.is_closing():
+            continue
+        if count:
+            BATCH_SIZES[count.bit_length()] += 1
+            writer.writelines(parts)
+            try:
+                await writer.drain()
+            except asyncio.CancelledError:
+                with suppress(ConnectionError):
+                    await writer.drain()
+            except ConnectionError:
+                continue
+        # Messages that spilled to disk move back into the queue as it
+        # empties, oldest first. Once the client has caught up, the spill's
+        # files are deleted.
+        if spill := SPILLS.get(writer):
+            while len(spill) and not queue.full():
+                queue.put_nowait(spill.pop())
+            if not len(spill):
+                del SPILLS[writer]
+                spill.close()
     writer.close()
     await writer.wait_closed()
 
 
-async def chan_sender(name: bytes):
+async def chan_sender(name: bytes, queue: Queue):
+    policy = slow_policy(name)
+    wake = WAKE[name]
     with suppress(asyncio.CancelledError):
         while True:
-            writers = SUBSCRIBERS[name]
-            if not writers:
-                await asyncio.sleep(1)
+            if not (writers := route(name)) or (
+                    CONSUMERS and name.startswith(b'/queue')
+                    and not any(can_take(w, CONSUMERS) for w in writers)):
                 # chan_sender() is the distribution logic for a channel: it
                 # sends data from a dedicated channel Queue instance to all
                 # the subscribers on that channel. But what happens if there
-                # are no subscribers for this channel yet? We’ll just wait a
-                # bit and try again. (Note, though, that the queue for this
-                # channel, CHAN_QUEUES[name], will keep filling up.)
+                # are no subscribers for this channel yet? We wait until
+                # subscribe() says that there may be one now. (Note, though,
+                # that the queue for this channel will keep filling up.) The
+                # same goes for a /queue channel whose consumers have no room
+                # left in their windows; an ACK wakes us up then. The event
+                # is also how reap_channels() stops us in this state.
+                wake.clear()
+                await wake.wait()
+                if CHAN_QUEUES.get(name) is not queue:
+                    break
                 continue
+            # Messages to be handed out again come first. Otherwise, we’ll
+            # wait here for data on the queue, and exit if None is received,
+            # which is what reap_channels() does once the channel has been
+            # idle for a while.
+            if backlog := REDELIVER.get(name):
+                msg = backlog.popleft()
+                if not backlog:
+                    del REDELIVER[name]
+            elif not (msg := await queue.get()):
+                break
+            if expired(msg):
+                TRAFFIC[name][3] += 1
+                continue
+            # Subscriptions may have changed while we were waiting, so look
+            # up the subscribers again now that there is something to send.
+            if not (writers := route(name)):
+                continue
+            if TRACE.sampled(DEBUG):
+                TRACE.event(DEBUG, 'Sending to %s: %s...', name,
+                            bytes(unwrap(msg)[:19]))
             # As in our previous broker implementation, we do something
             # special for channels whose name begins with /queue: we rotate
-            # the deque and send only to the first entry. This acts like a
+            # the subscribers and send only to the first. This acts like a
             # crude load-balancing system because each subscriber gets
             # different messages off the same queue. For all other channels,
             # all subscribers get all the messages.
+            if name.startswith(b'/queue') and CONSUMERS:
+                # With consumers that acknowledge, see send_work().
+                if not send_work(name, writers, msg, policy):
+                    REDELIVER.setdefault(name, deque()).appendleft(msg)
+                continue
             if name.startswith(b'/queue'):
                 writers.rotate()
-                writers = [writers[0]]
-            # We’ll wait here for data on the queue, and exit if None is
-            # received. Currently, this isn’t triggered anywhere (so these
-            # chan_sender() coroutines live forever), but if logic were added
-            # to clean up these channel tasks after, say, some period of
-            # inactivity, that’s how it would be done.
-            if not (msg := await CHAN_QUEUES[name].get()):
-                break
+                writers = [writers.first()]
+            else:
+                writers = writers.snapshot()
+            encoded = {}
+            links = []
             for writer in writers:
-                if not SEND_QUEUES[writer].full():
-                    print(f'Sending to {name}: {msg[:19]}...')
-                    # Data has been received, so it’s time to send to
-                    # subscribers. We do not do the sending here: instead, we
-                    # place the data onto each subscriber’s own send queue.
-                    # This decoupling is necessary to make sure that a slow
-                    # subscriber doesn’t slow down anyone else receiving data.
-                    # And furthermore, if the subscriber is so slow that their
-                    # send queue fills up, we don’t put that data on their
-                    # queue; i.e., it is lost.
-                    await SEND_QUEUES[writer].put(msg)
-
-
-async def main(*args, **kwargs):
-    server = await asyncio.start_server(*args, **kwargs)
-    async with server:
-        await server.serve_forever()
-try:
-    asyncio.run(main(client, host='127.0.0.1', port=25000))
-except KeyboardInterrupt:
-    print('Bye!')
+                if isinstance(writer, Link):
+                    writer.forward(name, msg)
+                    links.append(writer)
+                    continue
+                # Data has been received, so it’s time to send to
+                # subscribers. We do not do the sending here: instead, we
+                # place the data onto each subscriber’s own send queue. This
+                # decoupling is necessary to make sure that a slow subscriber
+                # doesn’t slow down anyone else receiving data. What happens
+                # when a subscriber is so slow that their send queue fills up
+                # depends on the channel's policy; see offer().
+                offer(writer, name,
+                      encode_for(writer, msg, encoded) if CODECS else msg,
+                      policy)
+            # Unlike a subscriber, a link to another node that can't keep up
+            # holds up the channel, rather than lose messages. The message
+            # is only in the link's batch so far, and drain() can only tell
+            # whether the peer keeps up once the transport has it.
+            for link in links:
+                link.batch.flush()
+                with suppress(ConnectionError):
+                    await link.writer.drain()
+
+
+# Give a /queue message to the subscriber with the most room for it, as
+# mq_credit.choose() sees it. Returns False if nobody has room. An expired
+# message counts as handed out, since nobody should get it. Consumers that
+# acknowledge are sent the data only: acknowledgements count messages in
+# the order they were sent, so their send queues mustn't reorder them by
+# lane, or drop one that expires while it waits there. (What they haven't
+# acknowledged keeps its lane and TTL, for when it is handed out again.)
+def send_work(name: bytes, writers: Subscribers, msg: Union[Frame, Message],
+              policy: str) -> bool:
+    if expired(msg):
+        TRAFFIC[name][3] += 1
+        return True
+    writers.rotate()
+    if (writer := choose(writers, CONSUMERS)) is None:
+        return False
+    if consumer := CONSUMERS.get(writer):
+        consumer.sent(name, msg)
+        msg = unwrap(msg)
+    offer(writer, name, encode_for(writer, msg), policy)
+    return True
+
+
+# What a subscriber is actually sent for a message: the message, or if it
+# asked for compression, the message compressed with its codec. Send queues
+# and spills hold what encode_for() returns, so nothing is compressed twice,
+# and with encoded shared between the subscribers of one message, it's
+# compressed once per codec rather than once per subscriber.
+def encode_for(writer: StreamWriter, msg: Union[Frame, Message],
+               encoded: Optional[Dict[Codec, Any]] = None
+               ) -> Union[Frame, Message]:
+    if (codec := CODECS.get(writer)) is None:
+        return msg
+    if encoded is not None and (packed := encoded.get(codec)) is not None:
+        return packed
+    if isinstance(msg, Message):
+        packed = msg.replace(codec.compress(msg.data))
+    else:
+        packed = codec.compress(msg)
+    if encoded is not None:
+        encoded[codec] = packed
+    return packed
+
+
+# Hand out the messages waiting in REDELIVER, as far as consumers have room
+# for them. This is done right away, rather than by chan_sender(), since it
+# may be waiting on an empty queue for a long time.
+def redeliver():
+    for name in list(REDELIVER):
+        backlog = REDELIVER[name]
+        policy = slow_policy(name)
+        while backlog and (writers := route(name)) and send_work(
+                name, writers, backlog[0], policy):
+            backlog.popleft()
+        if not backlog:
+            del REDELIVER[name]
+
+
+def slow_policy(name: bytes) -> str:
+    for pattern, policy in SLOW_POLICIES:
+        if matches(pattern, name):
+            return policy
+    return SLOW_OPTIONS['default']
+
+
+# A coalescing channel puts one of these on a subscriber's send queue rather
+# than the message itself. While it waits there, newer messages for the same
+# channel just replace its data, so a subscriber that falls behind gets the
+# latest value instead of a backlog of stale ones.
+class Latest:
+    __slots__ = ('key', 'data')
+
+    def __init__(self, key: Tuple[StreamWriter, bytes], data: Frame):
+        self.key = key
+        self.data = data
+
+
+# Queue a message for one subscriber according to the channel's policy for
+# slow subscribers:
+#   • drop-newest: the new message is lost (the original behavior).
+#   • drop-oldest: the oldest message on the send queue is lost instead.
+#   • coalesce: only the latest message of the channel is kept.
+#   • disconnect: the subscriber is cut off, and has to reconnect (and catch
+#     up by other means, such as a replay).
+#   • spill: messages that don't fit go to a queue on disk (mq_log.Spill)
+#     and are sent once the subscriber catches up. Nothing is lost, at the
+#     cost of disk space.
+# This never waits, so one slow subscriber can't hold up a channel.
+def offer(writer: StreamWriter, name: bytes, msg: Union[Frame, Message],
+          policy: str):
+    queue = SEND_QUEUES[writer]
+    counts = SLOW_COUNTS[writer]
+    # Before anything is dropped to make room, what has expired goes.
+    if queue.full():
+        counts['expired'] += len(queue.expire())
+    if policy == 'coalesce' and (latest := LATEST.get((writer, name))):
+        counts['overflowed'] += 1
+        counts['dropped'] += 1
+        TRAFFIC[name][2] += 1
+        latest.data = msg
+        return
+    if policy == 'spill' and (spill := SPILLS.get(writer)) and len(spill):
+        # Once anything has spilled, everything after it goes to disk too,
+        # so that the channel's messages stay in order. Only the data is
+        # written, so spilled messages lose their lane and TTL.
+        counts['overflowed'] += 1
+        spill.push(unwrap(msg))
+        return
+    if policy == 'coalesce':
+        msg = LATEST[(writer, name)] = Latest((writer, name), msg)
+    if not queue.full():
+        queue.put_nowait(msg)
+        return
+    counts['overflowed'] += 1
+    if policy == 'drop-oldest':
+        if isinstance(oldest := queue.drop_nowait(), Latest):
+            del LATEST[oldest.key]
+        queue.put_nowait(msg)
+        counts['dropped'] += 1
+        TRAFFIC[name][2] += 1
+    elif policy == 'spill':
+        SPILLS.setdefault(writer, Spill()).push(unwrap(msg))
+    else:
+        if policy == 'coalesce':
+            del LATEST[(writer, name)]
+        elif policy == 'disconnect' and not writer.transport.is_closing():
+            peername = writer.get_extra_info('peername')
+            print(f'Disconnecting slow subscriber {peername}')
+            writer.transport.abort()
+        counts['dropped'] += 1
+        TRAFFIC[name][2] += 1
+
+
+# Every interval seconds, publish a snapshot of the broker's state on the
+# /sys/stats channel, as JSON, if anyone is subscribed to it. On the hot
+# path, this costs no more than the few additions in publish() and offer();
+# everything else is worked out here, once per interval. The snapshot has:
+#   • loop_lag_ms: how much later than asked this task woke up, which is
+#     how long the event loop was busy with other things.
+#   • channel_tasks, connections: the number of chan_sender() tasks and of
+#     client connections.
+#   • delayed: the number of delayed messages not yet due.
+#   • links: for each link to another node, the number of messages
+#     forwarded to it.
+#   • channels: for each channel that had traffic during the interval or
+#     has messages queued, its message and byte rates, the number of
+#     messages dropped for slow subscribers, of those that expired and of
+#     duplicates turned away, the depth of its queue, and the number of
+#     subscribers.
+#   • send_batches: how many messages were written to a subscriber at a
+#     time (see send_client()), as the number of batches of 1, 2-3, 4-7,
+#     ... messages.
+#   • subscribers: for each connection that has messages waiting to be
+#     sent, or has lost any, the depth of its send queue (and of its spill
+#     on disk) and its overflow, drop and expiry counts since it connected.
+async def publish_stats(interval: float):
+    loop = asyncio.get_running_loop()
+    last = loop.time()
+    while True:
+        await asyncio.sleep(interval)
+        now = loop.time()
+        elapsed, last = now - last, now
+        traffic = dict(TRAFFIC)
+        TRAFFIC.clear()
+        batches = sorted(BATCH_SIZES.items())
+        BATCH_SIZES.clear()
+        if not route(STATS_CHANNEL):
+            continue
+        snapshot = dict(
+            time=time.time(),
+            loop_lag_ms=round((elapsed - interval) * 1000, 3),
+            channel_tasks=len(CHANNEL_TASKS),
+            connections=len(SEND_QUEUES),
+            delayed=len(TIMERS),
+            links={node.decode(errors='replace'): link.forwarded
+                   for node, link in LINKS.items()},
+            channels=channel_stats(traffic, elapsed),
+            send_batches={batch_range(n): count for n, count in batches},
+            subscribers=subscriber_stats())
+        await publish(STATS_CHANNEL, json.dumps(snapshot).encode())
+
+
+def channel_stats(traffic: Dict[bytes, List[int]], elapsed: float) -> Dict:
+    stats = {}
+    for name, queue in CHAN_QUEUES.items():
+        messages, size, dropped, stale, duplicates = traffic.get(
+            name, (0, 0, 0, 0, 0))
+        if not (messages or dropped or stale or duplicates
+                or queue.qsize()):
+            continue
+        stats[name.decode(errors='replace')] = dict(
+            messages_per_second=round(messages / elapsed, 1),
+            bytes_per_second=round(size / elapsed, 1),
+            dropped=dropped,
+            expired=stale,
+            duplicates=duplicates,
+            queued=queue.qsize(),
+            subscribers=len(route(name)))
+    return stats
+
+
+def batch_range(n: int) -> str:
+    low, high = 1 << (n - 1), (1 << n) - 1
+    return str(low) if low == high else f'{low}-{high}'
+
+
+def subscriber_stats() -> Dict:
+    stats = {}
+    for writer, queue in SEND_QUEUES.items():
+        counts = SLOW_COUNTS.get(writer, {})
+        spill = SPILLS.get(writer)
+        if not (queue.qsize() or spill or counts.get('dropped')
+                or counts.get('expired')):
+            continue
+        peername = writer.get_extra_info('peername')
+        if isinstance(peername, tuple):
+            peername = ':'.join(map(str, peername[:2]))
+        stats[str(peername)] = dict(
+            queued=queue.qsize(),
+            spilled=len(spill) if spill else 0,
+            overflowed=counts.get('overflowed', 0),
+            dropped=counts.get('dropped', 0),
+            expired=counts.get('expired', 0))
+    return stats
+
+
+async def main(*args, framer: str = 'stream', durable: Dict = None,
+               sync_interval: float = 0.01, slow: Dict = None,
+               idle_timeout: float = 60, stats_interval: float = 5,
+               max_frame_size: Optional[int] = None, zdict: bytes = b'',
+               unix: Optional[str] = None, federation: Dict = None,
+               trace: Dict = None, delay: Dict = None, dedup: Dict = None,
+               **kwargs):
+    LIMITS['max_frame_size'] = max_frame_size
+    if dedup:
+        DEDUP.configure(**dedup)
+    if delay:
+        TIMERS.configure(**delay)
+    timers = asyncio.create_task(TIMERS.run(release))
+    if trace:
+        flush = trace.pop('flush')
+        TRACE.configure(**trace)
+        install_dump(TRACE)
+        if flush:
+            flusher = asyncio.create_task(TRACE.flusher(flush))
+    if zdict:
+        codec = Codec(zdict)
+        COMPRESSORS[codec.dict_id] = codec
+    if slow:
+        SLOW_POLICIES.extend(slow.pop('policies', []))
+        SLOW_OPTIONS.update(slow)
+    if durable:
+        LOG_OPTIONS.update(durable)
+        # Pick up the durable channels of a previous run, so that their
+        # backlog is delivered as soon as consumers turn up.
+        os.makedirs(durable['directory'], exist_ok=True)
+        for entry in os.listdir(durable['directory']):
+            get_channel(unquote_to_bytes(entry))
+        syncer = asyncio.create_task(log_syncer(LOGS.values(), sync_interval))
+    if idle_timeout:
+        reaper = asyncio.create_task(reap_channels(idle_timeout))
+    if stats_interval:
+        stats = asyncio.create_task(publish_stats(stats_interval))
+    links = []
+    if federation:
+        FEDERATION.update(node=federation['node'],
+                          max_hops=federation['max_hops'])
+        for host, port, patterns in federation['links']:
+            links.append(asyncio.create_task(federate(
+                host, port, patterns, FEDERATION['node'],
+                FEDERATION['max_hops'], attach_link, detach_link, publish)))
+    if framer == 'buffered':
+        server = await start_frame_server(
+            *args, max_size=max_frame_size, **kwargs)
+    else:
+        server = await asyncio.start_server(*args, **kwargs)
+    # A Unix socket as well, as in mq_server.
+    if unix:
+        if framer == 'buffered':
+            unix_server = await start_frame_unix_server(
+                args[0], unix, max_size=max_frame_size)
+        else:
+            unix_server = await asyncio.start_unix_server(args[0], unix)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if unix:
+            unix_server.close()
+            os.remove(unix)
+        timers.cancel()
+        if idle_timeout:
+            reaper.cancel()
+        if stats_interval:
+            stats.cancel()
+        for task in links:
+            task.cancel()
+        if trace and flush:
+            flusher.cancel()
+        if durable:
+            syncer.cancel()
+            for log in LOGS.values():
+                log.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=25000, type=int)
+    parser.add_argument('--framer', default='stream',
+                        choices=['stream', 'buffered'])
+    # Durable mode: /queue channels are written to a log in this directory
+    # (see mq_log). Logs roll over to a new segment every --segment-bytes,
+    # old segments are deleted once the log is bigger than
+    # --retention-bytes or older than --retention-seconds, and the disk is
+    # synced every --sync-interval seconds.
+    parser.add_argument('--durable', metavar='DIRECTORY')
+    parser.add_argument('--segment-bytes', default=64 * 1024 * 1024,
+                        type=int)
+    parser.add_argument('--retention-bytes', type=int)
+    parser.add_argument('--retention-seconds', type=float)
+    parser.add_argument('--sync-interval', default=0.01, type=float)
+    # Slow subscribers: each one has a send queue of --send-queue-size
+    # messages, and what happens when it is full is up to the channel's
+    # policy, e.g. --slow-policy '/topic/prices/#=coalesce'. Channels that
+    # match no --slow-policy get --default-policy. A subscriber with a
+    # backlog is sent up to --send-batch-bytes of it in one write.
+    parser.add_argument('--send-queue-size', default=1000, type=int)
+    parser.add_argument('--send-batch-bytes', default=64 * 1024, type=int)
+    parser.add_argument('--default-policy', default='drop-newest',
+                        choices=POLICIES)
+    parser.add_argument('--slow-policy', default=[], action='append',
+                        metavar='PATTERN=POLICY')
+    # Channels that have been idle for --idle-timeout seconds are dropped
+    # (0 keeps them forever).
+    parser.add_argument('--idle-timeout', default=60, type=float)
+    # Snapshots on /sys/stats every --stats-interval seconds (0 for none).
+    parser.add_argument('--stats-interval', default=5, type=float)
+    # Zero means no limit.
+    parser.add_argument('--max-frame-size', default=16 * 1024 * 1024,
+                        type=int)
+    # A preset dictionary for compression, shared with the clients.
+    parser.add_argument('--zdict', metavar='FILE')
+    # Listen on a Unix socket too, for clients on the same machine.
+    parser.add_argument('--unix', metavar='PATH')
+    # Federation with brokers on other nodes (see mq_federation), e.g.
+    # --federate other-host:25000=/topic/prices/#,/topic/news. --node names
+    # this broker (by default, after its host name and port), and
+    # --max-hops is how many links a message may cross.
+    parser.add_argument('--federate', default=[], action='append',
+                        metavar='HOST:PORT=PATTERNS')
+    parser.add_argument('--node')
+    parser.add_argument('--max-hops', default=1, type=int)
+    # Delayed messages are released every --delay-tick seconds, from a
+    # timer wheel of --delay-slots slots (see mq_timers).
+    parser.add_argument('--delay-tick', default=0.01, type=float)
+    parser.add_argument('--delay-slots', default=4096, type=int)
+    # Idempotent publishing (see mq_dedup).
+    mq_dedup.add_arguments(parser)
+    mq_trace.add_arguments(parser)
+    args = parser.parse_args()
+    zdict = b''
+    if args.zdict:
+        with open(args.zdict, 'rb') as f:
+            zdict = f.read()
+    policies = []
+    for rule in args.slow_policy:
+        pattern, _, policy = rule.rpartition('=')
+        if policy not in POLICIES:
+            parser.error(f'unknown policy in --slow-policy {rule}')
+        policies.append((pattern.encode(), policy))
+    slow = dict(policies=policies, default=args.default_policy,
+                send_queue_size=args.send_queue_size,
+                send_batch_bytes=args.send_batch_bytes)
+    links = []
+    for rule in args.federate:
+        address, _, patterns = rule.partition('=')
+        host, _, port = address.rpartition(':')
+        if not (host and port.isdigit() and patterns):
+            parser.error(f'--federate {rule} is not HOST:PORT=PATTERNS')
+        links.append((host, int(port),
+                      [p.encode() for p in patterns.split(',')]))
+    if args.max_hops < 1:
+        parser.error('--max-hops must be at least 1')
+    federation = dict(
+        node=(args.node or f'{socket.gethostname()}:{args.port}').encode(),
+        max_hops=args.max_hops, links=links)
+    durable = args.durable and dict(
+        directory=args.durable, segment_bytes=args.segment_bytes,
+        retention_bytes=args.retention_bytes,
+        retention_seconds=args.retention_seconds)
+    try:
+        asyncio.run(main(client, host=args.host, port=args.port,
+                         framer=args.framer, durable=durable,
+                         sync_interval=args.sync_interval, slow=slow,
+                         idle_timeout=args.idle_timeout,
+                         stats_interval=args.stats_interval,
+                         max_frame_size=args.max_frame_size,
+                         zdict=zdict, unix=args.unix,
+                         federation=federation,
+                         trace=mq_trace.options(args),
+                         delay=dict(tick=args.delay_tick,
+                                    slots=args.delay_slots),
+                         dedup=mq_dedup.options(args)))
+    except KeyboardInterrupt:
+        print('Bye!')
@@ -0,0 +1,92 @@
+# Tests for mq_server_plus, run in-process:
+#   python -m pytest mq_server_plus_test.py
+# or simply python mq_server_plus_test.py.
+import asyncio
+import tempfile
+import mq_server_plus as broker
+
+
+# A channel that was published to but never subscribed to still has its
+# message queued. Once it has been idle for idle_timeout, the reaper must
+# drop it anyway, along with its queue, its chan_sender() task and whatever
+# else the broker kept for it.
+def test_reaps_channels_without_subscribers():
+    async def main():
+        for i in range(30):
+            await broker.publish(b'/topic/session/%d' % i, b'x')
+        # A subscriber that has come and gone leaves nothing behind.
+        broker.subscribe(b'/topic/session/0', 'writer')
+        broker.unsubscribe(b'/topic/session/0', 'writer')
+        await asyncio.sleep(0)
+        assert len(broker.CHANNEL_TASKS) == 30
+        reaper = asyncio.create_task(broker.reap_channels(0.05))
+        # One round marks them as idle, the next one reaps them.
+        await asyncio.sleep(0.2)
+        reaper.cancel()
+        assert not broker.CHAN_QUEUES
+        assert not broker.WAKE
+        assert not broker.CHANNEL_TASKS
+        assert not broker.SUBSCRIBERS
+        assert not broker.TRAFFIC
+
+    asyncio.run(main())
+
+
+# A publisher waiting for room on a full channel that gets reaped must not
+# lose its message: it goes to the channel's new queue.
+def test_keeps_message_waiting_on_reaped_channel():
+    async def main():
+        for i in range(10):
+            await broker.publish(b'/topic/full', b'%d' % i)
+        waiting = asyncio.create_task(broker.publish(b'/topic/full', b'late'))
+        reaper = asyncio.create_task(broker.reap_channels(0.1))
+        # The second round reaps the channel.
+        await asyncio.sleep(0.25)
+        reaper.cancel()
+        assert waiting.done()
+        assert broker.CHAN_QUEUES[b'/topic/full'].get_nowait() == b'late'
+
+    asyncio.run(main())
+
+
+# A durable channel whose backlog has all been delivered is idle, but while a
+# client is replaying its log, the reaper must leave the log open.
+def test_keeps_log_open_during_replay():
+    class SlowWriter:
+        def __init__(self):
+            self.frames = []
+
+        def writelines(self, buffers):
+            self.frames.append(buffers[1])
+
+        async def drain(self):
+            await asyncio.sleep(0.01)
+
+    async def main():
+        broker.LOG_OPTIONS.update(directory=tempfile.mkdtemp())
+        try:
+            for i in range(30):
+                await broker.publish(b'/queue/orders', b'%d' % i)
+            log = broker.LOGS[b'/queue/orders']
+            log.cursor = log.end
+            writer = SlowWriter()
+            reaper = asyncio.create_task(broker.reap_channels(0.05))
+            await broker.replay(writer, b'/queue/orders', log, 0)
+            assert writer.frames == [b'%d' % i for i in range(30)]
+            assert not log.closed
+            # Once the replay is done, the channel is reaped as usual.
+            await asyncio.sleep(0.2)
+            reaper.cancel()
+            assert log.closed
+            assert not broker.REPLAYING
+        finally:
+            broker.LOG_OPTIONS.clear()
+
+    asyncio.run(main())
+
+
+if __name__ == '__main__':
+    test_reaps_channels_without_subscribers()
+    test_keeps_message_waiting_on_reaped_channel()
+    test_keeps_log_open_during_replay()
+    print('OK')
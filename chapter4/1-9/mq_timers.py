@@ -0,0 +1,96 @@
+# Delayed delivery for both brokers (see msgproto.DELAY): a hashed timer
+# wheel.
+#
+# The obvious way to hold a message until its time comes is a task per
+# message that sleeps and then publishes it. Every one of those is a task, a
+# coroutine, a timer handle in the event loop's heap and a future, a couple
+# of kilobytes all told, and every timer costs O(log n) to add to the heap
+# and to take off it again. With millions of messages waiting, that's
+# gigabytes, and a loop that spends its time sorting timers.
+#
+# A TimerWheel keeps pending messages in a ring of slots instead, one per
+# tick of time (10 ms by default). A message goes into the slot of the tick
+# it's due in, modulo the number of slots, as a (tick, channel, data) tuple
+# and nothing else; messages for the same channel share its name. One task,
+# run(), moves the wheel on every tick and releases the messages that have
+# come due, all of them in one batch, so adding a message is O(1), and
+# releasing one is O(1) too. A message due further ahead than one turn of
+# the wheel (41 s with the defaults) shares its slot with those of the
+# current turn; it stays there, and is looked at once per turn until its
+# tick comes. Messages due in the same tick are released in the order they
+# were scheduled.
+#
+# Like the queues of channels that aren't durable, the wheel is in memory
+# only: whatever is pending when the broker stops is lost.
+import asyncio
+import math
+import time
+from typing import Awaitable, Callable, Dict, List, Tuple
+from msgproto import Frame
+
+
+class TimerWheel:
+    def __init__(self, tick: float = 0.01, slots: int = 4096):
+        self.configure(tick, slots)
+        self._pending = asyncio.Event()
+
+    def configure(self, tick: float, slots: int):
+        self.tick = tick
+        self.slots: List[List[Tuple[int, bytes, Frame]]] = [
+            [] for _ in range(slots)]
+        self.count = 0
+        # One copy of each channel name for all of its pending messages.
+        self.names: Dict[bytes, bytes] = {}
+        # Everything due up to and including this tick has been released.
+        self.current = math.floor(time.monotonic() / tick)
+
+    def __len__(self) -> int:
+        return self.count
+
+    # Hold data for channel until the time.monotonic() time due.
+    def schedule(self, due: float, channel: bytes, data: Frame):
+        if not self.count:
+            # The wheel stood still while it was empty.
+            self.current = math.floor(time.monotonic() / self.tick)
+        tick = max(math.ceil(due / self.tick), self.current + 1)
+        channel = self.names.setdefault(channel, channel)
+        self.slots[tick % len(self.slots)].append((tick, channel, data))
+        self.count += 1
+        self._pending.set()
+
+    # The (channel, data) of every message due by the time.monotonic() time
+    # now, in the order they're due.
+    def advance(self, now: float) -> List[Tuple[bytes, Frame]]:
+        end = math.floor(now / self.tick)
+        size = len(self.slots)
+        due = []
+        # However far behind the wheel is, each slot only needs looking at
+        # once.
+        for tick in range(self.current + 1,
+                          min(end, self.current + size) + 1):
+            if not (slot := self.slots[tick % size]):
+                continue
+            self.slots[tick % size] = later = [
+                entry for entry in slot if entry[0] > end]
+            if later:
+                slot = [entry for entry in slot if entry[0] <= end]
+            due += slot
+        if end - self.current > size:
+            due.sort(key=lambda entry: entry[0])
+        self.current = max(self.current, end)
+        if not (count := self.count - len(due)):
+            self.names.clear()
+        self.count = count
+        return [(channel, data) for _, channel, data in due]
+
+    # Move the wheel on every tick, and hand each batch of messages that came
+    # due to release(). The wheel only turns while it has messages.
+    async def run(self, release: Callable[[List[Tuple[bytes, Frame]]],
+                                          Awaitable[None]]):
+        while True:
+            if not self.count:
+                self._pending.clear()
+                await self._pending.wait()
+            await asyncio.sleep(self.tick)
+            if due := self.advance(time.monotonic()):
+                await release(due)
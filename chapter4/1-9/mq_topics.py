@@ -0,0 +1,98 @@
+# Pattern subscriptions for the message brokers. Channel names are split on
+# b'/' into segments, and a pattern may use two wildcard segments:
+#   • b'*' matches exactly one segment: /topic/orders/* matches
+#     /topic/orders/new but not /topic/orders/new/eu.
+#   • b'#', only as the last segment, matches any number of remaining
+#     segments, including none: /topic/# matches /topic, /topic/orders and
+#     /topic/orders/new/eu.
+# Patterns are stored in a trie keyed by segment. Matching a channel walks
+# the trie one segment at a time, following at most the exact, * and #
+# branches at each level, so its cost depends on the length of the channel
+# name, not on how many patterns are registered.
+from typing import Dict, Hashable, List
+
+
+STAR = b'*'
+HASH = b'#'
+
+
+def is_pattern(channel: bytes) -> bool:
+    return any(s in (STAR, HASH) for s in channel.split(b'/'))
+
+
+# Match a single pattern, for when building a trie isn't worth it.
+def matches(pattern: bytes, channel: bytes) -> bool:
+    segments = channel.split(b'/')
+    for i, segment in enumerate(pattern.split(b'/')):
+        if segment == HASH:
+            return True
+        if i == len(segments) or segment not in (STAR, segments[i]):
+            return False
+    return i + 1 == len(segments)
+
+
+class _Node:
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children: Dict[bytes, _Node] = {}
+        # Used as an ordered set, so that match() results come out in
+        # subscription order.
+        self.subscribers: Dict[Hashable, None] = {}
+
+
+class TopicTrie:
+    def __init__(self):
+        self._root = _Node()
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, pattern: bytes, subscriber: Hashable):
+        node = self._root
+        for segment in pattern.split(b'/'):
+            node = node.children.setdefault(segment, _Node())
+        if subscriber not in node.subscribers:
+            node.subscribers[subscriber] = None
+            self._count += 1
+
+    def remove(self, pattern: bytes, subscriber: Hashable):
+        # Walk down, remembering the path, so that nodes left with neither
+        # subscribers nor children can be pruned on the way back up.
+        path = [self._root]
+        segments = pattern.split(b'/')
+        for segment in segments:
+            if (node := path[-1].children.get(segment)) is None:
+                return
+            path.append(node)
+        if subscriber not in path[-1].subscribers:
+            return
+        del path[-1].subscribers[subscriber]
+        self._count -= 1
+        for i in range(len(segments), 0, -1):
+            if path[i].subscribers or path[i].children:
+                break
+            del path[i - 1].children[segments[i - 1]]
+
+    def match(self, channel: bytes) -> List[Hashable]:
+        found: Dict[Hashable, None] = {}
+        nodes = [self._root]
+        for segment in channel.split(b'/'):
+            following = []
+            for node in nodes:
+                children = node.children
+                if (child := children.get(HASH)) is not None:
+                    found.update(child.subscribers)
+                if (child := children.get(segment)) is not None:
+                    following.append(child)
+                if (child := children.get(STAR)) is not None:
+                    following.append(child)
+            if not (nodes := following):
+                break
+        for node in nodes:
+            found.update(node.subscribers)
+            # A trailing # also matches when there are no segments left.
+            if (child := node.children.get(HASH)) is not None:
+                found.update(child.subscribers)
+        return list(found)
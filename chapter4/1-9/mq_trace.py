@@ -0,0 +1,124 @@
+# Tracing for the hot paths of the brokers, in place of a print() for every
+# message.
+#
+# A print() per message costs more than everything else the broker does
+# with the message, and a busy broker's output is unreadable anyway. A
+# Tracer records events into a ring of preallocated slots instead: an event
+# is a timestamp, a level, a format string and its arguments, and nothing
+# is formatted until the event is written out. Events below the tracer's
+# level are not recorded at all, and of the per-message ones (those that
+# ask sampled() first) only one in every sample is. When the ring is full,
+# the newest events replace the oldest ones.
+#
+# flusher() writes whatever has been recorded since its last round every
+# interval seconds, as one write, in the default executor, so a slow
+# terminal or pipe doesn't hold up the event loop. dump() formats the whole
+# ring on demand, e.g. from a signal handler (see install_dump()), for a
+# look at the last few thousand messages through a broker that isn't
+# printing anything.
+import argparse
+import asyncio
+import signal
+import sys
+import time
+from typing import Any, List, Optional, TextIO, Tuple
+
+DEBUG, INFO, WARNING = 10, 20, 30
+LEVELS = dict(debug=DEBUG, info=INFO, warning=WARNING)
+NAMES = {level: name.upper() for name, level in LEVELS.items()}
+
+
+class Tracer:
+    def __init__(self, size: int = 4096, level: int = INFO, sample: int = 1):
+        self.configure(size, level, sample)
+
+    def configure(self, size: int, level: int, sample: int):
+        self.slots: List[Optional[Tuple[float, int, str, Tuple[Any, ...]]]] = (
+            [None] * size)
+        self.level = level
+        self.sample = sample
+        # Events recorded so far, and of those, the number written out by
+        # flusher(); slot i holds event number n where n % size == i.
+        self.count = 0
+        self.flushed = 0
+        self._seen = 0
+
+    # For events that happen once per message: whether this one is to be
+    # recorded. Callers check this before building the event's arguments.
+    def sampled(self, level: int = DEBUG) -> bool:
+        if level < self.level:
+            return False
+        self._seen += 1
+        return self._seen % self.sample == 0
+
+    def event(self, level: int, fmt: str, *args: Any):
+        if level < self.level:
+            return
+        self.slots[self.count % len(self.slots)] = (
+            time.time(), level, fmt, args)
+        self.count += 1
+
+    def lines(self, start: int) -> List[str]:
+        # Event number start onward, formatted, as far as the ring still has
+        # them.
+        size = len(self.slots)
+        lines = []
+        if (lost := self.count - size - start) > 0:
+            lines.append(f'... {lost} events overwritten before they were '
+                         f'written out')
+            start += lost
+        for n in range(start, self.count):
+            when, level, fmt, args = self.slots[n % size]
+            stamp = time.strftime('%H:%M:%S', time.localtime(when))
+            lines.append(f'{stamp}.{int(when % 1 * 1000):03d} '
+                         f'{NAMES.get(level, level)} {fmt % args}')
+        return lines
+
+    def dump(self) -> str:
+        start = max(self.count - len(self.slots), 0)
+        return ''.join(f'{line}\n' for line in self.lines(start))
+
+    async def flusher(self, interval: float, stream: TextIO = sys.stdout):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            if self.flushed == self.count:
+                continue
+            text = ''.join(f'{line}\n' for line in self.lines(self.flushed))
+            self.flushed = self.count
+            await loop.run_in_executor(None, write, stream, text)
+
+
+def write(stream: TextIO, text: str):
+    stream.write(text)
+    stream.flush()
+
+
+# Dump the ring to stream whenever the process gets SIGUSR1, e.g. with
+# kill -USR1 <pid>.
+def install_dump(tracer: Tracer, stream: TextIO = sys.stderr):
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGUSR1, lambda: write(stream, tracer.dump()))
+
+
+# The command-line options of both brokers: events at --trace-level and
+# above, and of those that come with every message, one in --trace-sample,
+# are kept in a ring of --trace-size events, and written out every
+# --trace-flush seconds (with 0, only on SIGUSR1).
+def add_arguments(parser):
+    parser.add_argument('--trace-level', default='debug', choices=LEVELS)
+    parser.add_argument('--trace-sample', default=100, type=sample_rate)
+    parser.add_argument('--trace-size', default=4096, type=int)
+    parser.add_argument('--trace-flush', default=0, type=float)
+
+
+# One in every n events: n can't be less than one.
+def sample_rate(value: str) -> int:
+    if (n := int(value)) < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, not {n}')
+    return n
+
+
+def options(args) -> dict:
+    return dict(size=args.trace_size, level=LEVELS[args.trace_level],
+                sample=args.trace_sample, flush=args.trace_flush)
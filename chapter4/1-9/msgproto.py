@@ -1,20 +1,680 @@
 # Example 4-1. Message protocol: read and write
+import asyncio
+import zlib
 from asyncio import StreamReader, StreamWriter
+from asyncio.streams import FlowControlMixin
+from collections import deque
+from typing import Deque, Iterable, Iterator, List, Optional, Tuple, Union
 
+# Frames handed out by the buffered framer (see FrameProtocol below) are
+# memoryview slices of its receive buffer rather than fresh bytes objects.
+Frame = Union[bytes, memoryview]
 
-async def read_msg(stream: StreamReader) -> bytes:
+# Control frames. After subscribing, a client normally sends a channel name
+# followed by the data for it. Channel names start with b'/', and never with
+# a NUL byte, so a frame in the channel-name position that starts with
+# CONTROL cannot be mistaken for one; its second byte says what kind of
+# control frame it is. Clients that never send control frames see exactly
+# the original protocol.
+CONTROL = b'\x00'
+# A batch frame carries any number of (channel, data) pairs, each encoded as
+# a 4-byte channel name size, the channel name, a 4-byte data size, and the
+# data.
+BATCH = b'\x00B'
+# Channel aliases. Sending the full channel name with every message costs
+# bytes on the wire and, in the broker, a fresh bytes object and a dict
+# lookup per message. Instead, a client can register a channel name once
+# under a small integer alias of its own choosing (REGISTER, 4-byte alias,
+# channel name). From then on, it publishes with a PUBLISH frame: the 4-byte
+# alias followed directly by the data. Aliases belong to the connection that
+# registered them, so clients don't need to coordinate, and no reply from
+# the broker is needed before the alias can be used.
+REGISTER = b'\x00R'
+PUBLISH = b'\x00P'
+# The first frame on a connection subscribes it to one channel. SUBSCRIBE and
+# UNSUBSCRIBE, followed by a channel name or a pattern (see mq_topics), add
+# and remove further subscriptions on the same connection at any time.
+SUBSCRIBE = b'\x00S'
+UNSUBSCRIBE = b'\x00U'
+# For durable /queue channels (see mq_log), REPLAY, an 8-byte offset and a
+# channel name asks the broker to send this connection every message of that
+# channel still on disk, from the offset onward.
+REPLAY = b'\x00O'
+# Work queue consumers that acknowledge what they have done. PREFETCH, a
+# 4-byte window and a /queue channel name (or pattern) subscribes like
+# SUBSCRIBE, and also says that this connection will acknowledge the /queue
+# messages it receives: it will have at most window unacknowledged messages
+# at a time, and the broker gives each message to the consumer with the most
+# free room in its window. ACK and a 4-byte count acknowledges that many of
+# the oldest unacknowledged messages. When a consumer goes away, the
+# messages it hasn't acknowledged are given to other consumers.
+PREFETCH = b'\x00F'
+ACK = b'\x00A'
+# Large messages. Every frame is read completely before anything is done with
+# it, so a message has to fit in memory, and in a broker it fits once per
+# connection that is in the middle of sending one. A message can instead be
+# sent in pieces of any size: each CHUNK frame carries a 4-byte size of the
+# whole message, a 4-byte channel name size, the channel name and the next
+# piece of the data. The broker passes every piece on as it arrives, and its
+# subscribers receive the message as one ordinary frame. The pieces of one
+# message must follow each other on the connection, but other frames may come
+# in between.
+CHUNK = b'\x00C'
+# Compression of what the broker sends. COMPRESS, optionally followed by the
+# 4-byte id of a preset dictionary (see Codec below), is sent as the very
+# first frame, right before the channel to subscribe to, and asks the broker
+# to compress everything it sends to this connection. Each of those frames
+# starts with a byte that says what follows: PLAIN for data that wasn't
+# worth compressing, ZLIB, or ZLIB_DICT for zlib with the preset dictionary.
+# A broker that doesn't have a dictionary with that id uses plain ZLIB, and
+# the marker byte tells the client so.
+COMPRESS = b'\x00Z'
+PLAIN = b'='
+ZLIB = b'z'
+ZLIB_DICT = b'd'
+# A message with a priority lane and a time to live. ENVELOPE carries a
+# 1-byte lane (0 is the default; higher lanes are more urgent), a 4-byte TTL
+# in milliseconds (0 for none), a 4-byte channel name size, the channel name
+# and the data. A broker that queues messages sends those in higher lanes
+# first, and never sends a message once its TTL has run out.
+ENVELOPE = b'\x00E'
+# Delayed delivery. DELAY carries an 8-byte time in milliseconds since the
+# epoch, a 4-byte channel name size, the channel name and the data. The
+# broker holds on to the message until that time and only then publishes
+# it to the channel; a time in the past publishes it right away.
+DELAY = b'\x00D'
+# Idempotent publishing. IDEMPOTENT carries a 1-byte message id size, the
+# message id, a 4-byte channel name size, the channel name and the data. The
+# broker publishes a message with an id it has recently seen on the same
+# channel only once, so a producer that isn't sure whether a message got
+# through, e.g. after its connection broke, can safely send it again with
+# the same id.
+IDEMPOTENT = b'\x00I'
+# Request and reply (see mq_client.BrokerClient.request()). These aren't
+# control frames but the data of ordinary messages, which the broker passes
+# on like any other. A request is REQUEST, a 1-byte correlation id size, the
+# correlation id, a 4-byte size of the channel name to reply to, the channel
+# name, and the request itself. Its reply, published to that channel, is
+# REPLY, the same correlation id with its 1-byte size, and the reply itself.
+REQUEST = b'\x00Q'
+REPLY = b'\x00Y'
+# Federation (see mq_federation). A broker that links up with another one
+# sends FEDERATE as its first frame, instead of a channel to subscribe to,
+# with its node name and the channel names or patterns to exchange, each as
+# a 4-byte size and the name. The other broker answers with FEDERATE and its
+# own node name.
+FEDERATE = b'\x00X'
+
+# Default size of each receive buffer used by FrameProtocol. A single
+# recv_into() call can fill the whole buffer, so this also bounds how many
+# small frames get parsed per buffer_updated() call.
+BUFSIZE = 64 * 1024
+
+
+# Raised by read_msg() when the size prefix of a frame is larger than the
+# reader allows. The rest of the frame is still on its way, so the connection
+# can't be used any further.
+class FrameTooLarge(Exception):
+    def __init__(self, size: int, max_size: int):
+        super().__init__(f'frame of {size} bytes is larger than the maximum '
+                         f'of {max_size}')
+        self.size = size
+        self.max_size = max_size
+
+
+async def read_msg(stream: Union[StreamReader, 'FrameReader'],
+                   max_size: Optional[int] = None) -> Frame:
+    # Connections opened with start_frame_server() or open_frame_connection()
+    # have already been split into frames by FrameProtocol, so there is
+    # nothing left to parse: just take the next frame. (Their maximum frame
+    # size is given to FrameProtocol instead.)
+    if isinstance(stream, FrameReader):
+        return await stream.read_frame()
     # Get the first 4 bytes. This is the size prefix.
     size_bytes = await stream.readexactly(4)
     # Those 4 bytes must be converted into an integer.
     size = int.from_bytes(size_bytes, byteorder='big')
+    # Whatever the peer claims is what readexactly() would allocate, so a
+    # limit has to be checked before reading any further.
+    if max_size and size > max_size:
+        raise FrameTooLarge(size, max_size)
     # Now we know the payload size, so we read that off the stream.
     data = await stream.readexactly(size)
     return data
 
 
-async def send_msg(stream: StreamWriter, data: bytes):
+async def send_msg(stream: StreamWriter, data: Frame):
     size_bytes = len(data).to_bytes(4, byteorder='big')
     # Write is the inverse of read: first we send the length of the data,
     # encoded as 4 bytes, and thereafter the data.
     stream.writelines([size_bytes, data])
     await stream.drain()
+
+
+def encode_msg(data: Frame) -> List[Frame]:
+    # The same two buffers that send_msg() writes, but built once so that
+    # they can be handed to any number of transports.
+    return [len(data).to_bytes(4, byteorder='big'), data]
+
+
+def encode_batch(pairs: Iterable[Tuple[bytes, Frame]]) -> List[Frame]:
+    # Like encode_msg(), the result is a list of buffers for writelines(),
+    # including the size prefix of the whole frame.
+    parts: List[Frame] = [b'', BATCH]
+    size = len(BATCH)
+    for channel, data in pairs:
+        parts += [len(channel).to_bytes(4, byteorder='big'), channel,
+                  len(data).to_bytes(4, byteorder='big'), data]
+        size += 8 + len(channel) + len(data)
+    parts[0] = size.to_bytes(4, byteorder='big')
+    return parts
+
+
+def iter_batch(frame: Frame) -> Iterator[Tuple[bytes, memoryview]]:
+    # Slicing a memoryview doesn't copy, so the data parts come out as views
+    # into the batch frame. Channel names are converted to bytes, because
+    # they are used as dict keys.
+    view = memoryview(frame)
+    pos, end = len(BATCH), len(view)
+    while pos < end:
+        size = int.from_bytes(view[pos:pos + 4], byteorder='big')
+        channel = bytes(view[pos + 4:pos + 4 + size])
+        pos += 4 + size
+        size = int.from_bytes(view[pos:pos + 4], byteorder='big')
+        yield channel, view[pos + 4:pos + 4 + size]
+        pos += 4 + size
+
+
+def encode_register(alias: int, channel: bytes) -> List[Frame]:
+    return encode_msg(REGISTER + alias.to_bytes(4, byteorder='big') + channel)
+
+
+def encode_publish(alias: int, data: Frame) -> List[Frame]:
+    # Frame size, PUBLISH and alias together are a fixed 10-byte header.
+    return [(len(data) + 6).to_bytes(4, byteorder='big') + PUBLISH
+            + alias.to_bytes(4, byteorder='big'), data]
+
+
+def encode_replay(offset: int, channel: bytes) -> List[Frame]:
+    return encode_msg(REPLAY + offset.to_bytes(8, byteorder='big') + channel)
+
+
+def encode_prefetch(window: int, channel: bytes) -> List[Frame]:
+    return encode_msg(PREFETCH + window.to_bytes(4, byteorder='big')
+                      + channel)
+
+
+def encode_ack(count: int = 1) -> List[Frame]:
+    return encode_msg(ACK + count.to_bytes(4, byteorder='big'))
+
+
+def encode_chunk(total: int, channel: bytes, piece: Frame) -> List[Frame]:
+    return [(len(piece) + 10 + len(channel)).to_bytes(4, byteorder='big')
+            + CHUNK + total.to_bytes(4, byteorder='big')
+            + len(channel).to_bytes(4, byteorder='big') + channel, piece]
+
+
+def iter_chunks(channel: bytes, data: Frame,
+                chunk_size: int) -> Iterator[List[Frame]]:
+    # The CHUNK frames for one message, with the pieces as memoryview slices
+    # of data, so nothing is copied.
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        yield encode_chunk(len(view), channel,
+                           view[start:start + chunk_size])
+    if not view:
+        yield encode_chunk(0, channel, b'')
+
+
+def parse_chunk(frame: Frame) -> Tuple[int, memoryview, memoryview]:
+    # The size of the whole message, the channel name and the piece.
+    view = memoryview(frame)
+    size = int.from_bytes(view[6:10], byteorder='big')
+    return (int.from_bytes(view[2:6], byteorder='big'), view[10:10 + size],
+            view[10 + size:])
+
+
+# Send one message as CHUNK frames of at most chunk_size bytes of data each,
+# waiting for the writer to drain after every one of them.
+async def send_chunked(stream: StreamWriter, channel: bytes, data: Frame,
+                       chunk_size: int):
+    for frame in iter_chunks(channel, data, chunk_size):
+        stream.writelines(frame)
+        await stream.drain()
+
+
+def encode_envelope(channel: bytes, data: Frame, lane: int = 0,
+                    ttl: float = 0) -> List[Frame]:
+    return [(len(data) + 11 + len(channel)).to_bytes(4, byteorder='big')
+            + ENVELOPE + lane.to_bytes(1, byteorder='big')
+            + round(ttl * 1000).to_bytes(4, byteorder='big')
+            + len(channel).to_bytes(4, byteorder='big') + channel, data]
+
+
+def parse_envelope(frame: Frame) -> Tuple[int, float, memoryview,
+                                          memoryview]:
+    # The lane, the TTL in seconds, the channel name and the data.
+    view = memoryview(frame)
+    size = int.from_bytes(view[7:11], byteorder='big')
+    return (view[2], int.from_bytes(view[3:7], byteorder='big') / 1000,
+            view[11:11 + size], view[11 + size:])
+
+
+def encode_delay(channel: bytes, data: Frame, when: float) -> List[Frame]:
+    # when is a time.time() timestamp; for a delay, time.time() + delay.
+    return [(len(data) + 14 + len(channel)).to_bytes(4, byteorder='big')
+            + DELAY + round(when * 1000).to_bytes(8, byteorder='big')
+            + len(channel).to_bytes(4, byteorder='big') + channel, data]
+
+
+def parse_delay(frame: Frame) -> Tuple[float, memoryview, memoryview]:
+    # The time (as from time.time()), the channel name and the data.
+    view = memoryview(frame)
+    size = int.from_bytes(view[10:14], byteorder='big')
+    return (int.from_bytes(view[2:10], byteorder='big') / 1000,
+            view[14:14 + size], view[14 + size:])
+
+
+def encode_idempotent(channel: bytes, data: Frame,
+                      msg_id: bytes) -> List[Frame]:
+    size = len(data) + 7 + len(msg_id) + len(channel)
+    return [size.to_bytes(4, byteorder='big')
+            + IDEMPOTENT + len(msg_id).to_bytes(1, byteorder='big') + msg_id
+            + len(channel).to_bytes(4, byteorder='big') + channel, data]
+
+
+def parse_idempotent(frame: Frame) -> Tuple[memoryview, memoryview,
+                                            memoryview]:
+    # The message id, the channel name and the data.
+    view = memoryview(frame)
+    pos = 3 + view[2]
+    size = int.from_bytes(view[pos:pos + 4], byteorder='big')
+    return view[3:pos], view[pos + 4:pos + 4 + size], view[pos + 4 + size:]
+
+
+def encode_request(correlation_id: bytes, reply_to: bytes,
+                   data: Frame) -> bytes:
+    return b''.join([
+        REQUEST, len(correlation_id).to_bytes(1, byteorder='big'),
+        correlation_id, len(reply_to).to_bytes(4, byteorder='big'), reply_to,
+        data])
+
+
+def parse_request(frame: Frame) -> Tuple[memoryview, memoryview,
+                                         memoryview]:
+    # The correlation id, the channel to reply to and the request.
+    view = memoryview(frame)
+    pos = 3 + view[2]
+    size = int.from_bytes(view[pos:pos + 4], byteorder='big')
+    return view[3:pos], view[pos + 4:pos + 4 + size], view[pos + 4 + size:]
+
+
+def encode_reply(correlation_id: bytes, data: Frame) -> bytes:
+    return b''.join([REPLY, len(correlation_id).to_bytes(1, byteorder='big'),
+                     correlation_id, data])
+
+
+def parse_reply(frame: Frame) -> Tuple[memoryview, memoryview]:
+    # The correlation id and the reply.
+    view = memoryview(frame)
+    pos = 3 + view[2]
+    return view[3:pos], view[pos:]
+
+
+def encode_federate(node: bytes, patterns: Iterable[bytes] = ()
+                    ) -> List[Frame]:
+    return encode_msg(FEDERATE + b''.join(
+        len(name).to_bytes(4, byteorder='big') + name
+        for name in (node, *patterns)))
+
+
+def parse_federate(frame: Frame) -> Tuple[bytes, List[bytes]]:
+    # The node name and the patterns.
+    view = memoryview(frame)
+    pos, names = len(FEDERATE), []
+    while pos < len(view):
+        size = int.from_bytes(view[pos:pos + 4], byteorder='big')
+        names.append(bytes(view[pos + 4:pos + 4 + size]))
+        pos += 4 + size
+    return names[0], names[1:]
+
+
+def encode_compress(dict_id: bytes = b'') -> List[Frame]:
+    return encode_msg(COMPRESS + dict_id)
+
+
+# zlib, with an optional preset dictionary: a sample of typical message
+# content, such as the keys and boilerplate of JSON messages. zlib finds
+# matches in the dictionary even in a message too short to repeat anything
+# itself, which is what makes compressing small messages pay off. Every
+# message is compressed on its own, so that a broker can compress it once
+# and send the result to all the subscribers that use the same codec, and
+# any of them can decompress it, whenever they subscribed.
+class Codec:
+    def __init__(self, zdict: bytes = b'', level: int = 6):
+        self.zdict = zdict
+        self.level = level
+        self.marker = ZLIB_DICT if zdict else ZLIB
+        # Both ends must have exactly the same dictionary, so its checksum
+        # is what identifies it.
+        self.dict_id = (zlib.adler32(zdict).to_bytes(4, byteorder='big')
+                        if zdict else b'')
+
+    def compress(self, data: Frame) -> bytes:
+        if self.zdict:
+            compressor = zlib.compressobj(self.level, zdict=self.zdict)
+            packed = compressor.compress(data) + compressor.flush()
+        else:
+            packed = zlib.compress(data, self.level)
+        if len(packed) < len(data):
+            return self.marker + packed
+        return PLAIN + data
+
+    def decompress(self, frame: Frame) -> bytes:
+        marker, view = bytes(frame[:1]), memoryview(frame)[1:]
+        if marker == ZLIB:
+            return zlib.decompress(view)
+        if marker == ZLIB_DICT:
+            decompressor = zlib.decompressobj(zdict=self.zdict)
+            return decompressor.decompress(view) + decompressor.flush()
+        return bytes(view)
+
+
+def parse_alias(frame: Frame) -> Tuple[int, memoryview]:
+    # For REGISTER this returns the alias and the channel name, for PUBLISH
+    # the alias and the data. (It works for PREFETCH too: the window and the
+    # channel name.)
+    view = memoryview(frame)
+    return int.from_bytes(view[2:6], byteorder='big'), view[6:]
+
+
+# A publisher that sends many small messages pays for a frame header, a
+# write() and a drain() on each one. BatchSender collects messages instead,
+# and sends them as a single batch frame once max_bytes have accumulated or
+# max_delay seconds have passed since the first message of the batch,
+# whichever comes first.
+class BatchSender:
+    def __init__(self, writer: StreamWriter, max_delay: float = 0.005,
+                 max_bytes: int = 64 * 1024):
+        self._writer = writer
+        self._max_delay = max_delay
+        self._max_bytes = max_bytes
+        self._pairs: List[Tuple[bytes, Frame]] = []
+        self._size = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def send(self, channel: bytes, data: Frame):
+        if self.add(channel, data):
+            # The only await is here, once per full batch. This is where the
+            # broker's back-pressure reaches a fast producer.
+            await self._writer.drain()
+
+    # The synchronous part of send(), for callers that can't await on every
+    # message. It returns True when a full batch was just written out, and
+    # then the caller should drain() the writer when it can.
+    def add(self, channel: bytes, data: Frame) -> bool:
+        self._pairs.append((channel, data))
+        self._size += 8 + len(channel) + len(data)
+        if self._size >= self._max_bytes:
+            self.flush()
+            return True
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self._max_delay, self.flush)
+        return False
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pairs:
+            self._writer.writelines(encode_batch(self._pairs))
+            self._pairs, self._size = [], 0
+
+
+# Fan-out for the broker: write one already-encoded message to many
+# subscribers. Unlike calling send_msg() for each subscriber, this creates no
+# coroutines and builds no headers; it just calls writelines() on each
+# transport (a vectored send on Python 3.12+). The transport accepts the data
+# into its buffer immediately, so there is only something to wait for if a
+# subscriber's buffer has grown past its high-water mark. Those subscribers,
+# and only those, are returned so that the caller can await their drain().
+def broadcast(writers: Iterable[StreamWriter],
+              frame: List[Frame]) -> List[StreamWriter]:
+    slow = []
+    for writer in writers:
+        transport = writer.transport
+        transport.writelines(frame)
+        # Most of the time the kernel takes everything and the buffer is
+        # empty, so the limits only need to be looked up on the rare
+        # occasion that it isn't.
+        size = transport.get_write_buffer_size()
+        if size and size > transport.get_write_buffer_limits()[1]:
+            slow.append(writer)
+    return slow
+
+
+# read_msg() above pays for two readexactly() calls per frame, and each one
+# goes through the StreamReader's internal buffer, a waiter future and a
+# fresh bytes allocation. For small messages at high rates, that bookkeeping
+# dominates. FrameProtocol instead uses the BufferedProtocol interface: the
+# transport receives straight into our buffer (get_buffer()), and on every
+# buffer_updated() call we parse *all* the complete frames that arrived, in a
+# plain loop with no awaits. The wire format is unchanged.
+class FrameProtocol(asyncio.BufferedProtocol):
+    def __init__(self, bufsize: int = BUFSIZE, retain: bool = True,
+                 max_size: Optional[int] = None):
+        self._bufsize = bufsize
+        # Frames larger than this are refused (see frame_too_large()) before
+        # any room is made for them.
+        self._max_size = max_size
+        # With retain=True, frame_received() may keep the memoryview slices
+        # it is given (e.g., by putting them on a queue). We then never write
+        # over bytes that have already been handed out: the buffer is filled
+        # front to back, and when it's full, a new one is allocated and only
+        # the trailing partial frame is copied across. The old buffer is
+        # freed once the last view into it goes away. With retain=False, the
+        # caller promises to be done with each view by the time
+        # frame_received() returns, so the same buffer is reused forever.
+        self._retain = retain
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        # Unparsed data lives in self._buf[self._start:self._end].
+        self._start = 0
+        self._end = 0
+
+    def frame_received(self, frame: memoryview):
+        raise NotImplementedError
+
+    def frame_too_large(self, size: int):
+        raise NotImplementedError
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._end == len(self._buf):
+            self._make_room()
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        self._end += nbytes
+        view, start, end = self._view, self._start, self._end
+        while end - start >= 4:
+            size = int.from_bytes(view[start:start + 4], byteorder='big')
+            if self._max_size and size > self._max_size:
+                # Nothing after this can be parsed, so everything that is
+                # left over is dropped. (Only the bytes before start may
+                # have been handed out, so the rest can be written over.)
+                self._start = self._end = start
+                self.frame_too_large(size)
+                return
+            if end - start - 4 < size:
+                break
+            start += 4
+            self.frame_received(view[start:start + size])
+            start += size
+        self._start = start
+        if start == end and not self._retain:
+            self._start = self._end = 0
+
+    def _make_room(self):
+        pending = self._end - self._start
+        need = self._bufsize
+        if pending >= 4:
+            # Make sure a large frame fits completely, so that it can still
+            # be handed out as a single contiguous slice. (buffer_updated()
+            # has already checked it against the maximum.)
+            size = int.from_bytes(
+                self._view[self._start:self._start + 4], byteorder='big')
+            need = max(need, 4 + size)
+        if not self._retain and need <= len(self._buf):
+            self._buf[:pending] = self._buf[self._start:self._end]
+        else:
+            buf = bytearray(need)
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf, self._view = buf, memoryview(buf)
+        self._start, self._end = 0, pending
+
+
+# FrameReader is the consumer side of a FrameStreamProtocol: frames are
+# pushed in from buffer_updated(), and coroutines pull them out with
+# read_msg(). It plays the role that StreamReader plays for
+# asyncio.start_server(), so the broker's client() coroutines work unchanged
+# with either.
+class FrameReader:
+    def __init__(self, limit: int = 1024):
+        self._frames: Deque[memoryview] = deque()
+        # If the consumer falls behind by more than this many frames, stop
+        # reading from the socket until it catches up. This is the same
+        # back-pressure that StreamReader applies with its byte limit.
+        self._limit = limit
+        self._waiter: Optional[asyncio.Future] = None
+        self._transport: Optional[asyncio.Transport] = None
+        self._paused = False
+        self._eof = False
+        self._exception: Optional[BaseException] = None
+
+    def set_transport(self, transport: asyncio.Transport):
+        self._transport = transport
+
+    def _wakeup(self):
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def feed_frame(self, frame: memoryview):
+        self._frames.append(frame)
+        self._wakeup()
+        if not self._paused and len(self._frames) > self._limit:
+            self._paused = True
+            self._transport.pause_reading()
+
+    def feed_eof(self):
+        self._eof = True
+        self._wakeup()
+
+    def set_exception(self, exc: BaseException):
+        self._exception = exc
+        self._wakeup()
+
+    async def read_frame(self) -> memoryview:
+        while not self._frames:
+            if self._exception is not None:
+                raise self._exception
+            if self._eof:
+                # Match StreamReader.readexactly(), so that callers only
+                # have one end-of-stream exception to handle.
+                raise asyncio.IncompleteReadError(b'', 4)
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        frame = self._frames.popleft()
+        if self._paused and len(self._frames) <= self._limit // 2:
+            self._paused = False
+            self._transport.resume_reading()
+        return frame
+
+
+# Glue between FrameProtocol, FrameReader and a regular StreamWriter. The
+# FlowControlMixin from asyncio.streams provides pause_writing() and
+# resume_writing() bookkeeping, which is what StreamWriter.drain() waits on.
+class FrameStreamProtocol(FrameProtocol, FlowControlMixin):
+    def __init__(self, client_connected_cb=None, loop=None,
+                 bufsize: int = BUFSIZE, max_size: Optional[int] = None):
+        FrameProtocol.__init__(self, bufsize=bufsize, retain=True,
+                               max_size=max_size)
+        FlowControlMixin.__init__(self, loop=loop)
+        self._client_connected_cb = client_connected_cb
+        self._task: Optional[asyncio.Task] = None
+        self._closed = self._loop.create_future()
+        self.reader = FrameReader()
+        self.writer: Optional[StreamWriter] = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.reader.set_transport(transport)
+        self.writer = StreamWriter(transport, self, None, self._loop)
+        if self._client_connected_cb is not None:
+            self._task = self._loop.create_task(
+                self._client_connected_cb(self.reader, self.writer))
+
+    def frame_received(self, frame: memoryview):
+        self.reader.feed_frame(frame)
+
+    def frame_too_large(self, size: int):
+        # The frames before this one are still read as usual; then read_msg()
+        # raises, just like it does with a StreamReader.
+        self.reader.set_exception(FrameTooLarge(size, self._max_size))
+        self.writer.transport.close()
+
+    def eof_received(self):
+        self.reader.feed_eof()
+        return False
+
+    def connection_lost(self, exc: Optional[BaseException]):
+        if exc is None:
+            self.reader.feed_eof()
+        else:
+            self.reader.set_exception(exc)
+        if not self._closed.done():
+            self._closed.set_result(None)
+        super().connection_lost(exc)
+
+    def _get_close_waiter(self, stream: StreamWriter) -> asyncio.Future:
+        return self._closed
+
+
+# Counterparts of asyncio.start_server() and asyncio.open_connection() that
+# use the buffered framer. A program opts in simply by calling these instead.
+async def start_frame_server(client_connected_cb, host=None, port=None,
+                             max_size: Optional[int] = None,
+                             **kwargs) -> asyncio.AbstractServer:
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(
+        lambda: FrameStreamProtocol(client_connected_cb, loop=loop,
+                                    max_size=max_size),
+        host, port, **kwargs)
+
+
+async def open_frame_connection(host=None, port=None, **kwargs):
+    loop = asyncio.get_running_loop()
+    _, protocol = await loop.create_connection(
+        lambda: FrameStreamProtocol(loop=loop), host, port, **kwargs)
+    return protocol.reader, protocol.writer
+
+
+# The same for Unix sockets, like asyncio.start_unix_server() and
+# asyncio.open_unix_connection().
+async def start_frame_unix_server(client_connected_cb, path=None,
+                                  max_size: Optional[int] = None,
+                                  **kwargs) -> asyncio.AbstractServer:
+    loop = asyncio.get_running_loop()
+    return await loop.create_unix_server(
+        lambda: FrameStreamProtocol(client_connected_cb, loop=loop,
+                                    max_size=max_size),
+        path, **kwargs)
+
+
+async def open_frame_unix_connection(path=None, **kwargs):
+    loop = asyncio.get_running_loop()
+    _, protocol = await loop.create_unix_connection(
+        lambda: FrameStreamProtocol(loop=loop), path, **kwargs)
+    return protocol.reader, protocol.writer
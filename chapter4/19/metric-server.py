@@ -9,6 +9,7 @@ from contextlib import suppress
 from aiohttp import web
 from aiohttp_sse import sse_response
 from weakref import WeakSet
+from tracing import Tracer, DEBUG
 
 
 CHARTS_HTML_FILE_PATH = os.path.join(os.path.dirname(os.path.realpath(
@@ -22,6 +23,10 @@ ctx = zmq.asyncio.Context()
 # clients. Each connected client will have an associated Queue() instance, so
 # this connections identifier is really a set of queues.
 connections = WeakSet()
+# Printing every sample, twice, costs more than handling it. The samples are
+# traced instead (see tracing.py): the last few thousand events are kept in
+# memory, and the /trace endpoint shows them.
+TRACE = Tracer(size=4096, level=DEBUG)
 
 
 async def collector():
@@ -46,7 +51,8 @@ async def collector():
         # automatically deserialized from JSON (yes, this means data is a
         # dict()).
         while data := await sock.recv_json():
-            print(data)
+            if TRACE.sampled(DEBUG):
+                TRACE.event(DEBUG, 'received %s', data)
             for q in connections:
                 # Recall that our connections set holds a queue for every
                 # connected web client. Now that data has been received, it’s
@@ -75,7 +81,8 @@ async def feed(request):
             # We remain connected to the web client, and wait for data on this
             # specific client’s queue.
             while data := await queue.get():
-                print('sending data:', data)
+                if TRACE.sampled(DEBUG):
+                    TRACE.event(DEBUG, 'sending data: %s', data)
                 # As soon as the data comes in (inside collector() ), it will
                 # be sent to the connected web client. Note that I reserialize
                 # the data dict here. An optimization to this code would be to
@@ -94,6 +101,11 @@ async def index(request):
     return aiohttp.web.FileResponse(CHARTS_HTML_FILE_PATH)
 
 
+# The traced events, oldest first, as plain text.
+async def trace(request):
+    return web.Response(text=TRACE.dump())
+
+
 # The aiohttp library provides facilities for us to hook in additional
 # long-lived coroutines we might need. With the collector() coroutine, we have
 # exactly that situation, so I create a startup coroutine, start_collector(),
@@ -118,6 +130,7 @@ if __name__ == '__main__':
     app = web.Application()
     app.router.add_route('GET', '/', index)
     app.router.add_route('GET', '/feed', feed)
+    app.router.add_route('GET', '/trace', trace)
     # Finally, you can see where the custom startup and shutdown coroutines
     # are hooked in: the app instance provides hooks to which our custom
     # coroutines may be appended.
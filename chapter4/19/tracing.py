@@ -0,0 +1,53 @@
+# Tracing, in place of a print() for every sample that comes in or goes out.
+# (A cut-down version of the Tracer in chapter4/1-9/mq_trace.py, where the
+# message brokers also write their events out as they go.)
+#
+# A Tracer records events into a ring of preallocated slots: an event is a
+# timestamp, a level, a format string and its arguments, and nothing is
+# formatted until dump() is called. Events below the tracer's level are not
+# recorded at all, and of the frequent ones (those that ask sampled() first)
+# only one in every sample is. When the ring is full, the newest events
+# replace the oldest ones.
+import time
+from typing import Any, List, Optional, Tuple
+
+DEBUG, INFO, WARNING = 10, 20, 30
+NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING'}
+
+
+class Tracer:
+    def __init__(self, size: int = 4096, level: int = INFO, sample: int = 1):
+        self.slots: List[Optional[Tuple[float, int, str, Tuple[Any, ...]]]] = (
+            [None] * size)
+        self.level = level
+        self.sample = sample
+        # Events recorded so far; slot i holds event number n where
+        # n % size == i.
+        self.count = 0
+        self._seen = 0
+
+    # For events that happen once per sample: whether this one is to be
+    # recorded. Callers check this before building the event's arguments.
+    def sampled(self, level: int = DEBUG) -> bool:
+        if level < self.level:
+            return False
+        self._seen += 1
+        return self._seen % self.sample == 0
+
+    def event(self, level: int, fmt: str, *args: Any):
+        if level < self.level:
+            return
+        self.slots[self.count % len(self.slots)] = (
+            time.time(), level, fmt, args)
+        self.count += 1
+
+    # The events still in the ring, oldest first, one per line.
+    def dump(self) -> str:
+        size = len(self.slots)
+        lines = []
+        for n in range(max(self.count - size, 0), self.count):
+            when, level, fmt, args = self.slots[n % size]
+            stamp = time.strftime('%H:%M:%S', time.localtime(when))
+            lines.append(f'{stamp}.{int(when % 1 * 1000):03d} '
+                         f'{NAMES.get(level, level)} {fmt % args}\n')
+        return ''.join(lines)